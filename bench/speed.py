@@ -3,6 +3,7 @@
 from __future__ import absolute_import, unicode_literals, division
 import random
 import string
+import threading
 import timeit
 import os
 import zipfile
@@ -67,6 +68,26 @@ def bench(name, timer, descr='M ops/sec', op_count=0.1, repeats=3, runs=5):
         descr,
     ))
 
+def bench_threaded(name, func, words, thread_counts=(1, 2, 4), runs=3):
+    for thread_count in thread_counts:
+        chunks = [words[i::thread_count] for i in range(thread_count)]
+        times = []
+        for x in range(runs):
+            threads = [threading.Thread(target=func, args=(chunk,))
+                       for chunk in chunks]
+            start = timeit.default_timer()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            times.append(timeit.default_timer() - start)
+
+        print("%55s:    %0.3f%s" % (
+            '%s, %d threads' % (name, thread_count),
+            len(words) / min(times) / 1e6,
+            'M ops/sec',
+        ))
+
 def create_trie():
     words = words100k()
     trie = datrie.Trie(ALPHABET)
@@ -82,6 +103,7 @@ def benchmark():
         ('__getitem__ (hits)', "for word in words: data[word]", 'M ops/sec', 0.1, 3),
         ('__contains__ (hits)', "for word in words: word in data", 'M ops/sec', 0.1, 3),
         ('__contains__ (misses)', "for word in NON_WORDS100k: word in data", 'M ops/sec', 0.1, 3),
+        ('__contains__ (short keys)', "for word in MIXED_WORDS100k: word in data", 'M ops/sec', 0.1, 3),
         ('__len__', 'len(data)', ' ops/sec', 1, 1),
         ('__setitem__ (updates)', 'for word in words: data[word]=1', 'M ops/sec', 0.1, 3),
         ('__setitem__ (inserts, random)', 'for word in NON_WORDS_10k: data[word]=1', 'M ops/sec',0.01, 3),
@@ -113,6 +135,34 @@ NON_WORDS_1k = ['ыва', 'xyz', 'соы', 'Axx', 'avы']*200
 
     # trie-specific benchmarks
 
+    bench(
+        'trie.build (inserts, random)',
+        timeit.Timer(
+            "datrie.Trie.build([(word, 1) for word in NON_WORDS_10k], ALPHABET)",
+            trie_setup
+        ),
+        op_count=0.01
+    )
+
+    bench(
+        'trie.build (inserts, sorted)',
+        timeit.Timer(
+            "datrie.Trie.build([(word, 1) for word in words], ALPHABET, presorted=True)",
+            trie_setup
+        )
+    )
+
+    for test_name, test in [
+        ('get_many (hits)', "data.get_many(words)"),
+        ('get_many (misses)', "data.get_many(NON_WORDS100k)"),
+        ('contains_many (hits)', "data.contains_many(words)"),
+        ('contains_many (misses)', "data.contains_many(NON_WORDS100k)"),
+    ]:
+        bench(
+            'trie.%s' % test_name,
+            timeit.Timer(test, trie_setup)
+        )
+
     bench(
         'trie.iter_prefix_values (hits)',
         timeit.Timer(
@@ -255,6 +305,27 @@ NON_WORDS_1k = ['ыва', 'xyz', 'соы', 'Axx', 'avы']*200
                 op_count=1,
             )
 
+
+def benchmark_threads():
+    print('\n====== Multi-threaded lookups (100k words) =======\n')
+
+    trie = create_trie()
+    words = WORDS100k * 5
+
+    def lookup(words):
+        for word in words:
+            trie[word]
+
+    def lookup_many(words):
+        for i in range(0, len(words), 1000):
+            trie.get_many(words[i:i+1000])
+
+    bench_threaded('trie.__getitem__', lookup, words)
+    bench_threaded('trie.get_many', lookup_many, words)
+    trie.concurrent = True
+    bench_threaded('trie.__getitem__ (concurrent mode)', lookup, words)
+
+
 def profiling():
     print('\n====== Profiling =======\n')
 
@@ -325,6 +396,7 @@ def profiling():
 
 if __name__ == '__main__':
     benchmark()
+    benchmark_threads()
     #profiling()
     #memory()
     print('\n~~~~~~~~~~~~~~\n')
\ No newline at end of file
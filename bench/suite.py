@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for datrie.
+
+Run benchmarks and save the results::
+
+    $ python bench/suite.py run --output before.json
+    $ python bench/suite.py run --sizes 10000,1000000 --alphabets ascii,cjk \
+          --groups lookup,memory --output after.json
+
+Compare two result files (exits with status 1 if something got slower
+or bigger by more than ``--threshold`` and by more than the spread of
+the repeated runs)::
+
+    $ python bench/suite.py compare before.json after.json
+
+Synthetic corpora are generated from a fixed seed, so the runs with
+the same arguments measure the same keys.
+"""
+from __future__ import absolute_import, unicode_literals, division
+import argparse
+import gc
+import json
+import os
+import pickle
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import zipfile
+
+# datrie is imported by ``run``, so that results can be compared
+# on a machine without the extension built
+datrie = None
+
+# characters of synthetic keys; the number of characters
+# must fit into libdatrie's alphabet (255 symbols)
+ALPHABETS = {
+    'ascii': 'abcdefghijklmnopqrstuvwxyz',
+    'cyrillic': 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя',
+    'cjk': ''.join(chr(code) for code in range(0x4E00, 0x4E00 + 200)),
+}
+
+# (min, max) lengths of synthetic keys
+KEY_LENGTHS = {
+    'ascii': (2, 14),
+    'cyrillic': (2, 14),
+    'cjk': (1, 6),
+}
+
+DEFAULT_SIZES = (10000, 100000)
+DEFAULT_ALPHABETS = ('words', 'ascii', 'cyrillic', 'cjk')
+
+# lookups, prefix walks and updates are measured on a sample of keys
+SAMPLE_SIZE = 100000
+PREFIX_SAMPLE_SIZE = 1000
+
+GROUPS = ('insert', 'lookup', 'iteration', 'prefix', 'serialization',
+          'memory')
+
+
+def words100k():
+    zip_name = os.path.join(
+        os.path.abspath(os.path.dirname(__file__)),
+        'words100k.txt.zip'
+    )
+    zf = zipfile.ZipFile(zip_name)
+    txt = zf.open(zf.namelist()[0]).read().decode('utf8')
+    return txt.splitlines()
+
+
+def synthetic_words(alphabet, count, seed, exclude=()):
+    """
+    Returns ``count`` unique random words in random order. Characters
+    have Zipf-like frequencies, so the words share prefixes like
+    natural language words do.
+    """
+    rng = random.Random(seed)
+    chars = ALPHABETS[alphabet]
+    weights = [1 / (rank + 1) for rank in range(len(chars))]
+    min_length, max_length = KEY_LENGTHS[alphabet]
+    exclude = set(exclude)
+    words = {}
+    while len(words) < count:
+        length = rng.randint(min_length, max_length)
+        word = ''.join(rng.choices(chars, weights, k=length))
+        if word not in exclude:
+            words[word] = None
+    return list(words)
+
+
+class Corpus(object):
+    """
+    Keys of a benchmark corpus, lookup samples and misses.
+    """
+    def __init__(self, alphabet, size, seed):
+        self.name = '%s-%d' % (alphabet, size)
+        self.alphabet = alphabet
+        self.size = size
+
+        if alphabet == 'words':
+            words = words100k()
+            random.Random(seed).shuffle(words)
+            self.keys = words[:size]
+            misses = synthetic_words('ascii', min(size, SAMPLE_SIZE),
+                                     seed + 1, self.keys)
+        else:
+            self.keys = synthetic_words(alphabet, size, seed)
+            misses = synthetic_words(alphabet, min(size, SAMPLE_SIZE),
+                                     seed + 1, self.keys)
+
+        self.size = len(self.keys)
+        self.sorted_keys = sorted(self.keys)
+        self.sample = self.keys[:SAMPLE_SIZE]
+        self.misses = misses
+        self.prefixes = [key[:3] for key in self.keys[:PREFIX_SAMPLE_SIZE]]
+        self.alpha_map = datrie.AlphaMap.from_corpus(self.keys)
+
+    def new_trie(self):
+        return datrie.Trie(alpha_map=self.alpha_map)
+
+    def build_trie(self):
+        return datrie.Trie.build(
+            ((key, 1) for key in self.sorted_keys),
+            alpha_map=self.alpha_map, presorted=True
+        )
+
+
+def measure(func, setup=None, repeat=5):
+    """
+    Returns ``(best, spread)`` for ``repeat`` calls of ``func(setup())``:
+    the best time and the relative difference between the slowest and
+    the best time. The garbage collector is disabled while ``func`` runs.
+    """
+    best = worst = None
+    for x in range(repeat):
+        arg = setup() if setup is not None else None
+        gc.collect()
+        gc.disable()
+        try:
+            start = timeit.default_timer()
+            func(arg)
+            elapsed = timeit.default_timer() - start
+        finally:
+            gc.enable()
+        if best is None or elapsed < best:
+            best = elapsed
+        if worst is None or elapsed > worst:
+            worst = elapsed
+    return best, (worst / best - 1 if best else 0.0)
+
+
+def timings(corpus, group, repeat):
+    """
+    Yields ``(name, (seconds, spread), ops)`` for timing benchmarks
+    of ``group``.
+    """
+    trie = corpus.build_trie()
+    keys, sample, misses = corpus.keys, corpus.sample, corpus.misses
+
+    if group == 'insert':
+        def insert(trie):
+            for key in keys:
+                trie[key] = 1
+        yield 'insert_random', measure(insert, corpus.new_trie, repeat), len(keys)
+        yield 'build_sorted', measure(lambda arg: corpus.build_trie(),
+                                      repeat=repeat), len(keys)
+
+        def update(arg):
+            for key in sample:
+                trie[key] = 2
+        yield 'setitem_update', measure(update, repeat=repeat), len(sample)
+
+        def setdefault(arg):
+            for key in sample:
+                trie.setdefault(key, 2)
+        yield 'setdefault_hit', measure(setdefault, repeat=repeat), len(sample)
+
+    elif group == 'lookup':
+        def getitem(arg):
+            for key in sample:
+                trie[key]
+        yield 'getitem_hit', measure(getitem, repeat=repeat), len(sample)
+
+        def contains(arg):
+            for key in misses:
+                key in trie
+        yield 'contains_miss', measure(contains, repeat=repeat), len(misses)
+        yield 'get_many_hit', measure(lambda arg: trie.get_many(sample),
+                                      repeat=repeat), len(sample)
+        yield 'get_many_miss', measure(lambda arg: trie.get_many(misses),
+                                       repeat=repeat), len(misses)
+
+    elif group == 'iteration':
+        yield 'keys', measure(lambda arg: trie.keys(), repeat=repeat), len(keys)
+        yield 'items', measure(lambda arg: trie.items(), repeat=repeat), len(keys)
+
+        def iterkeys(arg):
+            for key in trie.iterkeys():
+                pass
+        yield 'iterkeys', measure(iterkeys, repeat=repeat), len(keys)
+
+    elif group == 'prefix':
+        def prefixes(arg):
+            for key in sample:
+                trie.prefixes(key)
+        yield 'prefixes', measure(prefixes, repeat=repeat), len(sample)
+
+        def longest_prefix(arg):
+            for key in misses:
+                trie.longest_prefix(key, None)
+        yield 'longest_prefix_miss', measure(longest_prefix, repeat=repeat), len(misses)
+
+        def has_keys(arg):
+            for prefix in corpus.prefixes:
+                trie.has_keys_with_prefix(prefix)
+        yield 'has_keys_with_prefix', measure(has_keys, repeat=repeat), len(corpus.prefixes)
+
+        def keys_with_prefix(arg):
+            for prefix in corpus.prefixes:
+                trie.keys(prefix)
+        yield 'keys_with_prefix', measure(keys_with_prefix, repeat=repeat), len(corpus.prefixes)
+
+    elif group == 'serialization':
+        data = trie.tobytes()
+        yield 'tobytes', measure(lambda arg: trie.tobytes(), repeat=repeat), len(keys)
+        yield 'frombytes', measure(lambda arg: datrie.Trie.frombytes(data),
+                                   repeat=repeat), len(keys)
+
+        fd, path = tempfile.mkstemp(suffix='.trie')
+        os.close(fd)
+        try:
+            yield 'save', measure(lambda arg: trie.save(path), repeat=repeat), len(keys)
+            yield 'load', measure(lambda arg: datrie.Trie.load(path),
+                                  repeat=repeat), len(keys)
+        finally:
+            os.remove(path)
+
+        pickled = pickle.dumps(trie, pickle.HIGHEST_PROTOCOL)
+        yield 'pickle_dumps', measure(
+            lambda arg: pickle.dumps(trie, pickle.HIGHEST_PROTOCOL),
+            repeat=repeat), len(keys)
+        yield 'pickle_loads', measure(lambda arg: pickle.loads(pickled),
+                                      repeat=repeat), len(keys)
+
+
+def memory(corpus):
+    """
+    Yields ``(name, unit, value)`` for memory benchmarks.
+    """
+    trie = corpus.build_trie()
+    # sys.getsizeof re-measures the key suffixes only from time to time,
+    # stats() measures them exactly
+    stats = trie.stats()
+    yield 'memory', 'bytes', stats['memory_bytes']
+    yield 'memory_per_key', 'bytes', stats['memory_bytes'] / corpus.size
+    yield 'data', 'bytes', stats['data_bytes']
+    yield 'da_cells', 'cells', stats['da_cells']
+    yield 'tail_bytes', 'bytes', stats['tail_bytes']
+
+
+def run_corpus(corpus, groups, repeat, log):
+    results = []
+
+    def add(group, name, unit, value, ops=None, spread=0.0):
+        result = {
+            'corpus': corpus.name, 'alphabet': corpus.alphabet,
+            'size': corpus.size, 'group': group, 'name': name,
+            'unit': unit, 'value': value, 'spread': spread,
+        }
+        if ops is not None:
+            result['ops'] = ops
+        results.append(result)
+        log('%-16s %-14s %-22s %14.1f %s' % (
+            corpus.name, group, name, value, unit))
+
+    for group in groups:
+        if group == 'memory':
+            for name, unit, value in memory(corpus):
+                add(group, name, unit, value)
+            continue
+        for name, (seconds, spread), ops in timings(corpus, group, repeat):
+            add(group, name, 'ns/op', seconds / ops * 1e9, ops, spread)
+    return results
+
+
+def _metadata(args):
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'sizes': args.sizes,
+        'alphabets': args.alphabets,
+        'groups': args.groups,
+        'repeat': args.repeat,
+        'seed': args.seed,
+    }
+
+
+def run(args):
+    global datrie
+    import datrie
+
+    log = (lambda msg: None) if args.quiet else (
+        lambda msg: print(msg, file=sys.stderr))
+    results = []
+    for alphabet in args.alphabets:
+        for size in args.sizes:
+            if alphabet == 'words' and size > 100000:
+                continue  # the corpus has 100k words
+            corpus = Corpus(alphabet, size, args.seed)
+            results.extend(run_corpus(corpus, args.groups, args.repeat, log))
+
+    output = {'metadata': _metadata(args), 'results': results}
+    if args.output == '-':
+        json.dump(output, sys.stdout, indent=1, sort_keys=True)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=1, sort_keys=True)
+    return 0
+
+
+def compare(args):
+    """
+    Compares results of two runs; all values are "lower is better".
+
+    A change is reported only if it exceeds both the threshold and
+    the larger spread of the repeated runs in the two files.
+    """
+    def load(path):
+        with open(path) as f:
+            data = json.load(f)
+        return dict(((r['corpus'], r['group'], r['name']), r)
+                    for r in data['results'])
+
+    old, new = load(args.old), load(args.new)
+    regressions = 0
+    print('%-16s %-14s %-22s %14s %14s %8s %7s' % (
+        'corpus', 'group', 'benchmark', 'old', 'new', 'change', 'noise'))
+
+    for key in sorted(set(old) & set(new)):
+        old_value, new_value = old[key]['value'], new[key]['value']
+        if old_value:
+            change = new_value / old_value - 1
+        else:
+            change = 0.0 if not new_value else float('inf')
+
+        # files written before the spread was recorded have none
+        noise = max(old[key].get('spread', 0.0), new[key].get('spread', 0.0))
+        limit = max(args.threshold, noise)
+        if change > limit:
+            flag = '  REGRESSION'
+            regressions += 1
+        elif change < -limit:
+            flag = '  improved'
+        else:
+            flag = ''
+        print('%-16s %-14s %-22s %14.1f %14.1f %+7.1f%% %6.1f%%%s' % (
+            key + (old_value, new_value, change * 100, noise * 100, flag)))
+
+    for path, missing in ((args.new, set(old) - set(new)),
+                          (args.old, set(new) - set(old))):
+        if missing:
+            print('\n%d benchmarks are missing in %s' % (len(missing), path))
+
+    print('\n%d regressions (threshold %.0f%%)' % (
+        regressions, args.threshold * 100))
+    return 1 if regressions else 0
+
+
+def _list(type):
+    return lambda value: [type(item) for item in value.split(',') if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='datrie benchmark suite')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='run benchmarks')
+    run_parser.add_argument(
+        '--output', '-o', default='-',
+        help='JSON file for the results (default: stdout)')
+    run_parser.add_argument(
+        '--sizes', type=_list(int), default=list(DEFAULT_SIZES),
+        help='comma-separated corpus sizes (default: %(default)s)')
+    run_parser.add_argument(
+        '--alphabets', type=_list(str), default=list(DEFAULT_ALPHABETS),
+        help='comma-separated corpora: words (the 100k words file), '
+             'ascii, cyrillic or cjk (default: %(default)s)')
+    run_parser.add_argument(
+        '--groups', type=_list(str), default=list(GROUPS),
+        help='comma-separated benchmark groups (default: %(default)s)')
+    run_parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='best of N runs; the spread of the runs is recorded '
+             'as noise for compare (default: %(default)s)')
+    run_parser.add_argument('--seed', type=int, default=42)
+    run_parser.add_argument('--quiet', '-q', action='store_true',
+                            help="don't print progress to stderr")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser(
+        'compare', help='compare two result files')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='relative change reported as a regression, unless the '
+             'runs are noisier (default: %(default)s)')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        unknown = (set(args.alphabets) - set(ALPHABETS) - set(['words'])) or (
+            set(args.groups) - set(GROUPS))
+        if unknown:
+            parser.error('unknown choices: %s' % ', '.join(sorted(unknown)))
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -18,9 +18,10 @@ cdef extern from "../libdatrie/datrie/alpha-map.h":
 
     int alpha_map_add_range (AlphaMap *alpha_map, AlphaChar begin, AlphaChar end)
     int alpha_char_strlen (AlphaChar *str)
+    int alpha_char_strcmp (AlphaChar *str1, AlphaChar *str2)
 
 
-cdef extern from "../libdatrie/datrie/trie.h":
+cdef extern from "../libdatrie/datrie/trie.h" nogil:
 
     ctypedef struct Trie:
         pass
@@ -88,6 +89,8 @@ cdef extern from "../libdatrie/datrie/trie.h":
 
     bint trie_state_is_walkable (TrieState *s, AlphaChar c)
 
+    int trie_state_walkable_chars (TrieState *s, AlphaChar chars[], int chars_nelm)
+
     bint trie_state_is_terminal(TrieState * s)
 
     bint trie_state_is_single (TrieState *s)
@@ -110,3 +113,171 @@ cdef extern from "../libdatrie/datrie/trie.h":
     AlphaChar *     trie_iterator_get_key (TrieIterator *iter)
 
     TrieData        trie_iterator_get_data (TrieIterator *iter)
+
+
+cdef extern from *:
+    """
+    /*
+     * Layouts of the private structures of libdatrie (alpha-map.c, darray.c,
+     * tail.c and trie.c); they are used to measure a trie in constant time
+     * and must be kept in sync with the bundled libdatrie. They are only
+     * used after datrie_layouts_match confirms them on a small trie.
+     */
+    typedef struct datrie_AlphaRange_ {
+        struct datrie_AlphaRange_ *next;
+        AlphaChar begin;
+        AlphaChar end;
+    } datrie_AlphaRange;
+
+    typedef struct {
+        datrie_AlphaRange *first_range;
+        AlphaChar alpha_begin;
+        AlphaChar alpha_end;
+        int alpha_map_sz;
+        TrieIndex *alpha_to_trie_map;
+        int trie_map_sz;
+        AlphaChar *trie_to_alpha_map;
+    } datrie_AlphaMapLayout;
+
+    typedef struct {
+        TrieIndex base;
+        TrieIndex check;
+    } datrie_DACell;
+
+    typedef struct {
+        TrieIndex num_cells;
+        datrie_DACell *cells;
+    } datrie_DArrayLayout;
+
+    typedef struct {
+        TrieIndex next_free;
+        TrieData data;
+        TrieChar *suffix;
+    } datrie_TailBlock;
+
+    typedef struct {
+        TrieIndex num_tails;
+        datrie_TailBlock *tails;
+        TrieIndex first_free;
+    } datrie_TailLayout;
+
+    typedef struct {
+        datrie_AlphaMapLayout *alpha_map;
+        datrie_DArrayLayout *da;
+        datrie_TailLayout *tail;
+        Bool is_dirty;
+    } datrie_TrieLayout;
+
+    static size_t datrie_alpha_map_size(const Trie *trie)
+    {
+        const datrie_AlphaMapLayout *a = ((const datrie_TrieLayout *) trie)->alpha_map;
+        const datrie_AlphaRange *r;
+        size_t size = sizeof (datrie_AlphaMapLayout)
+                      + a->alpha_map_sz * sizeof (TrieIndex)
+                      + a->trie_map_sz * sizeof (AlphaChar);
+        for (r = a->first_range; r; r = r->next)
+            size += sizeof (datrie_AlphaRange);
+        return size;
+    }
+
+    static size_t datrie_da_size(const Trie *trie)
+    {
+        const datrie_DArrayLayout *d = ((const datrie_TrieLayout *) trie)->da;
+        return sizeof (datrie_DArrayLayout) + d->num_cells * sizeof (datrie_DACell);
+    }
+
+    static size_t datrie_tail_size(const Trie *trie)
+    {
+        const datrie_TailLayout *t = ((const datrie_TrieLayout *) trie)->tail;
+        return sizeof (datrie_TailLayout) + t->num_tails * sizeof (datrie_TailBlock);
+    }
+
+    /* the size of the trie without suffixes */
+    static size_t datrie_trie_size(const Trie *trie)
+    {
+        return sizeof (datrie_TrieLayout) + datrie_alpha_map_size (trie)
+               + datrie_da_size (trie) + datrie_tail_size (trie);
+    }
+
+    static TrieIndex datrie_tail_num_blocks(const Trie *trie)
+    {
+        return ((const datrie_TrieLayout *) trie)->tail->num_tails;
+    }
+
+    /* allocated size of the suffixes; it is linear in the number of blocks */
+    static size_t datrie_tail_suffix_size(const Trie *trie)
+    {
+        const datrie_TailLayout *t = ((const datrie_TrieLayout *) trie)->tail;
+        size_t size = 0;
+        TrieIndex i;
+        for (i = 0; i < t->num_tails; i++) {
+            if (t->tails[i].suffix)
+                size += strlen ((const char *) t->tails[i].suffix) + 1;
+        }
+        return size;
+    }
+
+    static TrieIndex datrie_read_int32(const unsigned char *p)
+    {
+        return (TrieIndex) (((uint32_t) p[0] << 24) | ((uint32_t) p[1] << 16)
+                            | ((uint32_t) p[2] << 8) | p[3]);
+    }
+
+    /*
+     * Checks the layouts above against libdatrie: the alpha map ranges,
+     * double-array cells and tail blocks read through them must be the
+     * same as in the data of the trie written by trie_fwrite.
+     */
+    static int datrie_layouts_match(const Trie *trie, const unsigned char *data,
+                                    size_t size)
+    {
+        const datrie_TrieLayout *l = (const datrie_TrieLayout *) trie;
+        const datrie_AlphaRange *r;
+        size_t pos = 8, length;
+        TrieIndex i;
+
+        if ((l->is_dirty != 0) != (trie_is_dirty (trie) != 0) || size < 8)
+            return 0;
+        for (r = l->alpha_map->first_range; r; r = r->next, pos += 8) {
+            if (pos + 8 > size
+                    || (TrieIndex) r->begin != datrie_read_int32 (data + pos)
+                    || (TrieIndex) r->end != datrie_read_int32 (data + pos + 4))
+                return 0;
+        }
+        if ((size_t) datrie_read_int32 (data + 4) != (pos - 8) / 8)
+            return 0;
+
+        if (pos + 8 > size || l->da->num_cells < 1
+                || l->da->num_cells != datrie_read_int32 (data + pos + 4)
+                || (size - pos) / 8 < (size_t) l->da->num_cells)
+            return 0;
+        for (i = 0; i < l->da->num_cells; i++, pos += 8) {
+            if (l->da->cells[i].base != datrie_read_int32 (data + pos)
+                    || l->da->cells[i].check != datrie_read_int32 (data + pos + 4))
+                return 0;
+        }
+
+        if (pos + 12 > size
+                || l->tail->first_free != datrie_read_int32 (data + pos + 4)
+                || l->tail->num_tails != datrie_read_int32 (data + pos + 8))
+            return 0;
+        for (i = 0, pos += 12; i < l->tail->num_tails; i++) {
+            const datrie_TailBlock *b = l->tail->tails + i;
+            length = b->suffix ? strlen ((const char *) b->suffix) : 0;
+            if (pos + 10 + length > size
+                    || b->next_free != datrie_read_int32 (data + pos)
+                    || b->data != datrie_read_int32 (data + pos + 4)
+                    || length != (size_t) ((data[pos + 8] << 8) | data[pos + 9])
+                    || (length && memcmp (b->suffix, data + pos + 10, length)))
+                return 0;
+            pos += 10 + length;
+        }
+        return pos == size;
+    }
+    """
+    bint datrie_layouts_match(const Trie *trie, const unsigned char *data,
+                              size_t size) nogil
+    size_t datrie_trie_size(const Trie *trie) nogil
+    TrieIndex datrie_tail_num_blocks(const Trie *trie) nogil
+    size_t datrie_tail_suffix_size(const Trie *trie) nogil
+
@@ -4,17 +4,33 @@ Cython wrapper for libdatrie.
 """
 
 from cpython.version cimport PY_MAJOR_VERSION
+from cpython.unicode cimport (
+    PyUnicode_GET_LENGTH, PyUnicode_KIND, PyUnicode_DATA,
+    PyUnicode_1BYTE_KIND, PyUnicode_2BYTE_KIND, PyUnicode_4BYTE_KIND,
+    PyUnicode_FromKindAndData,
+)
 from cython.operator import dereference as deref
-from libc.stdlib cimport malloc, free
+from libc.math cimport INFINITY
+from libc.stdint cimport int16_t, int32_t, uint8_t, uint16_t, uint32_t
+from libc.stdlib cimport malloc, calloc, realloc, free
 from libc cimport stdio
 from libc cimport string
 cimport stdio_ext
 cimport cdatrie
+cimport rwlock
 
+import array
+import collections
+import importlib
+import io
 import itertools
+import operator
+import os
+import struct
 import warnings
 import sys
 import tempfile
+import time
 
 try:
     from collections.abc import MutableMapping
@@ -29,6 +45,53 @@ except ImportError:
 class DatrieError(Exception):
     pass
 
+cdef enum:
+    # keys shorter than this are encoded without heap allocation
+    KEY_BUFFER_SIZE = 64
+    # number of keys encoded and looked up at once by get_many/contains_many
+    RETRIEVE_BATCH_SIZE = 256
+    # size of (next free, data, suffix length) header of tail blocks in files
+    TAIL_BLOCK_HEADER_SIZE = 10
+    # size of chunks tries are written and read in; a tail block
+    # (with a suffix of up to 32767 bytes) must fit into a chunk
+    IO_CHUNK_SIZE = 65536
+
+cdef enum:
+    # BaseTrie._store_if_absent results
+    KEY_FOUND = 0
+    KEY_ADDED = 1
+    KEY_REJECTED = 2
+
+cdef enum:
+    # glob pattern token kinds
+    PATTERN_LITERAL = 0
+    PATTERN_ANY = 1
+    PATTERN_STAR = 2
+    PATTERN_CLASS = 3
+    PATTERN_NEGATED_CLASS = 4
+
+cdef enum:
+    # operations counted by the instrumentation
+    OP_GET = 0
+    OP_SET = 1
+    OP_DELETE = 2
+    OP_PREFIX = 3
+    OP_ITER = 4
+    OPERATION_COUNT = 5
+
+OPERATION_NAMES = ('get', 'set', 'delete', 'prefix', 'iter')
+
+cdef struct OperationCounters:
+    unsigned long long calls
+    unsigned long long hits
+    unsigned long long timed_calls
+    double time
+
+# TypedTrie values header: type code and number of values
+ARRAY_HEADER_FORMAT = '<cQ'
+
+COMPRESSION_MODULES = ('gzip', 'bz2', 'lzma')
+
 RAISE_KEY_ERROR = object()
 RERAISE_KEY_ERROR = object()
 DELETED_OBJECT = object()
@@ -43,6 +106,30 @@ cdef class BaseTrie:
 
     cdef AlphaMap alpha_map
     cdef cdatrie.Trie *_c_trie
+    cdef bint _frozen
+    cdef bint _concurrent
+    cdef bint _strict
+    cdef rwlock.datrie_rwlock_t _lock
+    cdef unsigned long _version  # incremented when keys are added or removed
+    cdef Py_ssize_t _len  # number of keys, -1 if it is not known yet
+    cdef object _top_k_index
+    cdef object _key_tree
+    cdef dict _structure_stats  # computed by stats() for _structure_version
+    cdef unsigned long _structure_version
+    cdef Py_ssize_t _suffix_size  # measured for _suffix_version, -1 if not yet
+    cdef Py_ssize_t _suffix_blocks  # tail blocks when _suffix_size was measured
+    cdef unsigned long _suffix_version
+    cdef bint _instrumented
+    cdef unsigned long _timing_interval
+    cdef unsigned long _calls_until_timing
+    cdef OperationCounters _counters[OPERATION_COUNT]
+    cdef unsigned long long _walk_steps
+    cdef unsigned long long _encoded_bytes
+
+    def __cinit__(self, *args, **kwargs):
+        rwlock.datrie_rwlock_init(&self._lock)
+        self._len = -1
+        self._suffix_size = -1
 
     def __init__(self, alphabet=None, ranges=None, AlphaMap alpha_map=None, _create=True):
         """
@@ -69,10 +156,44 @@ cdef class BaseTrie:
         self._c_trie = cdatrie.trie_new(alpha_map._c_alpha_map)
         if self._c_trie is NULL:
             raise MemoryError()
+        self._len = 0
 
     def __dealloc__(self):
         if self._c_trie is not NULL:
             cdatrie.trie_free(self._c_trie)
+        rwlock.datrie_rwlock_destroy(&self._lock)
+
+    @classmethod
+    def build(cls, items, alphabet=None, ranges=None, AlphaMap alpha_map=None,
+              presorted=False, **kwargs):
+        """
+        Creates a new trie from an iterable of ``(key, value)`` pairs.
+
+        This is a convenience constructor: keys are inserted one by one,
+        but in sorted order, which is much faster than random order.
+        ``items`` are sorted by key in memory first unless ``presorted``
+        is True; presorted items are consumed as they are inserted when
+        the alphabet is given. If the same key occurs several times
+        the last value wins.
+
+        If neither ``alphabet`` nor ``ranges`` nor ``alpha_map``
+        is given, the alphabet is made of all characters used in keys.
+        Extra keyword arguments are passed to the trie constructor.
+        """
+        if not presorted:
+            items = sorted(items, key=operator.itemgetter(0))
+        elif alphabet is None and ranges is None and alpha_map is None:
+            items = list(items)
+
+        if alphabet is None and ranges is None and alpha_map is None:
+            alphabet = set()
+            for key, value in items:
+                alphabet.update(key)
+
+        cdef BaseTrie trie = cls(alphabet, ranges, alpha_map, **kwargs)
+        for key, value in items:
+            trie[key] = value
+        return trie
 
     def update(self, other=(), **kwargs):
         if PY_MAJOR_VERSION == 2:
@@ -90,13 +211,381 @@ cdef class BaseTrie:
             self[key] = kwargs[key]
 
     def clear(self):
+        self._check_writable()
         cdef AlphaMap alpha_map = self.alpha_map.copy()
         _c_trie = cdatrie.trie_new(alpha_map._c_alpha_map)
         if _c_trie is NULL:
             raise MemoryError()
 
+        self._lock_write()
         cdatrie.trie_free(self._c_trie)
         self._c_trie = _c_trie
+        self._version += 1
+        self._len = 0
+        self._unlock_write()
+
+    property frozen:
+        """
+        True if the trie was loaded frozen (see :meth:`load`).
+        """
+        def __get__(self):
+            return self._frozen
+
+    property concurrent:
+        """
+        Concurrent mode flag (False by default).
+
+        In concurrent mode ``__getitem__``, ``get`` and ``__contains__``
+        release the GIL while looking up the key, so lookups from
+        several threads can run in parallel. Tries are protected by
+        an internal reader-writer lock in both modes; concurrent mode
+        only makes single-key lookups more expensive in
+        single-threaded code.
+        """
+        def __get__(self):
+            return self._concurrent
+
+        def __set__(self, bint value):
+            self._concurrent = value
+
+    property strict:
+        """
+        Strict mode flag (False by default).
+
+        Keys which can't be stored (because they contain characters
+        which are not in the alphabet) are silently ignored unless
+        the trie is in strict mode; in strict mode storing such keys
+        raises ``DatrieError``. See :meth:`extend_alphabet`.
+        """
+        def __get__(self):
+            return self._strict
+
+        def __set__(self, bint value):
+            self._strict = value
+
+    property instrumented:
+        """
+        Instrumentation flag (False by default).
+
+        When it is set, calls of lookups, writes, deletions, prefix walks
+        and iteration are counted (see :meth:`counters`); counting
+        costs a few nanoseconds per call. Disabling the instrumentation
+        keeps the collected counters.
+        """
+        def __get__(self):
+            return self._instrumented
+
+        def __set__(self, bint value):
+            self._instrumented = value
+
+    property timing_interval:
+        """
+        Every ``timing_interval``-th instrumented call is timed
+        (0, the default, disables timing).
+        """
+        def __get__(self):
+            return self._timing_interval
+
+        def __set__(self, unsigned long value):
+            self._timing_interval = value
+            self._calls_until_timing = value
+
+    def counters(self, reset=False):
+        """
+        Returns a snapshot of the instrumentation counters: a dict with
+        ``<operation>_calls``, ``<operation>_hits``, ``<operation>_misses``,
+        ``<operation>_timed_calls`` and ``<operation>_time`` (total time
+        of timed calls in seconds) for the ``get``, ``set``, ``delete``,
+        ``prefix`` and ``iter`` operations, and ``walk_steps`` (characters
+        walked in the trie) and ``encoded_bytes`` (size of keys encoded
+        for libdatrie).
+
+        ``get`` hits are found keys, ``set`` hits are updated keys (misses
+        are added keys), ``delete`` hits are removed keys, ``prefix`` hits
+        are walks which found some keys and ``iter`` hits are iterations
+        over an existing prefix. Lookups and writes are done by libdatrie,
+        so the whole key length is counted as walk steps for them.
+        Lazy iterators are counted when they are created; their time
+        doesn't include consuming the iterator.
+
+        If ``reset`` is True, the counters are set to zero.
+        """
+        cdef dict res = {}
+        cdef OperationCounters* counters
+        cdef int op
+        for op in range(OPERATION_COUNT):
+            counters = &self._counters[op]
+            name = OPERATION_NAMES[op]
+            res[name + '_calls'] = counters.calls
+            res[name + '_hits'] = counters.hits
+            res[name + '_misses'] = counters.calls - counters.hits
+            res[name + '_timed_calls'] = counters.timed_calls
+            res[name + '_time'] = counters.time
+        res['walk_steps'] = self._walk_steps
+        res['encoded_bytes'] = self._encoded_bytes
+
+        if reset:
+            string.memset(self._counters, 0, sizeof(self._counters))
+            self._walk_steps = 0
+            self._encoded_bytes = 0
+        return res
+
+    cdef inline double _start_timer(self):
+        """
+        Returns the start time if the instrumented call should be timed,
+        0 otherwise.
+        """
+        if not self._instrumented or not self._timing_interval:
+            return 0
+        if self._calls_until_timing > 1:
+            self._calls_until_timing -= 1
+            return 0
+        self._calls_until_timing = self._timing_interval
+        return time.perf_counter()
+
+    cdef inline int _record(self, int op, Py_ssize_t calls, Py_ssize_t hits,
+                            Py_ssize_t steps, Py_ssize_t encoded_length,
+                            double start) except -1:
+        """
+        Counts ``calls`` of ``op``; ``encoded_length`` is the total
+        length of keys encoded for libdatrie.
+        """
+        if not self._instrumented:
+            return 0
+        cdef OperationCounters* counters = &self._counters[op]
+        counters.calls += calls
+        counters.hits += hits
+        self._walk_steps += steps
+        if encoded_length:
+            # keys are encoded with a terminating zero
+            self._encoded_bytes += ((encoded_length + calls)
+                                    * sizeof(cdatrie.AlphaChar))
+        if start:
+            counters.timed_calls += calls
+            counters.time += time.perf_counter() - start
+        return 0
+
+    def stats(self):
+        """
+        Returns a dict with statistics of this trie:
+
+        - ``keys``: the number of keys;
+        - ``alphabet_size`` and ``alpha_map_ranges``: the number
+          of characters in the alphabet and of their ranges;
+        - ``da_cells`` and ``da_free_cells``: the number of
+          double-array cells and of unused ones;
+        - ``tail_blocks``, ``tail_free_blocks`` and ``tail_bytes``:
+          the number of tail blocks (key suffixes), of unused ones
+          and the total length of suffixes;
+        - ``max_depth`` and ``avg_depth``: the maximal and the average
+          key length;
+        - ``values`` and ``values_bytes``: the number of slots in the
+          value store and its size (0 for ``BaseTrie``);
+        - ``data_bytes``: the size of the trie data written by
+          :meth:`write` (without values);
+        - ``memory_bytes``: the size of the trie in memory, including
+          the value store (but not the values) and the indexes built by
+          :meth:`count` and :meth:`top_k`; the same estimate as
+          ``sys.getsizeof(trie)`` but with suffixes measured exactly.
+
+        The trie is measured by serializing it and walking its keys;
+        the results are cached until keys are added or removed.
+        """
+        cdef dict stats = dict(self._get_structure_stats())
+        stats['values'], stats['values_bytes'] = self._values_size()
+        stats['memory_bytes'] = (object.__sizeof__(self)
+                                 + self._memory_size(True))
+        return stats
+
+    def __sizeof__(self):
+        """
+        Returns an estimate of the memory size of the trie (allocator
+        overhead is not counted) in constant time (amortized): the sizes
+        of libdatrie structures are read from them, but the total length
+        of suffixes is only measured again after as many keys are added
+        or removed as there were suffixes; in between it is estimated
+        from the number of tail blocks.
+
+        libdatrie structures are read through copies of their private
+        layouts. If a check of the copies against libdatrie fails (a
+        warning is issued), the size of the trie data written by
+        :meth:`write` is used instead, which takes linear time.
+        """
+        return object.__sizeof__(self) + self._memory_size(False)
+
+    cdef Py_ssize_t _memory_size(self, bint exact) except -1:
+        """
+        Returns the size of libdatrie structures, of the value store
+        and of the indexes (without the object itself).
+        """
+        cdef Py_ssize_t blocks, size = 0
+        if self._c_trie is not NULL and not _check_layouts():
+            size = _write_trie(self._c_trie, None)
+        elif self._c_trie is not NULL:
+            blocks = cdatrie.datrie_tail_num_blocks(self._c_trie)
+            if (exact or self._suffix_size < 0
+                    or self._version - self._suffix_version
+                    > <unsigned long> self._suffix_blocks):
+                self._suffix_size = cdatrie.datrie_tail_suffix_size(
+                    self._c_trie)
+                self._suffix_blocks = blocks
+                self._suffix_version = self._version
+            if blocks == self._suffix_blocks or not self._suffix_blocks:
+                size = self._suffix_size
+            else:
+                size = <Py_ssize_t> (<double> self._suffix_size * blocks
+                                     / self._suffix_blocks)
+            size += cdatrie.datrie_trie_size(self._c_trie)
+        size += self._values_size()[1]
+        if self._key_tree is not None:
+            size += (<_KeyTree> self._key_tree)._memory_size()
+        if self._top_k_index is not None:
+            size += (<_KeyTree> self._top_k_index)._memory_size()
+        return size
+
+    cdef dict _get_structure_stats(self):
+        cdef dict stats = self._structure_stats
+        if stats is not None and self._structure_version == self._version:
+            return stats
+
+        cdef bytes data = BaseTrie.tobytes(self)
+        cdef BaseIterator iter = BaseIterator(BaseState(self))
+        cdef cdatrie.AlphaChar* key
+        cdef Py_ssize_t depth, max_depth = 0, total_depth = 0, count = 0
+
+        stats = _trie_data_stats(data)
+        while iter.next():
+            key = cdatrie.trie_iterator_get_key(iter._iter)
+            if key is NULL:
+                raise MemoryError()
+            depth = cdatrie.alpha_char_strlen(key)
+            free(key)
+            max_depth = max(depth, max_depth)
+            total_depth += depth
+            count += 1
+
+        stats['keys'] = count
+        stats['max_depth'] = max_depth
+        stats['avg_depth'] = <double> total_depth / count if count else 0.0
+        stats['data_bytes'] = len(data)
+        self._structure_stats = stats
+        self._structure_version = self._version
+        return stats
+
+    cdef tuple _values_size(self):
+        """
+        Returns the number of slots in the value store and its size.
+        """
+        return 0, 0
+
+    def extend_alphabet(self, alphabet=None, ranges=None):
+        """
+        Adds characters from ``alphabet`` and ``ranges`` (see the
+        constructor) to the alphabet of this trie. The trie is rebuilt
+        with the new alphabet; keys and values are kept.
+        """
+        self._check_writable()
+        cdef AlphaMap alpha_map = self.alpha_map.copy()
+        if ranges is not None:
+            for range in ranges:
+                alpha_map.add_range(*range)
+        if alphabet is not None:
+            alpha_map.add_alphabet(alphabet)
+        self._rebuild(alpha_map)
+
+    def repack(self):
+        """
+        Rebuilds the trie from its keys (inserted in key order), so that
+        cells and tail blocks left free by deleted keys are reclaimed.
+        Values are kept.
+
+        Returns sizes of the trie data (as written by :meth:`write`,
+        without values of ``Trie`` and ``TypedTrie``) before and after
+        repacking as a ``(before, after)`` tuple; the sizes are counted
+        while the trie is written to a stream which discards the data.
+        """
+        self._check_writable()
+        cdef Py_ssize_t before = _write_trie(self._c_trie, None)
+        self._rebuild(self.alpha_map)
+        return before, _write_trie(self._c_trie, None)
+
+    cdef int _rebuild(self, AlphaMap alpha_map) except -1:
+        """
+        Replaces the libdatrie trie with a new one which has the same
+        keys and data and uses ``alpha_map``.
+        """
+        cdef cdatrie.Trie* c_trie = cdatrie.trie_new(alpha_map._c_alpha_map)
+        if c_trie is NULL:
+            raise MemoryError()
+        cdef BaseIterator iter = BaseIterator(BaseState(self))
+        cdef cdatrie.AlphaChar* key
+        cdef bint stored
+        try:
+            while iter.next():
+                key = cdatrie.trie_iterator_get_key(iter._iter)
+                if key is NULL:
+                    raise MemoryError()
+                stored = cdatrie.trie_store(c_trie, key, iter.data())
+                free(key)
+                if not stored:
+                    raise MemoryError()
+        except:
+            cdatrie.trie_free(c_trie)
+            raise
+
+        self._lock_write()
+        cdatrie.trie_free(self._c_trie)
+        self._c_trie = c_trie
+        self.alpha_map = alpha_map
+        self._version += 1
+        self._unlock_write()
+        return 0
+
+    cdef int _reject_key(self, unicode key) except -1:
+        if self._strict:
+            raise DatrieError(
+                "Can't store key %r: it contains characters which are "
+                "not in the alphabet" % key)
+        return 0
+
+    cdef int _check_writable(self) except -1:
+        if self._frozen:
+            raise DatrieError("Can't modify a frozen trie")
+        return 0
+
+    cdef inline void _lock_write(self):
+        # Writers keep the GIL while modifying the trie; the GIL is only
+        # released while waiting for readers which don't hold it.
+        if not rwlock.datrie_rwlock_trywrlock(&self._lock):
+            with nogil:
+                rwlock.datrie_rwlock_wrlock(&self._lock)
+
+    cdef inline void _unlock_write(self):
+        rwlock.datrie_rwlock_wrunlock(&self._lock)
+
+    cdef inline void _lock_read(self):
+        # For readers which keep the GIL. Writers hold the GIL while
+        # modifying the trie, so such readers only need the lock where
+        # the GIL is disabled. They release the GIL (if any) while
+        # waiting for a writer, so that the writer can finish.
+        if (rwlock.DATRIE_GIL_DISABLED
+                and not rwlock.datrie_rwlock_tryrdlock(&self._lock)):
+            with nogil:
+                rwlock.datrie_rwlock_rdlock(&self._lock)
+
+    cdef inline void _unlock_read(self):
+        if rwlock.DATRIE_GIL_DISABLED:
+            rwlock.datrie_rwlock_rdunlock(&self._lock)
+
+    cdef inline void _key_added(self):
+        self._version += 1
+        if self._len >= 0:
+            self._len += 1
+
+    cdef inline void _key_removed(self):
+        self._version += 1
+        if self._len >= 0:
+            self._len -= 1
 
     cpdef bint is_dirty(self):
         """
@@ -105,74 +594,131 @@ cdef class BaseTrie:
         """
         return cdatrie.trie_is_dirty(self._c_trie)
 
-    def save(self, path):
+    def save(self, path, compression=None, **kwargs):
         """
-        Saves this trie.
+        Saves this trie. Keyword arguments are passed to :meth:`write`.
+
+        ``compression`` is one of ``'gzip'``, ``'bz2'`` or ``'lzma'``
+        to compress the file, or None.
         """
-        with open(path, "wb", 0) as f:
-            self.write(f)
+        with _open_file(path, "wb", compression) as f:
+            self.write(f, **kwargs)
 
-    def write(self, f):
+    def write(self, f, repack=False):
         """
-        Writes a trie to a file. File-like objects without real
-        file descriptors are not supported.
+        Writes a trie to a file-like object.
+
+        If ``repack`` is True, :meth:`repack` is called first.
         """
-        f.flush()
+        if repack:
+            self.repack()
+        _write_trie(self._c_trie, f.write)
 
-        cdef stdio.FILE* f_ptr = stdio_ext.fdopen(f.fileno(), "w")
-        if f_ptr == NULL:
-            raise IOError("Can't open file descriptor")
+    @classmethod
+    def load(cls, path, frozen=False, compression=None):
+        """
+        Loads a trie from file.
 
-        cdef int res = cdatrie.trie_fwrite(self._c_trie, f_ptr)
-        if res == -1:
-            raise IOError("Can't write to file")
+        If ``frozen`` is True, the trie can't be modified: methods
+        that would change it raise :class:`DatrieError`. This is only
+        a guard against accidental changes; the trie is read into memory
+        the same way, not mapped from the file.
 
-        stdio.fflush(f_ptr)
+        ``compression`` must match the value passed to :meth:`save`.
+        """
+        with _open_file(path, "rb", compression) as f:
+            return cls.read(f, frozen)
 
     @classmethod
-    def load(cls, path):
+    def read(cls, f, frozen=False):
         """
-        Loads a trie from file.
+        Creates a new Trie by reading it from a file-like object.
+        Only the trie data is read, so the file may contain
+        other data after it.
+
+        See :meth:`load` for ``frozen`` argument description.
+
+        # XXX: does it work properly in subclasses?
+        """
+        cdef BaseTrie trie = cls(_create=False)
+        cdef _CFile stream = _CFile(f, False)
+        try:
+            trie._read_from(stream)
+        finally:
+            stream.close()
+        trie._frozen = frozen
+        return trie
+
+    cdef int _read_from(self, _CFile stream) except -1:
+        """
+        Reads the trie from ``stream`` (subclasses read their values too).
+        """
+        return _read_trie(self, stream)
+
+    def tobytes(self):
         """
-        with open(path, "rb", 0) as f:
-            return cls.read(f)
+        Returns this trie serialized to bytes (the same data
+        :meth:`write` writes to a file).
+        """
+        cdef list chunks = []
+        _write_trie(self._c_trie, chunks.append)
+        return b''.join(chunks)
 
     @classmethod
-    def read(cls, f):
+    def frombytes(cls, data, frozen=False):
         """
-        Creates a new Trie by reading it from file.
-        File-like objects without real file descriptors are not supported.
+        Creates a new trie from ``data`` returned by :meth:`tobytes`
+        (``bytes`` or any other object supporting the buffer protocol).
 
-        # XXX: does it work properly in subclasses?
+        See :meth:`load` for ``frozen`` argument description.
         """
         cdef BaseTrie trie = cls(_create=False)
-        trie._c_trie = _load_from_file(f)
+        trie._load_bytes(data)
+        trie._frozen = frozen
         return trie
 
+    cdef int _load_bytes(self, data) except -1:
+        """
+        Loads the trie from ``data`` returned by :meth:`tobytes`.
+        """
+        cdef _CFile stream = _CFile(io.BytesIO(data), False)
+        try:
+            self._read_from(stream)
+        finally:
+            stream.close()
+        return 0
+
     def __reduce__(self):
-        with tempfile.NamedTemporaryFile() as f:
-            self.write(f)
-            f.seek(0)
-            state = f.read()
-            return BaseTrie, (None, None, None, False), state
+        return BaseTrie, (None, None, None, False), (self.tobytes(), len(self))
 
-    def __setstate__(self, bytes state):
+    def __setstate__(self, state):
         assert self._c_trie is NULL
-        with tempfile.NamedTemporaryFile() as f:
-            f.write(state)
-            f.flush()
-            f.seek(0)
-            self._c_trie = _load_from_file(f)
+        state, self._len = _unpack_state(state)
+        self._load_bytes(state)
 
     def __setitem__(self, unicode key, cdatrie.TrieData value):
         self._setitem(key, value)
 
-    cdef void _setitem(self, unicode key, cdatrie.TrieData value):
-        cdef cdatrie.AlphaChar* c_key = new_alpha_char_from_unicode(key)
+    cdef void _setitem(self, unicode key, cdatrie.TrieData value) except *:
+        self._check_writable()
+        cdef double start = self._start_timer()
+        cdef cdatrie.AlphaChar buf[KEY_BUFFER_SIZE]
+        cdef cdatrie.AlphaChar* c_key = encode_key(key, buf)
+        cdef bint updated = False
+        self._lock_write()
         try:
-            cdatrie.trie_store(self._c_trie, c_key, value)
+            if cdatrie.trie_store_if_absent(self._c_trie, c_key, value):
+                self._key_added()
+            elif cdatrie.trie_store(self._c_trie, c_key, value):
+                updated = True
+            else:
+                self._reject_key(key)
         finally:
-            free(c_key)
+            self._unlock_write()
+            free_key(c_key, buf)
+        if updated:
+            self._value_updated(key, value)
+        self._record(OP_SET, 1, updated, len(key), len(key), start)
 
     def __getitem__(self, unicode key):
         return self._getitem(key)
@@ -183,25 +729,152 @@ cdef class BaseTrie:
         except KeyError:
             return default
 
-    cdef cdatrie.TrieData _getitem(self, unicode key) except -1:
+    cdef cdatrie.TrieData _getitem(self, unicode key) except? -1:
         cdef cdatrie.TrieData data
-        cdef cdatrie.AlphaChar* c_key = new_alpha_char_from_unicode(key)
+        if not self._lookup(key, &data):
+            raise KeyError(key)
+        return data
+
+    cdef bint _lookup(self, unicode key, cdatrie.TrieData* data) except -1:
+        """
+        :meth:`_retrieve` counted by the instrumentation.
+        """
+        if not self._instrumented:
+            return self._retrieve(key, data)
+        cdef double start = self._start_timer()
+        cdef bint found = self._retrieve(key, data)
+        self._record(OP_GET, 1, found, len(key), len(key), start)
+        return found
+
+    cdef bint _retrieve(self, unicode key, cdatrie.TrieData* data) except -1:
+        """
+        Puts the value for ``key`` to ``data`` (if it is not NULL).
+        Returns boolean value indicating whether the key exists.
+        """
+        cdef cdatrie.AlphaChar buf[KEY_BUFFER_SIZE]
+        cdef cdatrie.AlphaChar* c_key = encode_key(key, buf)
+        cdef bint found
 
         try:
-            found = cdatrie.trie_retrieve(self._c_trie, c_key, &data)
+            if self._concurrent:
+                with nogil:
+                    rwlock.datrie_rwlock_rdlock(&self._lock)
+                    found = cdatrie.trie_retrieve(self._c_trie, c_key, data)
+                    rwlock.datrie_rwlock_rdunlock(&self._lock)
+            else:
+                found = cdatrie.trie_retrieve(self._c_trie, c_key, data)
         finally:
-            free(c_key)
+            free_key(c_key, buf)
 
-        if not found:
-            raise KeyError(key)
-        return data
+        return found
 
     def __contains__(self, unicode key):
-        cdef cdatrie.AlphaChar* c_key = new_alpha_char_from_unicode(key)
+        return self._lookup(key, NULL)
+
+    def get_many(self, keys, default=None):
+        """
+        Returns a list with values for all ``keys``; ``default`` is used
+        for keys which are not in the trie.
+
+        All keys are encoded into a single buffer and looked up with
+        the GIL released, so this is much faster than calling
+        ``trie.get`` in a loop.
+        """
+        cdef list keys_list = list(keys)
+        cdef Py_ssize_t i, count = len(keys_list)
+        cdef list res = []
+        cdef cdatrie.TrieData* data = <cdatrie.TrieData*> malloc(
+            max(count, 1) * sizeof(cdatrie.TrieData))
+        cdef char* found = <char*> malloc(max(count, 1) * sizeof(char))
+
+        try:
+            if data is NULL or found is NULL:
+                raise MemoryError()
+
+            self._retrieve_many(keys_list, data, found)
+            for i in range(count):
+                if found[i]:
+                    res.append(self._index_to_value(data[i]))
+                else:
+                    res.append(default)
+            return res
+        finally:
+            free(data)
+            free(found)
+
+    def contains_many(self, keys):
+        """
+        Returns a list of booleans indicating whether each of ``keys``
+        is in the trie. See :meth:`get_many`.
+        """
+        cdef list keys_list = list(keys)
+        cdef Py_ssize_t i, count = len(keys_list)
+        cdef char* found = <char*> malloc(max(count, 1) * sizeof(char))
+
+        try:
+            if found is NULL:
+                raise MemoryError()
+
+            self._retrieve_many(keys_list, NULL, found)
+            return [<bint> found[i] for i in range(count)]
+        finally:
+            free(found)
+
+    cdef int _retrieve_many(self, list keys, cdatrie.TrieData* data,
+                            char* found) except -1:
+        """
+        Looks up all ``keys`` with the GIL released. ``data`` (if not NULL)
+        and ``found`` must have room for ``len(keys)`` items.
+
+        Keys are processed in batches so that the encoded keys
+        stay in CPU cache.
+        """
+        cdef Py_ssize_t i, start, stop, count = len(keys)
+        cdef Py_ssize_t size, capacity = 0, encoded_length = 0
+        cdef Py_ssize_t offsets[RETRIEVE_BATCH_SIZE]
+        cdef cdatrie.AlphaChar* c_keys = NULL
+        cdef void* tmp
+        cdef unicode key
+        cdef double start_time = self._start_timer()
+
         try:
-            return cdatrie.trie_retrieve(self._c_trie, c_key, NULL)
+            for start in range(0, count, RETRIEVE_BATCH_SIZE):
+                stop = min(start + RETRIEVE_BATCH_SIZE, count)
+
+                size = 0
+                for i in range(start, stop):
+                    key = keys[i]
+                    size += len(key) + 1
+                if size > capacity:
+                    tmp = realloc(c_keys, size * sizeof(cdatrie.AlphaChar))
+                    if tmp is NULL:
+                        raise MemoryError()
+                    c_keys = <cdatrie.AlphaChar*> tmp
+                    capacity = size
+
+                size = 0
+                for i in range(start, stop):
+                    offsets[i - start] = size
+                    size += fill_alpha_char_from_unicode(keys[i], c_keys + size) + 1
+
+                with nogil:
+                    rwlock.datrie_rwlock_rdlock(&self._lock)
+                    for i in range(start, stop):
+                        if data is NULL:
+                            found[i] = cdatrie.trie_retrieve(
+                                self._c_trie, c_keys + offsets[i - start], NULL)
+                        else:
+                            found[i] = cdatrie.trie_retrieve(
+                                self._c_trie, c_keys + offsets[i - start], &data[i])
+                    rwlock.datrie_rwlock_rdunlock(&self._lock)
+                encoded_length += size - (stop - start)
         finally:
-            free(c_key)
+            free(c_keys)
+
+        if self._instrumented:
+            self._record(OP_GET, count, _count_found(found, count),
+                         encoded_length, encoded_length, start_time)
+        return 0
 
     def __delitem__(self, unicode key):
         self._delitem(key)
@@ -209,7 +882,7 @@ cdef class BaseTrie:
     def pop(self, unicode key, default=None):
         try:
             value = self[key]
-            self._delitem(key)
+            del self[key]
             return value
         except KeyError:
             return default
@@ -219,27 +892,40 @@ cdef class BaseTrie:
         Deletes an entry for the given key from the trie. Returns
         boolean value indicating whether the key exists and is removed.
         """
-        cdef cdatrie.AlphaChar* c_key = new_alpha_char_from_unicode(key)
+        self._check_writable()
+        cdef cdatrie.AlphaChar buf[KEY_BUFFER_SIZE]
+        cdef cdatrie.AlphaChar* c_key = encode_key(key, buf)
+        cdef double start = self._start_timer()
+        self._lock_write()
         try:
             found = cdatrie.trie_delete(self._c_trie, c_key)
+            if found:
+                self._key_removed()
         finally:
-            free(c_key)
+            self._unlock_write()
+            free_key(c_key, buf)
 
+        self._record(OP_DELETE, 1, found, len(key), len(key), start)
         if not found:
             raise KeyError(key)
 
     @staticmethod
     cdef int len_enumerator(cdatrie.AlphaChar *key, cdatrie.TrieData key_data,
-                            void *counter_ptr):
+                            void *counter_ptr) nogil:
         (<int *>counter_ptr)[0] += 1
         return True
 
     def __len__(self):
+        # The number of keys is maintained on insertion and deletion.
+        # It is only unknown for tries loaded from files, so the keys
+        # are counted once after loading.
         cdef int counter = 0
-        cdatrie.trie_enumerate(self._c_trie,
-                               <cdatrie.TrieEnumFunc>(self.len_enumerator),
-                               &counter)
-        return counter
+        if self._len < 0:
+            cdatrie.trie_enumerate(self._c_trie,
+                                   <cdatrie.TrieEnumFunc>(self.len_enumerator),
+                                   &counter)
+            self._len = counter
+        return self._len
 
     def __richcmp__(self, other, int op):
         if op == 2:    # ==
@@ -248,34 +934,120 @@ cdef class BaseTrie:
             elif not isinstance(other, BaseTrie):
                 return False
 
-            for key in self:
-                if self[key] != other[key]:
-                    return False
-
-            # XXX this can be written more efficiently via explicit iterators.
-            return len(self) == len(other)
+            return len(self) == len(other) and self._equals(other)
         elif op == 3:  # !=
             return not (self == other)
 
         raise TypeError("unorderable types: {0} and {1}".format(
             self.__class__, other.__class__))
 
+    cdef bint _equals(self, BaseTrie other) except -1:
+        """
+        Compares keys and values of two tries of the same size
+        in a single pass over both tries.
+        """
+        cdef BaseIterator iter = BaseIterator(BaseState(self))
+        cdef BaseIterator other_iter = BaseIterator(BaseState(other))
+        while iter.next():
+            if not other_iter.next():
+                return False
+            if _compare_iterator_keys(iter, other_iter) != 0:
+                return False
+            if (self._index_to_value(iter.data()) !=
+                    other._index_to_value(other_iter.data())):
+                return False
+        return True
+
+    def diff(self, BaseTrie other):
+        """
+        Compares this trie with ``other`` in a single pass over both tries.
+        Yields ``(status, key, value, other_value)`` tuples in key order,
+        where ``status`` is:
+
+          - ``'removed'`` if the key is only in this trie
+            (``other_value`` is None),
+          - ``'added'`` if the key is only in ``other`` (``value`` is None),
+          - ``'changed'`` if the values differ.
+        """
+        cdef BaseIterator iter = BaseIterator(BaseState(self))
+        cdef BaseIterator other_iter = BaseIterator(BaseState(other))
+        cdef bint has_key = iter.next()
+        cdef bint has_other_key = other_iter.next()
+        cdef int cmp
+
+        while has_key or has_other_key:
+            if not has_key:
+                cmp = 1
+            elif not has_other_key:
+                cmp = -1
+            else:
+                cmp = _compare_iterator_keys(iter, other_iter)
+
+            if cmp > 0:
+                yield ('added', other_iter.key(), None,
+                       other._index_to_value(other_iter.data()))
+                has_other_key = other_iter.next()
+            elif cmp < 0:
+                yield ('removed', iter.key(),
+                       self._index_to_value(iter.data()), None)
+                has_key = iter.next()
+            else:
+                value = self._index_to_value(iter.data())
+                other_value = other._index_to_value(other_iter.data())
+                if value != other_value:
+                    yield 'changed', iter.key(), value, other_value
+                has_key = iter.next()
+                has_other_key = other_iter.next()
+
     def setdefault(self, unicode key, cdatrie.TrieData value):
         return self._setdefault(key, value)
 
-    cdef cdatrie.TrieData _setdefault(self, unicode key, cdatrie.TrieData value):
-        cdef cdatrie.AlphaChar* c_key = new_alpha_char_from_unicode(key)
+    cdef cdatrie.TrieData _setdefault(self, unicode key, cdatrie.TrieData value) except? -1:
         cdef cdatrie.TrieData data
+        if self._store_if_absent(key, value, &data,
+                                 self._start_timer()) == KEY_FOUND:
+            return data
+        return value
+
+    cdef int _store_if_absent(self, unicode key, cdatrie.TrieData value,
+                              cdatrie.TrieData* data, double start) except -1:
+        """
+        Stores ``value`` for ``key`` if the key is not in the trie.
+        Returns KEY_ADDED if the key is added, KEY_FOUND if it is
+        already in the trie (its value is put to ``data``) or
+        KEY_REJECTED if it can't be stored (e.g. it contains
+        characters which are not in the alphabet).
+
+        The call is counted as a write by the instrumentation;
+        ``start`` is the result of ``_start_timer()`` called by the caller.
+        """
+        cdef cdatrie.AlphaChar buf[KEY_BUFFER_SIZE]
+        cdef cdatrie.AlphaChar* c_key = encode_key(key, buf)
+        cdef int res = KEY_REJECTED
 
         try:
-            found = cdatrie.trie_retrieve(self._c_trie, c_key, &data)
-            if found:
-                return data
-            else:
-                cdatrie.trie_store(self._c_trie, c_key, value)
-                return value
+            if cdatrie.trie_retrieve(self._c_trie, c_key, data):
+                res = KEY_FOUND
+                return res
+
+            self._check_writable()
+            self._lock_write()
+            try:
+                if cdatrie.trie_store_if_absent(self._c_trie, c_key, value):
+                    self._key_added()
+                    res = KEY_ADDED
+                elif cdatrie.trie_retrieve(self._c_trie, c_key, data):
+                    # the key was added by another thread meanwhile
+                    res = KEY_FOUND
+                else:
+                    self._reject_key(key)
+                return res
+            finally:
+                self._unlock_write()
         finally:
-            free(c_key)
+            free_key(c_key, buf)
+            self._record(OP_SET, 1, res == KEY_FOUND, len(key), len(key),
+                         start)
 
     def iter_prefixes(self, unicode key):
         '''
@@ -287,15 +1059,23 @@ cdef class BaseTrie:
             raise MemoryError()
 
         cdef int index = 1
+        cdef bint found = False, walked, terminal
+        cdef Py_UCS4 char
         try:
             for char in key:
-                if not cdatrie.trie_state_walk(state, <cdatrie.AlphaChar> char):
+                self._lock_read()
+                walked = cdatrie.trie_state_walk(state, <cdatrie.AlphaChar> char)
+                terminal = walked and cdatrie.trie_state_is_terminal(state)
+                self._unlock_read()
+                if not walked:
                     return
-                if cdatrie.trie_state_is_terminal(state):
+                if terminal:
+                    found = True
                     yield key[:index]
                 index += 1
         finally:
             cdatrie.trie_state_free(state)
+            self._record(OP_PREFIX, 1, found, index - 1, 0, 0)
 
     def iter_prefix_items(self, unicode key):
         '''
@@ -308,15 +1088,26 @@ cdef class BaseTrie:
             raise MemoryError()
 
         cdef int index = 1
+        cdef bint found = False, walked, terminal
+        cdef cdatrie.TrieData data
+        cdef Py_UCS4 char
         try:
             for char in key:
-                if not cdatrie.trie_state_walk(state, <cdatrie.AlphaChar> char):
+                self._lock_read()
+                walked = cdatrie.trie_state_walk(state, <cdatrie.AlphaChar> char)
+                terminal = walked and cdatrie.trie_state_is_terminal(state)
+                if terminal:
+                    data = cdatrie.trie_state_get_data(state)
+                self._unlock_read()
+                if not walked:
                     return
-                if cdatrie.trie_state_is_terminal(state): # word is found
-                    yield key[:index], cdatrie.trie_state_get_data(state)
+                if terminal: # word is found
+                    found = True
+                    yield key[:index], data
                 index += 1
         finally:
             cdatrie.trie_state_free(state)
+            self._record(OP_PREFIX, 1, found, index - 1, 0, 0)
 
     def iter_prefix_values(self, unicode key):
         '''
@@ -328,14 +1119,27 @@ cdef class BaseTrie:
         if state == NULL:
             raise MemoryError()
 
+        cdef int steps = 0
+        cdef bint found = False, walked, terminal
+        cdef cdatrie.TrieData data
+        cdef Py_UCS4 char
         try:
             for char in key:
-                if not cdatrie.trie_state_walk(state, <cdatrie.AlphaChar> char):
+                self._lock_read()
+                walked = cdatrie.trie_state_walk(state, <cdatrie.AlphaChar> char)
+                terminal = walked and cdatrie.trie_state_is_terminal(state)
+                if terminal:
+                    data = cdatrie.trie_state_get_data(state)
+                self._unlock_read()
+                if not walked:
                     return
-                if cdatrie.trie_state_is_terminal(state):
-                    yield cdatrie.trie_state_get_data(state)
+                steps += 1
+                if terminal:
+                    found = True
+                    yield data
         finally:
             cdatrie.trie_state_free(state)
+            self._record(OP_PREFIX, 1, found, steps, 0, 0)
 
     def prefixes(self, unicode key):
         '''
@@ -347,6 +1151,9 @@ cdef class BaseTrie:
 
         cdef list result = []
         cdef int index = 1
+        cdef Py_UCS4 char
+        cdef double start = self._start_timer()
+        self._lock_read()
         try:
             for char in key:
                 if not cdatrie.trie_state_walk(state, <cdatrie.AlphaChar> char):
@@ -356,7 +1163,9 @@ cdef class BaseTrie:
                 index += 1
             return result
         finally:
+            self._unlock_read()
             cdatrie.trie_state_free(state)
+            self._record(OP_PREFIX, 1, len(result) > 0, index - 1, 0, start)
 
     cpdef suffixes(self, unicode prefix=u''):
         """
@@ -366,16 +1175,20 @@ cdef class BaseTrie:
         cdef bint success
         cdef list res = []
         cdef BaseState state = BaseState(self)
+        cdef double start = self._start_timer()
 
         if prefix is not None:
             success = state.walk(prefix)
             if not success:
+                self._record(OP_ITER, 1, 0, len(prefix), 0, start)
                 return res
 
         cdef BaseIterator iter = BaseIterator(state)
         while iter.next():
             res.append(iter.key())
 
+        self._record(OP_ITER, 1, 1, 0 if prefix is None else len(prefix),
+                     0, start)
         return res
 
     def prefix_items(self, unicode key):
@@ -394,6 +1207,9 @@ cdef class BaseTrie:
 
         cdef list result = []
         cdef int index = 1
+        cdef Py_UCS4 char
+        cdef double start = self._start_timer()
+        self._lock_read()
         try:
             for char in key:
                 if not cdatrie.trie_state_walk(state, <cdatrie.AlphaChar> char):
@@ -406,7 +1222,9 @@ cdef class BaseTrie:
                 index += 1
             return result
         finally:
+            self._unlock_read()
             cdatrie.trie_state_free(state)
+            self._record(OP_PREFIX, 1, len(result) > 0, index - 1, 0, start)
 
     def prefix_values(self, unicode key):
         '''
@@ -422,15 +1240,22 @@ cdef class BaseTrie:
             raise MemoryError()
 
         cdef list result = []
+        cdef int steps = 0
+        cdef Py_UCS4 char
+        cdef double start = self._start_timer()
+        self._lock_read()
         try:
             for char in key:
                 if not cdatrie.trie_state_walk(state, <cdatrie.AlphaChar> char):
                     break
+                steps += 1
                 if cdatrie.trie_state_is_terminal(state): # word is found
                     result.append(cdatrie.trie_state_get_data(state))
             return result
         finally:
+            self._unlock_read()
             cdatrie.trie_state_free(state)
+            self._record(OP_PREFIX, 1, len(result) > 0, steps, 0, start)
 
     def longest_prefix(self, unicode key, default=RAISE_KEY_ERROR):
         """
@@ -446,7 +1271,10 @@ cdef class BaseTrie:
             raise MemoryError()
 
         cdef int index = 0, last_terminal_index = 0
+        cdef Py_UCS4 ch
+        cdef double start = self._start_timer()
 
+        self._lock_read()
         try:
             for ch in key:
                 if not cdatrie.trie_state_walk(state, <cdatrie.AlphaChar> ch):
@@ -463,7 +1291,9 @@ cdef class BaseTrie:
 
             return key[:last_terminal_index]
         finally:
+            self._unlock_read()
             cdatrie.trie_state_free(state)
+            self._record(OP_PREFIX, 1, last_terminal_index > 0, index, 0, start)
 
     def longest_prefix_item(self, unicode key, default=RAISE_KEY_ERROR):
         """
@@ -483,7 +1313,10 @@ cdef class BaseTrie:
             raise MemoryError()
 
         cdef int index = 0, last_terminal_index = 0, data
+        cdef Py_UCS4 ch
+        cdef double start = self._start_timer()
 
+        self._lock_read()
         try:
             for ch in key:
                 if not cdatrie.trie_state_walk(state, <cdatrie.AlphaChar> ch):
@@ -502,7 +1335,9 @@ cdef class BaseTrie:
             return key[:last_terminal_index], data
 
         finally:
+            self._unlock_read()
             cdatrie.trie_state_free(state)
+            self._record(OP_PREFIX, 1, last_terminal_index > 0, index, 0, start)
 
     def longest_prefix_value(self, unicode key, default=RAISE_KEY_ERROR):
         """
@@ -521,14 +1356,18 @@ cdef class BaseTrie:
         if state == NULL:
             raise MemoryError()
 
-        cdef int data = 0
+        cdef int data = 0, steps = 0
         cdef char found = 0
+        cdef Py_UCS4 ch
+        cdef double start = self._start_timer()
 
+        self._lock_read()
         try:
             for ch in key:
                 if not cdatrie.trie_state_walk(state, <cdatrie.AlphaChar> ch):
                     break
 
+                steps += 1
                 if cdatrie.trie_state_is_terminal(state):
                     found = 1
                     data = cdatrie.trie_state_get_data(state)
@@ -541,22 +1380,274 @@ cdef class BaseTrie:
             return data
 
         finally:
+            self._unlock_read()
             cdatrie.trie_state_free(state)
+            self._record(OP_PREFIX, 1, found, steps, 0, start)
 
     def has_keys_with_prefix(self, unicode prefix):
         """
         Returns True if any key in the trie begins with ``prefix``.
         """
-        cdef cdatrie.TrieState* state = cdatrie.trie_root(self._c_trie)
-        if state == NULL:
-            raise MemoryError()
+        cdef cdatrie.TrieState* state = NULL
+        cdef Py_UCS4 char
+        cdef int steps = 0
+        cdef double start = self._start_timer()
+        self._lock_read()
         try:
+            state = cdatrie.trie_root(self._c_trie)
+            if state == NULL:
+                raise MemoryError()
             for char in prefix:
                 if not cdatrie.trie_state_walk(state, <cdatrie.AlphaChar> char):
                     return False
+                steps += 1
             return True
         finally:
-            cdatrie.trie_state_free(state)
+            if state != NULL:
+                cdatrie.trie_state_free(state)
+            self._unlock_read()
+            self._record(OP_PREFIX, 1, steps == len(prefix), steps, 0, start)
+
+    def fuzzy_items(self, unicode query, int max_distance,
+                    transpositions=False, limit=None):
+        """
+        Returns a list of the items (``(key,value)`` tuples) of this trie
+        whose keys are within ``max_distance`` edits (insertions, deletions
+        and substitutions of a character) of ``query``. Items are sorted
+        by edit distance, then by key.
+
+        If ``transpositions`` is True, swapping two adjacent characters
+        counts as a single edit (optimal string alignment distance).
+        If ``limit`` is not None, at most ``limit`` closest items
+        are returned.
+        """
+        cdef _FuzzySearch search = _FuzzySearch(self, query, max_distance,
+                                                transpositions, limit)
+        return [(key, self._index_to_value(data))
+                for key, data in search.run()]
+
+    def fuzzy_keys(self, unicode query, int max_distance,
+                   transpositions=False, limit=None):
+        """
+        Returns a list of this trie's keys within ``max_distance``
+        edits of ``query`` (see :meth:`fuzzy_items`).
+        """
+        cdef _FuzzySearch search = _FuzzySearch(self, query, max_distance,
+                                                transpositions, limit)
+        return [key for key, data in search.run()]
+
+    def scanner(self):
+        """
+        Returns a :class:`Scanner` which finds keys of this trie
+        in texts (using the Aho-Corasick algorithm).
+        """
+        return Scanner(self)
+
+    def segment(self, unicode text, mode='longest', fallback='char'):
+        """
+        Splits ``text`` into a list of keys of this trie.
+
+        With ``mode='longest'`` the longest key starting at the current
+        position is taken each time (maximal munch). With ``mode='best'``
+        the split with the fewest characters not covered by keys and then
+        the largest sum of values is returned (values must be numbers,
+        e.g. log-probabilities of words).
+
+        Characters not covered by keys are handled according to
+        ``fallback``: ``'char'`` makes each of them a separate segment,
+        ``'merge'`` joins adjacent ones into a single segment
+        and ``'error'`` raises ``KeyError``.
+
+        The text is walked with the GIL released.
+        """
+        if mode not in ('longest', 'best'):
+            raise ValueError("mode must be 'longest' or 'best'")
+        if fallback not in ('char', 'merge', 'error'):
+            raise ValueError("fallback must be 'char', 'merge' or 'error'")
+
+        cdef _Segmentation segmentation = _Segmentation(self, text)
+        if mode == 'longest':
+            segmentation.longest()
+        else:
+            segmentation.best()
+
+        cdef list res = []
+        cdef Py_ssize_t i, start = 0, end
+        cdef bint merge = fallback == 'merge'
+        for i in range(segmentation.count):
+            end = segmentation.ends[i]
+            if segmentation.known[i]:
+                res.append(text[start:end])
+            elif fallback == 'error':
+                raise KeyError(text[start:end])
+            elif merge and i and not segmentation.known[i - 1]:
+                res[-1] += text[start:end]
+            else:
+                res.append(text[start:end])
+            start = end
+        return res
+
+    def count(self, unicode prefix=u''):
+        """
+        Returns the number of keys prefixed by ``prefix``.
+
+        :meth:`count`, :meth:`rank` and :meth:`select` use an index of
+        the numbers of keys in subtrees, so they take time proportional
+        to the key length. The index must be built by
+        :meth:`build_rank_index` first; they raise :class:`DatrieError`
+        if it isn't built or keys were added or removed after that.
+        """
+        return self._get_key_tree().count(prefix)
+
+    def rank(self, unicode key):
+        """
+        Returns the number of keys less than ``key`` (``key`` doesn't
+        have to be in the trie), i.e. the position of ``key`` in
+        :meth:`keys`.
+        """
+        return self._get_key_tree().rank(key)
+
+    def select(self, Py_ssize_t n):
+        """
+        Returns the ``n``-th key (like ``trie.keys()[n]``).
+        """
+        cdef _KeyTree tree = self._get_key_tree()
+        cdef Py_ssize_t size = tree._ranks[tree._size]
+        if n < 0:
+            n += size
+        if not 0 <= n < size:
+            raise IndexError("key index out of range")
+        return tree.node_key(tree.select(n))
+
+    def build_rank_index(self):
+        """
+        Builds the index used by :meth:`count`, :meth:`rank` and
+        :meth:`select`. The index is built from all keys in linear time
+        and can't be updated, so it must be built again after keys
+        are added or removed; build it after a batch of changes.
+        """
+        self._key_tree = _KeyTree(self)
+
+    cdef _KeyTree _get_key_tree(self):
+        cdef _KeyTree tree = self._key_tree
+        if tree is None or tree._version != self._version:
+            raise DatrieError("The rank index is not built or out of date; "
+                              "call build_rank_index()")
+        return tree
+
+    def top_k(self, unicode prefix, int k):
+        """
+        Returns a list of up to ``k`` items (``(key,value)`` tuples)
+        with keys prefixed by ``prefix`` and the largest values, largest
+        first; items with equal values are in key order.
+
+        The search is guided by an index of the largest values
+        in subtrees, so only the best branches are visited. The index
+        is built on the first call and rebuilt (in linear time) by the
+        first call after keys are added or removed; replacing values
+        of existing keys only updates their paths in the index. The index
+        isn't saved with the trie (see :meth:`build_top_k_index`).
+        """
+        return self._top_k(prefix, k, None)
+
+    def build_top_k_index(self):
+        """
+        Builds the index used by :meth:`top_k` (otherwise it is built by
+        the first :meth:`top_k` call after keys are added or removed).
+        """
+        self._top_k_index = _TopKIndex(self, self._top_k_scorer())
+
+    cdef object _top_k_scorer(self):
+        return None
+
+    cdef list _top_k(self, unicode prefix, int k, key):
+        if k < 0:
+            raise ValueError("k must be non-negative")
+        cdef _TopKIndex index = self._top_k_index
+        if index is None or not index.is_current(key):
+            index = _TopKIndex(self, key)
+            self._top_k_index = index
+        return index.search(prefix, k)
+
+    cdef int _value_updated(self, unicode key,
+                            cdatrie.TrieData data) except -1:
+        """
+        Updates the path of ``key`` in the :meth:`top_k` index (if it
+        is current) after the value of ``key`` is replaced.
+        """
+        cdef _TopKIndex index = self._top_k_index
+        if index is None or index._version != self._version:
+            return 0
+        try:
+            index.update(key, data)
+        except:
+            self._top_k_index = None
+            raise
+        return 0
+
+    def iter_match(self, unicode pattern):
+        """
+        Returns an iterator over this trie's keys matching
+        a glob ``pattern``: ``?`` matches any character, ``*`` matches
+        any string and ``[...]`` matches a character from a set
+        (e.g. ``[abc]``, ``[a-z]`` or ``[!a-z]``).
+
+        Only subtrees which can match the pattern are visited.
+        """
+        cdef _MatchIterator iter = _MatchIterator(self, pattern)
+        while iter.next():
+            yield iter.key
+
+    def iter_match_items(self, unicode pattern):
+        """
+        Returns an iterator over the items (``(key,value)`` tuples)
+        of this trie with keys matching ``pattern`` (see :meth:`iter_match`).
+        """
+        cdef _MatchIterator iter = _MatchIterator(self, pattern)
+        while iter.next():
+            yield iter.key, self._index_to_value(iter.data)
+
+    def iter_match_values(self, unicode pattern):
+        """
+        Returns an iterator over the values of this trie
+        with keys matching ``pattern`` (see :meth:`iter_match`).
+        """
+        cdef _MatchIterator iter = _MatchIterator(self, pattern)
+        while iter.next():
+            yield self._index_to_value(iter.data)
+
+    def match(self, unicode pattern):
+        """
+        Returns a list of this trie's keys matching ``pattern``
+        (see :meth:`iter_match`).
+        """
+        cdef _MatchIterator iter = _MatchIterator(self, pattern)
+        cdef list result = []
+        while iter.next():
+            result.append(iter.key)
+        return result
+
+    def match_items(self, unicode pattern):
+        """
+        Returns a list of the items (``(key,value)`` tuples) of this trie
+        with keys matching ``pattern`` (see :meth:`iter_match`).
+        """
+        cdef _MatchIterator iter = _MatchIterator(self, pattern)
+        cdef list result = []
+        while iter.next():
+            result.append((iter.key, self._index_to_value(iter.data)))
+        return result
+
+    def match_values(self, unicode pattern):
+        """
+        Returns a list of the values of this trie with keys
+        matching ``pattern`` (see :meth:`iter_match`).
+        """
+        cdef _MatchIterator iter = _MatchIterator(self, pattern)
+        cdef list result = []
+        while iter.next():
+            result.append(self._index_to_value(iter.data))
+        return result
 
     cpdef items(self, unicode prefix=None):
         """
@@ -568,10 +1659,12 @@ cdef class BaseTrie:
         cdef bint success
         cdef list res = []
         cdef BaseState state = BaseState(self)
+        cdef double start = self._start_timer()
 
         if prefix is not None:
             success = state.walk(prefix)
             if not success:
+                self._record(OP_ITER, 1, 0, len(prefix), 0, start)
                 return res
 
         cdef BaseIterator iter = BaseIterator(state)
@@ -583,10 +1676,13 @@ cdef class BaseTrie:
             while iter.next():
                 res.append((prefix+iter.key(), iter.data()))
 
+        self._record(OP_ITER, 1, 1, 0 if prefix is None else len(prefix),
+                     0, start)
         return res
 
     def __iter__(self):
         cdef BaseIterator iter = BaseIterator(BaseState(self))
+        self._record(OP_ITER, 1, 1, 0, 0, 0)
         while iter.next():
             yield iter.key()
 
@@ -599,10 +1695,12 @@ cdef class BaseTrie:
         cdef bint success
         cdef list res = []
         cdef BaseState state = BaseState(self)
+        cdef double start = self._start_timer()
 
         if prefix is not None:
             success = state.walk(prefix)
             if not success:
+                self._record(OP_ITER, 1, 0, len(prefix), 0, start)
                 return res
 
         cdef BaseIterator iter = BaseIterator(state)
@@ -614,6 +1712,8 @@ cdef class BaseTrie:
             while iter.next():
                 res.append(prefix+iter.key())
 
+        self._record(OP_ITER, 1, 1, 0 if prefix is None else len(prefix),
+                     0, start)
         return res
 
     cpdef values(self, unicode prefix=None):
@@ -626,109 +1726,350 @@ cdef class BaseTrie:
         cdef bint success
         cdef list res = []
         cdef BaseState state = BaseState(self)
+        cdef double start = self._start_timer()
 
         if prefix is not None:
             success = state.walk(prefix)
             if not success:
+                self._record(OP_ITER, 1, 0, len(prefix), 0, start)
                 return res
 
         cdef BaseIterator iter = BaseIterator(state)
         while iter.next():
             res.append(iter.data())
+        self._record(OP_ITER, 1, 1, 0 if prefix is None else len(prefix),
+                     0, start)
         return res
 
-    cdef _index_to_value(self, cdatrie.TrieData index):
-        return index
+    def iterkeys(self, unicode prefix=None, unicode start=None,
+                 unicode stop=None, unicode after=None, limit=None,
+                 bint reverse=False):
+        """
+        Returns an iterator over this trie's keys in key order
+        (see :meth:`iteritems`).
+        """
+        cdef _RangeIterator iter = self._iter_range(prefix, start, stop,
+                                                    after, limit, reverse)
+        if iter is None:
+            return
+        while iter.next():
+            yield iter.key
 
+    def itervalues(self, unicode prefix=None, unicode start=None,
+                   unicode stop=None, unicode after=None, limit=None,
+                   bint reverse=False):
+        """
+        Returns an iterator over this trie's values in key order
+        (see :meth:`iteritems`).
+        """
+        cdef _RangeIterator iter = self._iter_range(prefix, start, stop,
+                                                    after, limit, reverse)
+        if iter is None:
+            return
+        while iter.next():
+            yield self._index_to_value(iter.data)
 
-cdef class Trie(BaseTrie):
-    """
-    Wrapper for libdatrie's trie.
-    Keys are unicode strings, values are Python objects.
+    def iteritems(self, unicode prefix=None, unicode start=None,
+                  unicode stop=None, unicode after=None, limit=None,
+                  bint reverse=False):
+        """
+        Returns an iterator over this trie's items (``(key,value)`` tuples)
+        in key order: keys are compared by code points of their characters
+        (like Python strings), so a key comes right before keys
+        it is a prefix of.
+
+        If ``prefix`` is not None, yields only the items
+        associated with keys prefixed by ``prefix``.
+
+        ``start`` and ``stop`` restrict keys to the range
+        ``start <= key < stop``; ``after`` skips keys up to
+        and including ``after`` in iteration order (e.g. the last key
+        of the previous page); ``limit`` is the maximal number of items.
+        If ``reverse`` is True, items are yielded in reverse key order.
+
+        Iteration starts by walking the trie to the first key
+        in the range rather than skipping keys before it.
+        """
+        cdef _RangeIterator iter = self._iter_range(prefix, start, stop,
+                                                    after, limit, reverse)
+        if iter is None:
+            return
+        while iter.next():
+            yield iter.key, self._index_to_value(iter.data)
+
+    cdef _RangeIterator _iter_range(self, unicode prefix, unicode start,
+                                    unicode stop, unicode after, limit,
+                                    bint reverse):
+        """
+        Returns an iterator for :meth:`iteritems` or None if there
+        are no keys in the range.
+        """
+        cdef BaseState state = BaseState(self)
+        cdef unicode lower = start, upper = stop, seek, other
+        cdef bint lower_inclusive = True, seek_inclusive, other_inclusive
+        cdef _RangeIterator iter
+        cdef double start_time = self._start_timer()
+
+        if limit is not None and limit < 0:
+            raise ValueError("limit must be non-negative")
+        if after is not None:
+            if reverse:
+                if upper is None or after < upper:
+                    upper = after
+            elif lower is None or after >= lower:
+                lower, lower_inclusive = after, False
+
+        if prefix is None:
+            prefix = u''
+        elif not state.walk(prefix):
+            self._record(OP_ITER, 1, 0, len(prefix), 0, start_time)
+            return None
+
+        if reverse:
+            seek, seek_inclusive = upper, False
+            other, other_inclusive = lower, lower_inclusive
+        else:
+            seek, seek_inclusive = lower, lower_inclusive
+            other, other_inclusive = upper, False
+
+        # the walk seeks the bound relative to the prefix
+        if seek is not None:
+            if seek.startswith(prefix):
+                seek = seek[len(prefix):]
+            elif (seek < prefix) != reverse:
+                seek = None  # all keys with the prefix are within the bound
+            else:
+                self._record(OP_ITER, 1, 1, len(prefix), 0, start_time)
+                return None
+
+        iter = _RangeIterator(state, prefix, seek, seek_inclusive, other,
+                              other_inclusive, -1 if limit is None else limit,
+                              reverse)
+        self._record(OP_ITER, 1, 1, len(prefix), 0, start_time)
+        return iter
+
+    def iterkeys_chunked(self, unicode prefix=None, int size=1000):
+        """
+        Returns an iterator over lists of at most ``size`` keys
+        (see :meth:`iterkeys`).
+        """
+        return _chunked(self.iterkeys(prefix), size)
+
+    def itervalues_chunked(self, unicode prefix=None, int size=1000):
+        """
+        Returns an iterator over lists of at most ``size`` values
+        (see :meth:`itervalues`).
+        """
+        return _chunked(self.itervalues(prefix), size)
+
+    def iteritems_chunked(self, unicode prefix=None, int size=1000):
+        """
+        Returns an iterator over lists of at most ``size`` items
+        (see :meth:`iteritems`).
+        """
+        return _chunked(self.iteritems(prefix), size)
+
+    cdef _index_to_value(self, cdatrie.TrieData index):
+        return index
+
+    cdef int _data_to_weights(self, cdatrie.TrieData* data, double* weights,
+                              Py_ssize_t count) except -1:
+        """
+        Converts trie data to the numbers used by :meth:`segment`.
+        """
+        cdef Py_ssize_t i
+        for i in range(count):
+            weights[i] = data[i]
+        return 0
+
+
+cdef class _ValueTrie(BaseTrie):
+    """
+    Base class for tries with values kept in a separate value store;
+    trie data are indices in the store. Slots of deleted keys are
+    reused for new keys.
     """
 
-    cdef list _values
+    cdef object _values  # list or array.array
+    cdef list _free_slots  # unused indices in _values; None if not known
+    cdef object _empty_value  # value of unused slots
+    cdef object _top_k_key  # see top_k_key
 
-    def __init__(self, alphabet=None, ranges=None, AlphaMap alpha_map=None, _create=True):
+    cdef int _init_values(self, values, empty_value) except -1:
+        self._values = values
+        self._empty_value = empty_value
+        self._free_slots = []
+        return 0
+
+    cdef int _write_values(self, f) except -1:
         """
-        For efficiency trie needs to know what unicode symbols
-        it should be able to store so this constructor requires
-        either ``alphabet`` (a string/iterable with all allowed characters),
-        ``ranges`` (a list of (begin, end) pairs, e.g. [('a', 'z')])
-        or ``alpha_map`` (:class:`datrie.AlphaMap` instance).
+        Writes the value store to a file-like object.
         """
-        self._values = []
-        super(Trie, self).__init__(alphabet, ranges, alpha_map, _create)
+        raise NotImplementedError()
+
+    cdef int _read_values(self, f) except -1:
+        """
+        Reads the value store written by :meth:`_write_values`.
+        """
+        raise NotImplementedError()
+
+    def tobytes(self):
+        """
+        Returns this trie serialized to bytes (the same data
+        :meth:`write` writes to a file).
+        """
+        f = io.BytesIO()
+        f.write(BaseTrie.tobytes(self))
+        self._write_values(f)
+        return f.getvalue()
+
+    cdef int _read_from(self, _CFile stream) except -1:
+        BaseTrie._read_from(self, stream)
+        return self._read_values(stream)
 
     def __reduce__(self):
-        with tempfile.NamedTemporaryFile() as f:
-            self.write(f)
-            pickle.dump(self._values, f)
-            f.seek(0)
-            state = f.read()
-            return Trie, (None, None, None, False), state
-
-    def __setstate__(self, bytes state):
-        assert self._c_trie is NULL
-        with tempfile.NamedTemporaryFile() as f:
-            f.write(state)
-            f.flush()
-            f.seek(0)
-            self._c_trie = _load_from_file(f)
-            self._values = pickle.load(f)
+        return type(self), (None, None, None, False), (self.tobytes(), len(self))
 
     def __getitem__(self, unicode key):
-        cdef cdatrie.TrieData index = self._getitem(key)
-        return self._values[index]
+        return self._values[self._getitem(key)]
 
     def get(self, unicode key, default=None):
         cdef cdatrie.TrieData index
-        try:
-            index = self._getitem(key)
+        if self._lookup(key, &index):
             return self._values[index]
-        except KeyError:
-            return default
+        return default
 
     def __setitem__(self, unicode key, object value):
-        cdef cdatrie.TrieData next_index = len(self._values)
-        cdef cdatrie.TrieData index = self._setdefault(key, next_index)
-        if index == next_index:
-            self._values.append(value)   # insert
-        else:
-            self._values[index] = value  # update
+        self._check_writable()
+        cdef cdatrie.TrieData index
+        cdef double start = self._start_timer()
+
+        # the value is stored (and converted by typed stores) before
+        # the key is added, so values of wrong type leave the trie unchanged
+        cdef cdatrie.TrieData next_index = self._reserve_slot()
+        try:
+            self._values[next_index] = value  # insert
+            res = self._store_if_absent(key, next_index, &index, start)
+        except:
+            self._release_slot(next_index)
+            raise
+
+        if res != KEY_ADDED:
+            self._release_slot(next_index)
+            if res == KEY_FOUND:
+                self._values[index] = value   # update
+                self._value_updated(key, index)
 
     def setdefault(self, unicode key, object value):
-        cdef cdatrie.TrieData next_index = len(self._values)
-        cdef cdatrie.TrieData index = self._setdefault(key, next_index)
-        if index == next_index:
-            self._values.append(value)   # insert
-            return value
-        else:
-            return self._values[index]   # lookup
+        cdef cdatrie.TrieData index
+        if self._frozen:
+            # frozen tries can't add keys
+            if key not in self:
+                self._check_writable()
+            return self[key]
+
+        cdef double start = self._start_timer()
+        cdef cdatrie.TrieData next_index = self._reserve_slot()
+        try:
+            self._values[next_index] = value
+            res = self._store_if_absent(key, next_index, &index, start)
+        except:
+            self._release_slot(next_index)
+            raise
+
+        if res == KEY_ADDED:
+            return self._values[next_index]  # insert
+
+        self._release_slot(next_index)
+        if res == KEY_FOUND:
+            return self._values[index]       # lookup
+        return value
 
     def __delitem__(self, unicode key):
         # XXX: this could be faster (key is encoded twice here)
-        cdef cdatrie.TrieData index = self._getitem(key)
-        self._values[index] = DELETED_OBJECT
-        self._delitem(key)
+        self._check_writable()
+        cdef cdatrie.TrieData index
+        cdef bint found = self._retrieve(key, &index)
+        self._delitem(key)  # raises KeyError if the key is not found
+        if found:
+            self._release_slot(index)
 
-    def write(self, f):
+    cdef cdatrie.TrieData _reserve_slot(self) except -1:
         """
-        Writes a trie to a file. File-like objects without real
-        file descriptors are not supported.
+        Returns an index of a free slot in the value store. The slot is
+        reserved until it is used for a value or released with
+        ``_release_slot``.
         """
-        super(Trie, self).write(f)
-        pickle.dump(self._values, f)
+        cdef list free_slots = self._get_free_slots()
+        if free_slots:
+            return free_slots.pop()
+        self._values.append(self._empty_value)
+        return len(self._values) - 1
+
+    cdef int _release_slot(self, cdatrie.TrieData index) except -1:
+        cdef list free_slots = self._get_free_slots()
+        self._values[index] = self._empty_value
+        if index == len(self._values) - 1:
+            self._values.pop()
+        else:
+            free_slots.append(index)
+        return 0
 
-    @classmethod
-    def read(cls, f):
+    cdef list _get_free_slots(self):
         """
-        Creates a new Trie by reading it from file.
-        File-like objects without real file descriptors are not supported.
+        Returns a list of unused indices in the value store. For tries
+        loaded from files it is computed by walking the trie once.
         """
-        cdef Trie trie = super(Trie, cls).read(f)
-        trie._values = pickle.load(f)
-        return trie
+        if self._free_slots is None:
+            self._free_slots = _unused_indices(self, len(self._values))
+            for index in self._free_slots:
+                self._values[index] = self._empty_value
+        return self._free_slots
+
+    property tombstones:
+        """
+        The number of unused slots (left by deleted keys) in the value
+        store. Call :meth:`compact` to reclaim them.
+        """
+        def __get__(self):
+            return len(self._get_free_slots())
+
+    def compact(self):
+        """
+        Removes unused slots (left by deleted keys) from the value store.
+        Values are renumbered in key order; returns the number of
+        reclaimed slots.
+        """
+        self._check_writable()
+        cdef list items = BaseTrie.items(self)
+        cdef object values = self._values[:0]  # an empty store of the same type
+        cdef Py_ssize_t reclaimed = len(self._values) - len(items)
+        cdef cdatrie.TrieData index
+
+        # the top_k index would score the new slots in the old store
+        self._top_k_index = None
+        for key, index in items:
+            values.append(self._values[index])
+            BaseTrie._setitem(self, key, len(values) - 1)
+
+        self._values = values
+        self._free_slots = []
+        # trie data are changed, so iterators, scanners and indexes
+        # made before must not be used
+        self._version += 1
+        return reclaimed
+
+    def write(self, f, compact=False, repack=False):
+        """
+        Writes a trie to a file-like object.
+
+        If ``compact`` is True, :meth:`compact` is called first;
+        if ``repack`` is True, :meth:`repack` is called first.
+        """
+        if compact:
+            self.compact()
+        super(_ValueTrie, self).write(f, repack)
+        self._write_values(f)
 
     cpdef items(self, unicode prefix=None):
         """
@@ -747,21 +2088,26 @@ cdef class Trie(BaseTrie):
         cdef bint success
         cdef list res = []
         cdef BaseState state = BaseState(self)
+        cdef double start = self._start_timer()
+        values = self._values
 
         if prefix is not None:
             success = state.walk(prefix)
             if not success:
+                self._record(OP_ITER, 1, 0, len(prefix), 0, start)
                 return res
 
         cdef BaseIterator iter = BaseIterator(state)
 
         if prefix is None:
             while iter.next():
-                res.append((iter.key(), self._values[iter.data()]))
+                res.append((iter.key(), values[iter.data()]))
         else:
             while iter.next():
-                res.append((prefix+iter.key(), self._values[iter.data()]))
+                res.append((prefix+iter.key(), values[iter.data()]))
 
+        self._record(OP_ITER, 1, 1, 0 if prefix is None else len(prefix),
+                     0, start)
         return res
 
     cpdef values(self, unicode prefix=None):
@@ -780,18 +2126,23 @@ cdef class Trie(BaseTrie):
 
         cdef list res = []
         cdef BaseState state = BaseState(self)
+        cdef double start = self._start_timer()
         cdef bint success
+        values = self._values
 
         if prefix is not None:
             success = state.walk(prefix)
             if not success:
+                self._record(OP_ITER, 1, 0, len(prefix), 0, start)
                 return res
 
         cdef BaseIterator iter = BaseIterator(state)
 
         while iter.next():
-            res.append(self._values[iter.data()])
+            res.append(values[iter.data()])
 
+        self._record(OP_ITER, 1, 1, 0 if prefix is None else len(prefix),
+                     0, start)
         return res
 
     def longest_prefix_item(self, unicode key, default=RAISE_KEY_ERROR):
@@ -837,7 +2188,7 @@ cdef class Trie(BaseTrie):
         return [(k, self._values[v]) for (k, v) in self._prefix_items(key)]
 
     def iter_prefix_items(self, unicode key):
-        for k, v in super(Trie, self).iter_prefix_items(key):
+        for k, v in super(_ValueTrie, self).iter_prefix_items(key):
             yield k, self._values[v]
 
     def prefix_values(self, unicode key):
@@ -848,12 +2199,128 @@ cdef class Trie(BaseTrie):
         return [self._values[v] for v in self._prefix_values(key)]
 
     def iter_prefix_values(self, unicode key):
-        for v in super(Trie, self).iter_prefix_values(key):
+        for v in super(_ValueTrie, self).iter_prefix_values(key):
             yield self._values[v]
 
+    def top_k(self, unicode prefix, int k):
+        """
+        Returns a list of up to ``k`` items (``(key,value)`` tuples)
+        with keys prefixed by ``prefix`` and the largest values
+        (or the largest ``top_k_key(value)`` if :attr:`top_k_key`
+        is set). See :meth:`BaseTrie.top_k`.
+
+        Changes of mutable values are not noticed by the index;
+        call :meth:`build_top_k_index` after them.
+        """
+        return self._top_k(prefix, k, self._top_k_key)
+
+    property top_k_key:
+        """
+        A function computing :meth:`top_k` scores from values
+        (None by default, values are scores). Setting it drops the
+        index; it isn't saved or pickled with the trie.
+        """
+        def __get__(self):
+            return self._top_k_key
+
+        def __set__(self, key):
+            self._top_k_key = key
+            self._top_k_index = None
+
+    cdef object _top_k_scorer(self):
+        return self._top_k_key
+
+    cdef tuple _values_size(self):
+        return len(self._values), sys.getsizeof(self._values)
+
     cdef _index_to_value(self, cdatrie.TrieData index):
         return self._values[index]
 
+    cdef int _data_to_weights(self, cdatrie.TrieData* data, double* weights,
+                              Py_ssize_t count) except -1:
+        cdef Py_ssize_t i
+        for i in range(count):
+            weights[i] = self._values[data[i]]
+        return 0
+
+
+cdef class Trie(_ValueTrie):
+    """
+    Wrapper for libdatrie's trie.
+    Keys are unicode strings, values are Python objects.
+    """
+
+    def __init__(self, alphabet=None, ranges=None, AlphaMap alpha_map=None, _create=True):
+        """
+        For efficiency trie needs to know what unicode symbols
+        it should be able to store so this constructor requires
+        either ``alphabet`` (a string/iterable with all allowed characters),
+        ``ranges`` (a list of (begin, end) pairs, e.g. [('a', 'z')])
+        or ``alpha_map`` (:class:`datrie.AlphaMap` instance).
+        """
+        self._init_values([], DELETED_OBJECT)
+        super(Trie, self).__init__(alphabet, ranges, alpha_map, _create)
+
+    cdef int _write_values(self, f) except -1:
+        pickle.dump(self._values, f)
+        return 0
+
+    cdef int _read_values(self, f) except -1:
+        self._values = pickle.load(f)
+        self._free_slots = None
+        return 0
+
+
+cdef class TypedTrie(_ValueTrie):
+    """
+    Wrapper for libdatrie's trie.
+    Keys are unicode strings, values are numbers of the same C type.
+
+    Values are kept in a contiguous ``array.array`` instead of a list
+    of Python objects and are saved to files as raw data.
+    """
+
+    def __init__(self, alphabet=None, ranges=None, AlphaMap alpha_map=None,
+                 _create=True, typecode='d'):
+        """
+        For efficiency trie needs to know what unicode symbols
+        it should be able to store so this constructor requires
+        either ``alphabet`` (a string/iterable with all allowed characters),
+        ``ranges`` (a list of (begin, end) pairs, e.g. [('a', 'z')])
+        or ``alpha_map`` (:class:`datrie.AlphaMap` instance).
+
+        ``typecode`` is a type code supported by :mod:`array` module,
+        e.g. ``'d'`` (float64, default) or ``'q'`` (int64).
+        """
+        self._init_values(array.array(typecode), 0)
+        super(TypedTrie, self).__init__(alphabet, ranges, alpha_map, _create)
+
+    property typecode:
+        """
+        Type code of values (see :mod:`array` module).
+        """
+        def __get__(self):
+            return self._values.typecode
+
+    cdef int _write_values(self, f) except -1:
+        _write_array(f, self._values)
+        return 0
+
+    cdef int _read_values(self, f) except -1:
+        self._values = _read_array(f)
+        self._free_slots = None
+        return 0
+
+    cpdef values(self, unicode prefix=None):
+        """
+        Returns an ``array.array`` with this trie's values.
+
+        If ``prefix`` is not None, returns only the values
+        associated with keys prefixed by ``prefix``.
+        """
+        return array.array(self._values.typecode,
+                           _ValueTrie.values(self, prefix))
+
 
 cdef class _TrieState:
     cdef cdatrie.TrieState* _state
@@ -870,11 +2337,15 @@ cdef class _TrieState:
             cdatrie.trie_state_free(self._state)
 
     cpdef walk(self, unicode to):
-        cdef bint res
+        cdef Py_UCS4 ch
+        cdef bint res = True
+        self._trie._lock_read()
         for ch in to:
-            if not self.walk_char(<cdatrie.AlphaChar> ch):
-                return False
-        return True
+            if not cdatrie.trie_state_walk(self._state, <cdatrie.AlphaChar> ch):
+                res = False
+                break
+        self._trie._unlock_read()
+        return res
 
     cdef bint walk_char(self, cdatrie.AlphaChar char):
         """
@@ -882,7 +2353,10 @@ cdef class _TrieState:
         On return, the state is updated to the new state if successfully walked.
         Returns boolean value indicating the success of the walk.
         """
-        return cdatrie.trie_state_walk(self._state, char)
+        self._trie._lock_read()
+        cdef bint res = cdatrie.trie_state_walk(self._state, char)
+        self._trie._unlock_read()
+        return res
 
     cpdef copy_to(self, _TrieState state):
         """ Copies trie state to another """
@@ -924,10 +2398,7 @@ cdef class BaseState(_TrieState):
 cdef class State(_TrieState):
 
     def __cinit__(self, Trie trie): # this is overriden for extra type check
-        self._state = cdatrie.trie_root(trie._c_trie)
-        if self._state is NULL:
-            raise MemoryError()
-        self._trie = trie
+        pass  # the state is created by _TrieState.__cinit__
 
     cpdef data(self):
         cdef cdatrie.TrieData data = cdatrie.trie_state_get_data(self._state)
@@ -937,9 +2408,11 @@ cdef class State(_TrieState):
 cdef class _TrieIterator:
     cdef cdatrie.TrieIterator* _iter
     cdef _TrieState _root
+    cdef unsigned long _version
 
     def __cinit__(self, _TrieState state):
         self._root = state # prevent garbage collection of state
+        self._version = state._trie._version
         self._iter = cdatrie.trie_iterator_new(state._state)
         if self._iter is NULL:
             raise MemoryError()
@@ -948,16 +2421,33 @@ cdef class _TrieIterator:
         if self._iter is not NULL:
             cdatrie.trie_iterator_free(self._iter)
 
-    cpdef bint next(self):
-        return cdatrie.trie_iterator_next(self._iter)
+    cpdef bint next(self) except -1:
+        cdef BaseTrie trie = self._root._trie
+        cdef bint res
+        if self._version != trie._version:
+            raise RuntimeError("trie changed size during iteration")
+        trie._lock_read()
+        res = cdatrie.trie_iterator_next(self._iter)
+        trie._unlock_read()
+        return res
 
     cpdef unicode key(self):
+        cdef BaseTrie trie = self._root._trie
+        trie._lock_read()
         cdef cdatrie.AlphaChar* key = cdatrie.trie_iterator_get_key(self._iter)
+        trie._unlock_read()
         try:
             return unicode_from_alpha_char(key)
         finally:
             free(key)
 
+    cdef inline cdatrie.TrieData _data(self):
+        cdef BaseTrie trie = self._root._trie
+        trie._lock_read()
+        cdef cdatrie.TrieData data = cdatrie.trie_iterator_get_data(self._iter)
+        trie._unlock_read()
+        return data
+
 
 cdef class BaseIterator(_TrieIterator):
     """
@@ -965,7 +2455,7 @@ cdef class BaseIterator(_TrieIterator):
     traversal.
     """
     cpdef cdatrie.TrieData data(self):
-        return cdatrie.trie_iterator_get_data(self._iter)
+        return self._data()
 
 
 cdef class Iterator(_TrieIterator):
@@ -974,29 +2464,2158 @@ cdef class Iterator(_TrieIterator):
     traversal.
     """
     def __cinit__(self, State state): # this is overriden for extra type check
-        self._root = state # prevent garbage collection of state
-        self._iter = cdatrie.trie_iterator_new(state._state)
-        if self._iter is NULL:
-            raise MemoryError()
+        pass  # the iterator is created by _TrieIterator.__cinit__
 
     cpdef data(self):
-        cdef cdatrie.TrieData data = cdatrie.trie_iterator_get_data(self._iter)
-        return self._root._trie._index_to_value(data)
+        return self._root._trie._index_to_value(self._data())
+
+
+cdef class _ScanResults:
+    """
+    Growable arrays of ``Scanner`` matches.
+    """
+    cdef Py_ssize_t count
+    cdef Py_ssize_t capacity
+    cdef Py_ssize_t* starts
+    cdef Py_ssize_t* ends
+    cdef cdatrie.TrieData* data
+    cdef Py_ssize_t* longest_ends  # end of the longest match by start
+    cdef cdatrie.TrieData* longest_data
+
+    def __dealloc__(self):
+        free(self.starts)
+        free(self.ends)
+        free(self.data)
+        free(self.longest_ends)
+        free(self.longest_data)
+
+    cdef int reserve_starts(self, Py_ssize_t length) except -1:
+        self.longest_ends = <Py_ssize_t*> calloc(length + 1, sizeof(Py_ssize_t))
+        self.longest_data = <cdatrie.TrieData*> malloc(
+            (length + 1) * sizeof(cdatrie.TrieData))
+        if self.longest_ends is NULL or self.longest_data is NULL:
+            raise MemoryError()
+        return 0
+
+    cdef int add(self, Py_ssize_t start, Py_ssize_t end,
+                 cdatrie.TrieData data) noexcept nogil:
+        """
+        Adds a match; returns -1 on memory error.
+        """
+        cdef Py_ssize_t capacity
+        cdef void* ptr
+        if self.count == self.capacity:
+            capacity = 2 * self.capacity or 64
+            ptr = realloc(self.starts, capacity * sizeof(Py_ssize_t))
+            if ptr is NULL:
+                return -1
+            self.starts = <Py_ssize_t*> ptr
+            ptr = realloc(self.ends, capacity * sizeof(Py_ssize_t))
+            if ptr is NULL:
+                return -1
+            self.ends = <Py_ssize_t*> ptr
+            ptr = realloc(self.data, capacity * sizeof(cdatrie.TrieData))
+            if ptr is NULL:
+                return -1
+            self.data = <cdatrie.TrieData*> ptr
+            self.capacity = capacity
+
+        self.starts[self.count] = start
+        self.ends[self.count] = end
+        self.data[self.count] = data
+        self.count += 1
+        return 0
+
+
+cdef class Scanner:
+    """
+    Aho-Corasick automaton for finding all keys of a trie in a text.
+    Use :meth:`BaseTrie.scanner` to create it.
+
+    The automaton is compiled once from the keys of the trie; nodes are
+    numbered in breadth-first order, so children of each node are
+    contiguous and sorted by character.
+    """
+    cdef BaseTrie _trie
+    cdef unsigned long _version
+    cdef int _size  # number of nodes
+    cdef int _capacity
+    cdef int* _first_child  # children of node n are [_first_child[n], _first_child[n + 1])
+    cdef cdatrie.AlphaChar* _labels  # character of the edge to node
+    cdef int* _depths
+    cdef int* _fail
+    cdef int* _output  # nearest key node on the failure chain; 0 if none
+    cdef char* _terminal
+    cdef cdatrie.TrieData* _data
+
+    def __cinit__(self, BaseTrie trie):
+        self._trie = trie
+        self._version = trie._version
+        self._reserve(64)
+        self._build()
+
+    def __dealloc__(self):
+        free(self._first_child)
+        free(self._labels)
+        free(self._depths)
+        free(self._fail)
+        free(self._output)
+        free(self._terminal)
+        free(self._data)
+
+    cdef int _reserve(self, int size) except -1:
+        """
+        Makes room for ``size`` nodes (plus a sentinel in _first_child).
+        """
+        cdef int capacity = self._capacity or 1
+        cdef void* ptr
+        if size < self._capacity:
+            return 0
+        while capacity <= size:
+            capacity *= 2
+
+        ptr = realloc(self._first_child, (capacity + 1) * sizeof(int))
+        if ptr is NULL:
+            raise MemoryError()
+        self._first_child = <int*> ptr
+        ptr = realloc(self._labels, capacity * sizeof(cdatrie.AlphaChar))
+        if ptr is NULL:
+            raise MemoryError()
+        self._labels = <cdatrie.AlphaChar*> ptr
+        ptr = realloc(self._depths, capacity * sizeof(int))
+        if ptr is NULL:
+            raise MemoryError()
+        self._depths = <int*> ptr
+        ptr = realloc(self._fail, capacity * sizeof(int))
+        if ptr is NULL:
+            raise MemoryError()
+        self._fail = <int*> ptr
+        ptr = realloc(self._output, capacity * sizeof(int))
+        if ptr is NULL:
+            raise MemoryError()
+        self._output = <int*> ptr
+        ptr = realloc(self._terminal, capacity)
+        if ptr is NULL:
+            raise MemoryError()
+        self._terminal = <char*> ptr
+        ptr = realloc(self._data, capacity * sizeof(cdatrie.TrieData))
+        if ptr is NULL:
+            raise MemoryError()
+        self._data = <cdatrie.TrieData*> ptr
+
+        self._capacity = capacity
+        return 0
+
+    cdef int _build(self) except -1:
+        cdef cdatrie.TrieState** states = NULL  # trie states of queued nodes
+        cdef int states_capacity = 0
+        cdef cdatrie.AlphaChar chars[256]
+        cdef cdatrie.TrieState* state
+        cdef int node, i, count, f, next_node
+        cdef void* ptr
+
+        # breadth-first walk over the trie
+        self._size = 1
+        self._labels[0] = 0
+        self._depths[0] = 0
+        try:
+            states = <cdatrie.TrieState**> malloc(
+                64 * sizeof(cdatrie.TrieState*))
+            if states is NULL:
+                raise MemoryError()
+            states_capacity = 64
+            states[0] = cdatrie.trie_root(self._trie._c_trie)
+            if states[0] is NULL:
+                raise MemoryError()
+
+            node = 0
+            while node < self._size:
+                state = states[node]
+                self._first_child[node] = self._size
+                self._terminal[node] = 0
+                count = cdatrie.trie_state_walkable_chars(state, chars, 256)
+                for i in range(count):
+                    if chars[i] == 0:
+                        # the empty key is not searched for
+                        if node:
+                            self._terminal[node] = 1
+                            self._data[node] = cdatrie.trie_state_get_data(state)
+                        continue
+
+                    self._reserve(self._size + 1)
+                    if self._size == states_capacity:
+                        ptr = realloc(states, 2 * states_capacity *
+                                      sizeof(cdatrie.TrieState*))
+                        if ptr is NULL:
+                            raise MemoryError()
+                        states = <cdatrie.TrieState**> ptr
+                        states_capacity *= 2
+                    states[self._size] = cdatrie.trie_state_clone(state)
+                    if states[self._size] is NULL:
+                        raise MemoryError()
+                    cdatrie.trie_state_walk(states[self._size], chars[i])
+                    self._labels[self._size] = chars[i]
+                    self._depths[self._size] = self._depths[node] + 1
+                    self._size += 1
+
+                cdatrie.trie_state_free(state)
+                states[node] = NULL
+                node += 1
+        finally:
+            if states is not NULL:
+                for i in range(self._size):
+                    if states[i] is not NULL:
+                        cdatrie.trie_state_free(states[i])
+                free(states)
+        self._first_child[self._size] = self._size
+
+        # failure links; parents are processed before children
+        self._fail[0] = 0
+        self._output[0] = 0
+        for node in range(self._size):
+            for i in range(self._first_child[node], self._first_child[node + 1]):
+                f = self._fail[node]
+                next_node = 0
+                while node:
+                    next_node = self._goto(f, self._labels[i])
+                    if next_node or f == 0:
+                        break
+                    f = self._fail[f]
+                self._fail[i] = next_node
+                f = self._fail[i]
+                self._output[i] = f if self._terminal[f] else self._output[f]
+        return 0
+
+    cdef int _goto(self, int node, cdatrie.AlphaChar char) noexcept nogil:
+        """
+        Returns the child of ``node`` by ``char``, or 0 (the root is
+        nobody's child).
+        """
+        cdef int low = self._first_child[node]
+        cdef int high = self._first_child[node + 1]
+        cdef int middle
+        while low < high:
+            middle = (low + high) // 2
+            if self._labels[middle] < char:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._first_child[node + 1] and self._labels[low] == char:
+            return low
+        return 0
+
+    def finditer(self, unicode text, overlapping=True):
+        """
+        Returns an iterator over ``(start, end, value)`` tuples for keys
+        found in ``text`` (``text[start:end]`` is the key).
+
+        By default all occurrences are returned in order of their end
+        positions (longer keys first). If ``overlapping`` is False,
+        the leftmost longest non-overlapping occurrences are returned
+        in order of their start positions.
+
+        Occurrences are found as the iterator is consumed, so the text
+        is only scanned as far as needed.
+        """
+        cdef _ScanIterator iter = _ScanIterator(self, text, overlapping)
+        while iter.next():
+            yield iter.start, iter.end, self._trie._index_to_value(iter.data)
+
+    def findall(self, unicode text, overlapping=True):
+        """
+        Returns a list of ``(start, end, value)`` tuples for keys
+        found in ``text`` (see :meth:`finditer`).
+
+        The whole text is scanned at once with the GIL released.
+        """
+        if self._version != self._trie._version:
+            raise RuntimeError("trie changed after the scanner was created")
+
+        cdef Py_ssize_t length = len(text)
+        cdef cdatrie.AlphaChar* c_text = <cdatrie.AlphaChar*> malloc(
+            (length + 1) * sizeof(cdatrie.AlphaChar))
+        if c_text is NULL:
+            raise MemoryError()
+        cdef _ScanResults results = _ScanResults()
+        cdef list res = []
+        cdef Py_ssize_t i
+        cdef int error
+
+        try:
+            fill_alpha_char_from_unicode(text, c_text)
+            if not overlapping:
+                results.reserve_starts(length)
+            with nogil:
+                error = self._scan(c_text, length, results)
+            if error:
+                raise MemoryError()
+
+            for i in range(results.count):
+                res.append((
+                    results.starts[i], results.ends[i],
+                    self._trie._index_to_value(results.data[i])
+                ))
+            return res
+        finally:
+            free(c_text)
+
+    cdef int _scan(self, cdatrie.AlphaChar* text, Py_ssize_t length,
+                   _ScanResults results) noexcept nogil:
+        """
+        Finds keys in ``text``; returns -1 on memory error.
+        """
+        cdef Py_ssize_t i, start
+        cdef int node = 0
+        cdef int next_node, match
+        cdef bint longest = results.longest_ends is not NULL
+
+        for i in range(length):
+            while True:
+                next_node = self._goto(node, text[i])
+                if next_node:
+                    node = next_node
+                    break
+                if node == 0:
+                    break
+                node = self._fail[node]
+
+            match = node if self._terminal[node] else self._output[node]
+            while match:
+                start = i + 1 - self._depths[match]
+                if longest:
+                    # all matches ending here are shorter than any
+                    # match from the same start found later
+                    results.longest_ends[start] = i + 1
+                    results.longest_data[start] = self._data[match]
+                elif results.add(start, i + 1, self._data[match]):
+                    return -1
+                match = self._output[match]
+
+        if longest:
+            i = 0
+            while i < length:
+                if results.longest_ends[i]:
+                    if results.add(i, results.longest_ends[i],
+                                   results.longest_data[i]):
+                        return -1
+                    i = results.longest_ends[i]
+                else:
+                    i += 1
+        return 0
+
+
+cdef class _ScanIterator:
+    """
+    Lazy walk of a :class:`Scanner` automaton over a text
+    (see :meth:`Scanner.finditer`).
+
+    In non-overlapping mode the longest match of every start is kept
+    until no later match can start there, i.e. until the start is before
+    ``position - depth`` of the current node; matches are kept in a ring
+    buffer by start, which is as long as the longest key plus one.
+    """
+    cdef Scanner _scanner
+    cdef unicode _text
+    cdef Py_ssize_t _length
+    cdef Py_ssize_t _pos  # index of the next character
+    cdef int _node
+    cdef int _match  # next node on the output chain; 0 if none
+    cdef bint _overlapping
+    cdef Py_ssize_t _next_start  # matches starting before it are done
+    cdef int _ring_size
+    cdef Py_ssize_t* _ring_ends  # end of the longest match by start; 0 if none
+    cdef cdatrie.TrieData* _ring_data
+    cdef Py_ssize_t start
+    cdef Py_ssize_t end
+    cdef cdatrie.TrieData data
+
+    def __cinit__(self, Scanner scanner, unicode text, bint overlapping):
+        self._scanner = scanner
+        self._text = text
+        self._length = len(text)
+        self._overlapping = overlapping
+        if not overlapping:
+            # nodes are in breadth-first order, the last one is the deepest
+            self._ring_size = scanner._depths[scanner._size - 1] + 1
+            self._ring_ends = <Py_ssize_t*> calloc(self._ring_size,
+                                                   sizeof(Py_ssize_t))
+            self._ring_data = <cdatrie.TrieData*> malloc(
+                self._ring_size * sizeof(cdatrie.TrieData))
+            if self._ring_ends is NULL or self._ring_data is NULL:
+                raise MemoryError()
+
+    def __dealloc__(self):
+        free(self._ring_ends)
+        free(self._ring_data)
+
+    cdef bint next(self) except -1:
+        if self._scanner._version != self._scanner._trie._version:
+            raise RuntimeError("trie changed after the scanner was created")
+        if self._overlapping:
+            return self._next_overlapping()
+        return self._next_longest()
+
+    cdef void _step(self):
+        """
+        Walks the automaton by the next character.
+        """
+        cdef Scanner scanner = self._scanner
+        cdef cdatrie.AlphaChar char = self._text[self._pos]
+        cdef int node = self._node, next_node
+        while True:
+            next_node = scanner._goto(node, char)
+            if next_node:
+                node = next_node
+                break
+            if node == 0:
+                break
+            node = scanner._fail[node]
+        self._node = node
+        self._pos += 1
+        self._match = node if scanner._terminal[node] else scanner._output[node]
+
+    cdef bint _next_overlapping(self):
+        cdef Scanner scanner = self._scanner
+        while not self._match:
+            if self._pos == self._length:
+                return False
+            self._step()
+        self.start = self._pos - scanner._depths[self._match]
+        self.end = self._pos
+        self.data = scanner._data[self._match]
+        self._match = scanner._output[self._match]
+        return True
+
+    cdef bint _next_longest(self):
+        cdef Scanner scanner = self._scanner
+        cdef Py_ssize_t frontier, start, slot
+        while True:
+            if self._pos == self._length:
+                frontier = self._length
+            else:
+                frontier = self._pos - scanner._depths[self._node]
+            while self._next_start < frontier:
+                slot = self._next_start % self._ring_size
+                if self._ring_ends[slot]:
+                    self.start = self._next_start
+                    self.end = self._ring_ends[slot]
+                    self.data = self._ring_data[slot]
+                    # overlapping matches are skipped
+                    for start in range(self.start, self.end):
+                        self._ring_ends[start % self._ring_size] = 0
+                    self._next_start = self.end
+                    return True
+                self._next_start += 1
+            if self._pos == self._length:
+                return False
+
+            self._step()
+            while self._match:
+                # matches on the chain get shorter, later ones are longer
+                start = self._pos - scanner._depths[self._match]
+                if start >= self._next_start:
+                    slot = start % self._ring_size
+                    self._ring_ends[slot] = self._pos
+                    self._ring_data[slot] = scanner._data[self._match]
+                self._match = scanner._output[self._match]
+
+
+cdef inline bint _is_better_split(Py_ssize_t unknown, double score,
+                                  Py_ssize_t count, Py_ssize_t other_unknown,
+                                  double other_score,
+                                  Py_ssize_t other_count) nogil:
+    if unknown != other_unknown:
+        return unknown < other_unknown
+    if score != other_score:
+        return score > other_score
+    return count < other_count
+
+
+cdef class _Segmentation:
+    """
+    Split of a text into keys of a trie (see :meth:`BaseTrie.segment`).
+    Segment ``i`` ends at ``ends[i]``; ``known[i]`` tells whether
+    it is a key or a single character not covered by keys.
+    """
+    cdef BaseTrie _trie
+    cdef Py_ssize_t length
+    cdef cdatrie.AlphaChar* text
+    cdef Py_ssize_t count
+    cdef Py_ssize_t* ends
+    cdef char* known
+
+    def __cinit__(self, BaseTrie trie, unicode text):
+        self._trie = trie
+        self.length = len(text)
+        self.text = <cdatrie.AlphaChar*> malloc(
+            (self.length + 1) * sizeof(cdatrie.AlphaChar))
+        self.ends = <Py_ssize_t*> malloc((self.length + 1) * sizeof(Py_ssize_t))
+        self.known = <char*> malloc(self.length + 1)
+        if self.text is NULL or self.ends is NULL or self.known is NULL:
+            raise MemoryError()
+        fill_alpha_char_from_unicode(text, self.text)
+
+    def __dealloc__(self):
+        free(self.text)
+        free(self.ends)
+        free(self.known)
+
+    cdef int longest(self) except -1:
+        cdef cdatrie.TrieState* state = cdatrie.trie_root(self._trie._c_trie)
+        if state is NULL:
+            raise MemoryError()
+        try:
+            with nogil:
+                rwlock.datrie_rwlock_rdlock(&self._trie._lock)
+                self._longest(state)
+                rwlock.datrie_rwlock_rdunlock(&self._trie._lock)
+        finally:
+            cdatrie.trie_state_free(state)
+        return 0
+
+    cdef int _longest(self, cdatrie.TrieState* state) noexcept nogil:
+        cdef Py_ssize_t i = 0, j, end
+        self.count = 0
+        while i < self.length:
+            cdatrie.trie_state_rewind(state)
+            end = 0
+            j = i
+            while j < self.length and cdatrie.trie_state_walk(state, self.text[j]):
+                j += 1
+                if cdatrie.trie_state_is_terminal(state):
+                    end = j
+            self.known[self.count] = end != 0
+            i = end if end else i + 1
+            self.ends[self.count] = i
+            self.count += 1
+        return 0
+
+    cdef int best(self) except -1:
+        cdef _ScanResults edges = _ScanResults()
+        cdef Py_ssize_t size = self.length + 1
+        cdef double* weights = NULL
+        cdef double* scores = NULL
+        cdef Py_ssize_t* unknown = NULL
+        cdef Py_ssize_t* counts = NULL
+        cdef Py_ssize_t* starts = NULL
+        cdef int error
+        cdef cdatrie.TrieState* state = cdatrie.trie_root(self._trie._c_trie)
+        if state is NULL:
+            raise MemoryError()
+        try:
+            with nogil:
+                rwlock.datrie_rwlock_rdlock(&self._trie._lock)
+                error = self._find_keys(state, edges)
+                rwlock.datrie_rwlock_rdunlock(&self._trie._lock)
+            if error:
+                raise MemoryError()
+
+            weights = <double*> malloc((edges.count + 1) * sizeof(double))
+            scores = <double*> malloc(size * sizeof(double))
+            unknown = <Py_ssize_t*> malloc(size * sizeof(Py_ssize_t))
+            counts = <Py_ssize_t*> malloc(size * sizeof(Py_ssize_t))
+            starts = <Py_ssize_t*> malloc(size * sizeof(Py_ssize_t))
+            if (weights is NULL or scores is NULL or unknown is NULL
+                    or counts is NULL or starts is NULL):
+                raise MemoryError()
+            self._trie._data_to_weights(edges.data, weights, edges.count)
+
+            with nogil:
+                self._best(edges, weights, scores, unknown, counts, starts)
+        finally:
+            cdatrie.trie_state_free(state)
+            free(weights)
+            free(scores)
+            free(unknown)
+            free(counts)
+            free(starts)
+        return 0
+
+    cdef int _find_keys(self, cdatrie.TrieState* state,
+                        _ScanResults edges) noexcept nogil:
+        """
+        Finds all keys in the text ordered by start, then by end position;
+        returns -1 on memory error.
+        """
+        cdef Py_ssize_t i, j
+        for i in range(self.length):
+            cdatrie.trie_state_rewind(state)
+            j = i
+            while j < self.length and cdatrie.trie_state_walk(state, self.text[j]):
+                j += 1
+                if cdatrie.trie_state_is_terminal(state):
+                    if edges.add(i, j, cdatrie.trie_state_get_data(state)):
+                        return -1
+        return 0
+
+    cdef int _best(self, _ScanResults edges, double* weights, double* scores,
+                    Py_ssize_t* unknown, Py_ssize_t* counts,
+                    Py_ssize_t* starts) noexcept nogil:
+        # the best split of text[:i] has unknown[i] characters not covered
+        # by keys, the sum of values scores[i] and counts[i] segments;
+        # its last segment is text[starts[i]:i]
+        cdef Py_ssize_t i, end, k = 0
+        scores[0] = 0
+        unknown[0] = 0
+        counts[0] = 0
+        for i in range(1, self.length + 1):
+            unknown[i] = self.length + 1
+
+        for i in range(self.length):
+            if _is_better_split(unknown[i] + 1, scores[i], counts[i] + 1,
+                                unknown[i + 1], scores[i + 1], counts[i + 1]):
+                scores[i + 1] = scores[i]
+                unknown[i + 1] = unknown[i] + 1
+                counts[i + 1] = counts[i] + 1
+                starts[i + 1] = i
+            while k < edges.count and edges.starts[k] == i:
+                end = edges.ends[k]
+                if _is_better_split(unknown[i], scores[i] + weights[k],
+                                    counts[i] + 1, unknown[end], scores[end],
+                                    counts[end]):
+                    scores[end] = scores[i] + weights[k]
+                    unknown[end] = unknown[i]
+                    counts[end] = counts[i] + 1
+                    starts[end] = i
+                k += 1
+
+        self.count = counts[self.length]
+        end = self.length
+        for i in range(self.count - 1, -1, -1):
+            self.ends[i] = end
+            self.known[i] = unknown[end] == unknown[starts[end]]
+            end = starts[end]
+        return 0
+
+cdef class _KeyTree:
+    """
+    Keys of a trie as a tree of nodes in depth-first order, which
+    is also key order (see :meth:`BaseTrie.count`).
+
+    The subtree of node ``n`` is ``[n, ends[n])``; its first child
+    (if any) is ``n + 1`` and the next sibling of a child ``c``
+    is ``ends[c]``. ``ranks[n]`` is the number of keys in nodes
+    before ``n``.
+    """
+    cdef BaseTrie _trie
+    cdef unsigned long _version
+    cdef int _size  # number of nodes
+    cdef int _capacity
+    cdef int* _parents
+    cdef int* _ends
+    cdef int* _ranks
+    cdef cdatrie.AlphaChar* _labels
+    cdef char* _terminal
+    cdef cdatrie.TrieData* _data
+
+    def __cinit__(self, BaseTrie trie, *args):
+        self._trie = trie
+        self._version = trie._version
+        self._reserve(64)
+        self._build()
+
+    def __dealloc__(self):
+        free(self._parents)
+        free(self._ends)
+        free(self._ranks)
+        free(self._labels)
+        free(self._terminal)
+        free(self._data)
+
+    cdef Py_ssize_t _memory_size(self):
+        return (object.__sizeof__(self) + sizeof(int)
+                + self._capacity * (3 * sizeof(int) + 1
+                                    + sizeof(cdatrie.AlphaChar)
+                                    + sizeof(cdatrie.TrieData)))
+
+    cdef int _reserve(self, int size) except -1:
+        """
+        Makes room for ``size`` nodes (plus a sentinel in _ranks).
+        """
+        cdef int capacity = self._capacity or 1
+        cdef void* ptr
+        if size <= self._capacity:
+            return 0
+        while capacity < size:
+            capacity *= 2
+
+        ptr = realloc(self._parents, capacity * sizeof(int))
+        if ptr is NULL:
+            raise MemoryError()
+        self._parents = <int*> ptr
+        ptr = realloc(self._ends, capacity * sizeof(int))
+        if ptr is NULL:
+            raise MemoryError()
+        self._ends = <int*> ptr
+        ptr = realloc(self._ranks, (capacity + 1) * sizeof(int))
+        if ptr is NULL:
+            raise MemoryError()
+        self._ranks = <int*> ptr
+        ptr = realloc(self._labels, capacity * sizeof(cdatrie.AlphaChar))
+        if ptr is NULL:
+            raise MemoryError()
+        self._labels = <cdatrie.AlphaChar*> ptr
+        ptr = realloc(self._terminal, capacity)
+        if ptr is NULL:
+            raise MemoryError()
+        self._terminal = <char*> ptr
+        ptr = realloc(self._data, capacity * sizeof(cdatrie.TrieData))
+        if ptr is NULL:
+            raise MemoryError()
+        self._data = <cdatrie.TrieData*> ptr
+
+        self._capacity = capacity
+        return 0
+
+    cdef int _build(self) except -1:
+        cdef BaseIterator iter = BaseIterator(BaseState(self._trie))
+        cdef cdatrie.AlphaChar* key
+        cdef int* path = NULL  # nodes of the previous key by depth
+        cdef int length, prev_length = 0, capacity = 0, common, depth, node
+        cdef int rank = 0
+        cdef void* ptr
+
+        self._size = 1
+        self._parents[0] = -1
+        self._labels[0] = 0
+        self._terminal[0] = 0
+        try:
+            path = <int*> malloc(sizeof(int))
+            if path is NULL:
+                raise MemoryError()
+            path[0] = 0
+
+            # keys come in order, so new nodes are appended in depth-first order
+            while iter.next():
+                key = cdatrie.trie_iterator_get_key(iter._iter)
+                if key is NULL:
+                    raise MemoryError()
+                try:
+                    length = cdatrie.alpha_char_strlen(key)
+                    if length > capacity:
+                        capacity = 2 * length
+                        ptr = realloc(path, (capacity + 1) * sizeof(int))
+                        if ptr is NULL:
+                            raise MemoryError()
+                        path = <int*> ptr
+
+                    common = 0
+                    while (common < length and common < prev_length
+                           and key[common] == self._labels[path[common + 1]]):
+                        common += 1
+                    for depth in range(prev_length, common, -1):
+                        self._ends[path[depth]] = self._size
+
+                    self._reserve(self._size + length - common)
+                    for depth in range(common, length):
+                        node = self._size
+                        self._parents[node] = path[depth]
+                        self._labels[node] = key[depth]
+                        self._terminal[node] = 0
+                        path[depth + 1] = node
+                        self._size += 1
+                finally:
+                    free(key)
+
+                node = path[length]
+                self._terminal[node] = 1
+                self._data[node] = iter.data()
+                prev_length = length
+
+            for depth in range(prev_length, -1, -1):
+                self._ends[path[depth]] = self._size
+        finally:
+            free(path)
+
+        for node in range(self._size):
+            self._ranks[node] = rank
+            rank += self._terminal[node]
+        self._ranks[self._size] = rank
+        return 0
+
+    cdef int _child(self, int node, cdatrie.AlphaChar char):
+        """
+        Returns the child of ``node`` by ``char`` or, if there is none,
+        the first child with a larger character (``ends[node]``
+        if there are no such children).
+        """
+        cdef int child = node + 1
+        while child < self._ends[node] and self._labels[child] < char:
+            child = self._ends[child]
+        return child
+
+    cdef int find(self, unicode prefix):
+        """
+        Returns the node of ``prefix`` or -1.
+        """
+        cdef int node = 0, child
+        cdef Py_UCS4 char
+        for char in prefix:
+            child = self._child(node, char)
+            if child == self._ends[node] or self._labels[child] != char:
+                return -1
+            node = child
+        return node
+
+    cdef int count(self, unicode prefix):
+        cdef int node = self.find(prefix)
+        if node < 0:
+            return 0
+        return self._ranks[self._ends[node]] - self._ranks[node]
+
+    cdef int rank(self, unicode key):
+        """
+        Returns the number of keys less than ``key``.
+        """
+        cdef int node = 0, child
+        cdef Py_UCS4 char
+        for char in key:
+            child = self._child(node, char)
+            if child == self._ends[node] or self._labels[child] != char:
+                # all keys of the subtrees before child are less than key
+                return self._ranks[child]
+            node = child
+        return self._ranks[node]
+
+    cdef int select(self, int rank):
+        """
+        Returns the terminal node with ``rank`` keys before it
+        (``0 <= rank < number of keys``).
+        """
+        cdef int low = 0, high = self._size - 1, middle
+        # it is the last node with ranks[node] <= rank
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self._ranks[middle] <= rank:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    cdef unicode node_key(self, int node):
+        cdef int depth = 0, i = node
+        cdef cdatrie.AlphaChar* key
+        while i:
+            depth += 1
+            i = self._parents[i]
+        key = <cdatrie.AlphaChar*> malloc((depth + 1) * sizeof(cdatrie.AlphaChar))
+        if key is NULL:
+            raise MemoryError()
+        try:
+            i = depth
+            while node:
+                i -= 1
+                key[i] = self._labels[node]
+                node = self._parents[node]
+            return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, key, depth)
+        finally:
+            free(key)
+
+
+cdef class _TopKIndex(_KeyTree):
+    """
+    Key tree with the largest value in every subtree
+    (see :meth:`BaseTrie.top_k`).
+    """
+    cdef object _key
+    cdef double* _scores  # values of keys of terminal nodes
+    cdef double* _best  # the largest score in the subtree
+
+    # best-first search heap
+    cdef int _heap_size
+    cdef int _heap_capacity
+    cdef double* _heap_scores
+    cdef int* _heap_nodes
+    cdef char* _heap_items  # 1 for a key, 0 for a subtree
+
+    def __cinit__(self, BaseTrie trie, key):
+        cdef int node
+        self._key = key
+        self._scores = <double*> malloc(self._size * sizeof(double))
+        self._best = <double*> malloc(self._size * sizeof(double))
+        if self._scores is NULL or self._best is NULL:
+            raise MemoryError()
+        self._compute_scores()
+
+        for node in range(self._size):
+            self._best[node] = (self._scores[node] if self._terminal[node]
+                                else -INFINITY)
+        for node in range(self._size - 1, 0, -1):
+            if self._best[node] > self._best[self._parents[node]]:
+                self._best[self._parents[node]] = self._best[node]
+
+    def __dealloc__(self):
+        free(self._scores)
+        free(self._best)
+        free(self._heap_scores)
+        free(self._heap_nodes)
+        free(self._heap_items)
+
+    cdef Py_ssize_t _memory_size(self):
+        return (_KeyTree._memory_size(self)
+                + self._size * 2 * sizeof(double)
+                + self._heap_capacity * (sizeof(double) + sizeof(int) + 1))
+
+    cdef bint is_current(self, key):
+        return self._version == self._trie._version and self._key is key
+
+    cdef int update(self, unicode key, cdatrie.TrieData data) except -1:
+        """
+        Sets the data of ``key`` and updates the largest scores
+        of its node and of its ancestors.
+        """
+        cdef int node = self.find(key), child
+        cdef double score
+        if node < 0 or not self._terminal[node]:
+            return 0
+        if self._key is None:
+            self._trie._data_to_weights(&data, &score, 1)
+        else:
+            score = self._key(self._trie._index_to_value(data))
+        self._data[node] = data
+        self._scores[node] = score
+
+        while True:
+            score = self._scores[node] if self._terminal[node] else -INFINITY
+            child = node + 1
+            while child < self._ends[node]:
+                if self._best[child] > score:
+                    score = self._best[child]
+                child = self._ends[child]
+            if score == self._best[node]:
+                break  # the ancestors are not changed
+            self._best[node] = score
+            if node == 0:
+                break
+            node = self._parents[node]
+        return 0
+
+    cdef int _compute_scores(self) except -1:
+        cdef int key_count = self._ranks[self._size]
+        cdef cdatrie.TrieData* data = <cdatrie.TrieData*> malloc(
+            (key_count + 1) * sizeof(cdatrie.TrieData))
+        cdef double* weights = <double*> malloc((key_count + 1) * sizeof(double))
+        cdef int node, i = 0
+        try:
+            if data is NULL or weights is NULL:
+                raise MemoryError()
+            for node in range(self._size):
+                if self._terminal[node]:
+                    data[i] = self._data[node]
+                    i += 1
+
+            if self._key is None:
+                self._trie._data_to_weights(data, weights, key_count)
+            else:
+                for i in range(key_count):
+                    weights[i] = self._key(self._trie._index_to_value(data[i]))
+
+            i = 0
+            for node in range(self._size):
+                if self._terminal[node]:
+                    self._scores[node] = weights[i]
+                    i += 1
+        finally:
+            free(data)
+            free(weights)
+        return 0
+
+    cdef int _push(self, double score, int node, char item) except -1:
+        cdef int i, parent, capacity
+        cdef void* ptr
+        if self._heap_size == self._heap_capacity:
+            capacity = 2 * self._heap_capacity or 64
+            ptr = realloc(self._heap_scores, capacity * sizeof(double))
+            if ptr is NULL:
+                raise MemoryError()
+            self._heap_scores = <double*> ptr
+            ptr = realloc(self._heap_nodes, capacity * sizeof(int))
+            if ptr is NULL:
+                raise MemoryError()
+            self._heap_nodes = <int*> ptr
+            ptr = realloc(self._heap_items, capacity)
+            if ptr is NULL:
+                raise MemoryError()
+            self._heap_items = <char*> ptr
+            self._heap_capacity = capacity
+
+        i = self._heap_size
+        self._heap_size += 1
+        while i:
+            parent = (i - 1) // 2
+            if not self._heap_before(score, node, parent):
+                break
+            self._heap_move(parent, i)
+            i = parent
+        self._heap_scores[i] = score
+        self._heap_nodes[i] = node
+        self._heap_items[i] = item
+        return 0
+
+    cdef inline bint _heap_before(self, double score, int node, int i):
+        # larger scores first; entries with equal scores in key order
+        if score != self._heap_scores[i]:
+            return score > self._heap_scores[i]
+        return node < self._heap_nodes[i]
+
+    cdef inline void _heap_move(self, int source, int target):
+        self._heap_scores[target] = self._heap_scores[source]
+        self._heap_nodes[target] = self._heap_nodes[source]
+        self._heap_items[target] = self._heap_items[source]
+
+    cdef void _pop(self):
+        """
+        Removes the top entry (``_heap_*[0]``) from the heap.
+        """
+        cdef int i = 0, child
+        cdef int last = self._heap_size - 1
+        cdef double score = self._heap_scores[last]
+        cdef int node = self._heap_nodes[last]
+        cdef char item = self._heap_items[last]
+        self._heap_size = last
+        while True:
+            child = 2 * i + 1
+            if child >= last:
+                break
+            if (child + 1 < last and self._heap_before(
+                    self._heap_scores[child + 1], self._heap_nodes[child + 1],
+                    child)):
+                child += 1
+            if self._heap_before(score, node, child):
+                break
+            self._heap_move(child, i)
+            i = child
+        if last:
+            self._heap_scores[i] = score
+            self._heap_nodes[i] = node
+            self._heap_items[i] = item
+
+    cdef list search(self, unicode prefix, int k):
+        """
+        Returns a list of up to ``k`` items with keys prefixed by
+        ``prefix`` and the largest scores.
+        """
+        cdef list res = []
+        cdef int node = self.find(prefix), child
+        cdef char item
+
+        if node < 0:
+            return res
+        self._heap_size = 0
+        self._push(self._best[node], node, 0)
+        while self._heap_size and len(res) < k:
+            node = self._heap_nodes[0]
+            item = self._heap_items[0]
+            self._pop()
+            if item:
+                res.append((self.node_key(node),
+                            self._trie._index_to_value(self._data[node])))
+                continue
+
+            if self._terminal[node]:
+                self._push(self._scores[node], node, 1)
+            child = node + 1
+            while child < self._ends[node]:
+                self._push(self._best[child], child, 0)
+                child = self._ends[child]
+        return res
+
+
+cdef class _FuzzySearch:
+    """
+    Depth-first walk over a trie which computes a row of the edit
+    distance matrix (key prefix vs. query prefixes) for every visited
+    node and skips subtrees once all row values exceed the bound.
+    """
+    cdef BaseTrie _trie
+    cdef cdatrie.AlphaChar* _query
+    cdef int _query_len
+    cdef int _max_depth
+    cdef int _bound
+    cdef bint _transpositions
+    cdef Py_ssize_t _limit
+    cdef cdatrie.TrieState** _states  # state per depth
+    cdef int* _rows  # distance matrix row per depth
+    cdef cdatrie.AlphaChar* _key
+    cdef Py_ssize_t* _counts  # number of results per distance
+    cdef list _results
+
+    def __cinit__(self, BaseTrie trie, unicode query, int max_distance,
+                  bint transpositions, limit):
+        if max_distance < 0:
+            raise ValueError("max_distance must be non-negative")
+        if limit is not None and limit < 0:
+            raise ValueError("limit must be non-negative")
+
+        self._trie = trie
+        self._query_len = len(query)
+        self._max_depth = self._query_len + max_distance
+        self._bound = max_distance
+        self._transpositions = transpositions
+        self._limit = -1 if limit is None else limit
+        self._results = []
+
+        self._query = <cdatrie.AlphaChar*> malloc(
+            (self._query_len + 1) * sizeof(cdatrie.AlphaChar))
+        self._key = <cdatrie.AlphaChar*> malloc(
+            (self._max_depth + 1) * sizeof(cdatrie.AlphaChar))
+        self._rows = <int*> malloc(
+            (self._max_depth + 1) * (self._query_len + 1) * sizeof(int))
+        self._counts = <Py_ssize_t*> malloc(
+            (max_distance + 1) * sizeof(Py_ssize_t))
+        self._states = <cdatrie.TrieState**> malloc(
+            (self._max_depth + 1) * sizeof(cdatrie.TrieState*))
+        if (self._query is NULL or self._key is NULL or self._rows is NULL
+                or self._counts is NULL or self._states is NULL):
+            raise MemoryError()
+
+        fill_alpha_char_from_unicode(query, self._query)
+        string.memset(self._counts, 0, (max_distance + 1) * sizeof(Py_ssize_t))
+        string.memset(self._states, 0,
+                      (self._max_depth + 1) * sizeof(cdatrie.TrieState*))
+
+        cdef int i
+        for i in range(self._max_depth + 1):
+            self._states[i] = cdatrie.trie_root(trie._c_trie)
+            if self._states[i] is NULL:
+                raise MemoryError()
+
+    def __dealloc__(self):
+        cdef int i
+        if self._states is not NULL:
+            for i in range(self._max_depth + 1):
+                if self._states[i] is not NULL:
+                    cdatrie.trie_state_free(self._states[i])
+        free(self._states)
+        free(self._query)
+        free(self._key)
+        free(self._rows)
+        free(self._counts)
+
+    cdef list run(self):
+        """
+        Returns a list of ``(key, data)`` tuples sorted by distance.
+        """
+        cdef int i
+        for i in range(self._query_len + 1):
+            self._rows[i] = i
+        if self._limit != 0:
+            self._walk(0)
+
+        results = sorted(self._results, key=operator.itemgetter(0))
+        if self._limit >= 0:
+            results = results[:self._limit]
+        return [(key, data) for distance, key, data in results
+                if distance <= self._bound]
+
+    cdef int _walk(self, int depth) except -1:
+        cdef cdatrie.TrieState* state = self._states[depth]
+        cdef int* row = self._rows + depth * (self._query_len + 1)
+        cdef cdatrie.AlphaChar chars[256]
+        cdef int count = cdatrie.trie_state_walkable_chars(state, chars, 256)
+        cdef int i
+
+        for i in range(count):
+            if chars[i] == 0:
+                # the key ends here
+                if row[self._query_len] <= self._bound:
+                    self._add_result(depth, row[self._query_len],
+                                     cdatrie.trie_state_get_data(state))
+            elif depth < self._max_depth:
+                self._key[depth] = chars[i]
+                if self._fill_row(depth + 1) <= self._bound:
+                    cdatrie.trie_state_copy(self._states[depth + 1], state)
+                    cdatrie.trie_state_walk(self._states[depth + 1], chars[i])
+                    self._walk(depth + 1)
+        return 0
+
+    cdef int _fill_row(self, int depth):
+        """
+        Computes the distance matrix row for the key prefix
+        of length ``depth``; returns its minimal value.
+        """
+        cdef int width = self._query_len + 1
+        cdef int* row = self._rows + depth * width
+        cdef int* prev = row - width
+        cdef cdatrie.AlphaChar char = self._key[depth - 1]
+        cdef int i, cost, value
+        cdef int min_value = depth
+
+        row[0] = depth
+        for i in range(1, width):
+            cost = 0 if self._query[i - 1] == char else 1
+            value = prev[i - 1] + cost
+            if prev[i] + 1 < value:
+                value = prev[i] + 1
+            if row[i - 1] + 1 < value:
+                value = row[i - 1] + 1
+            if (self._transpositions and i > 1 and depth > 1
+                    and self._query[i - 2] == char
+                    and self._query[i - 1] == self._key[depth - 2]
+                    and prev[i - 2 - width] + 1 < value):
+                value = prev[i - 2 - width] + 1
+            row[i] = value
+            if value < min_value:
+                min_value = value
+        return min_value
+
+    cdef int _add_result(self, int depth, int distance,
+                         cdatrie.TrieData data) except -1:
+        cdef unicode key = PyUnicode_FromKindAndData(
+            PyUnicode_4BYTE_KIND, self._key, depth)
+        self._results.append((distance, key, data))
+        if self._limit < 0:
+            return 0
+
+        # there are enough results within a smaller distance
+        # to skip keys which are further away
+        self._counts[distance] += 1
+        cdef Py_ssize_t total = 0
+        cdef int d
+        for d in range(self._bound + 1):
+            total += self._counts[d]
+            if total >= self._limit:
+                self._bound = d
+                break
+        return 0
+
+
+cdef class _RangeIterator:
+    """
+    Depth-first walk over keys of a subtree which starts at a bound:
+    the lower bound in key order or the upper bound in reverse order.
+
+    The walk descends along the bound (``seek`` is relative to the
+    subtree root); in key order subtrees to the right of it are
+    enumerated by ``BaseIterator``. The walk stops at the other bound
+    (``stop``) or after ``limit`` keys.
+    """
+    cdef BaseTrie _trie
+    cdef unsigned long _version
+    cdef bint _reverse
+    cdef unicode _prefix
+    cdef cdatrie.AlphaChar* _seek
+    cdef int _seek_length  # -1 if there is no bound to seek
+    cdef bint _seek_inclusive
+    cdef unicode _stop
+    cdef bint _stop_inclusive
+    cdef Py_ssize_t _limit  # -1 if there is no limit
+    cdef bint _done
+
+    # per-depth walk stack
+    cdef int _depth
+    cdef int _capacity
+    cdef cdatrie.TrieState** _states
+    cdef cdatrie.AlphaChar* _children  # children to visit; 256 per depth
+    cdef int* _counts
+    cdef int* _indices  # next child to visit (counts down in reverse order)
+    cdef char* _on_bound  # the node is a prefix of the bound
+    cdef cdatrie.AlphaChar* _key
+
+    cdef BaseIterator _subtree
+    cdef unicode _subtree_prefix
+
+    cdef readonly unicode key
+    cdef readonly cdatrie.TrieData data
+
+    def __cinit__(self, BaseState state, unicode prefix, unicode seek,
+                  bint seek_inclusive, unicode stop, bint stop_inclusive,
+                  Py_ssize_t limit, bint reverse):
+        self._trie = state._trie
+        self._version = self._trie._version
+        self._reverse = reverse
+        self._prefix = prefix
+        self._seek_inclusive = seek_inclusive
+        self._stop = stop
+        self._stop_inclusive = stop_inclusive
+        self._limit = limit
+        self._seek_length = -1
+        if seek is not None:
+            self._seek_length = len(seek)
+            self._seek = new_alpha_char_from_unicode(seek)
+
+        self._grow(16)
+        self._states[0] = cdatrie.trie_state_clone(state._state)
+        if self._states[0] is NULL:
+            raise MemoryError()
+        self._on_bound[0] = self._seek_length >= 0
+        self._depth = 0
+        self._enter(0)
+
+    def __dealloc__(self):
+        cdef int i
+        if self._states is not NULL:
+            for i in range(self._capacity):
+                if self._states[i] is not NULL:
+                    cdatrie.trie_state_free(self._states[i])
+        free(self._states)
+        free(self._children)
+        free(self._counts)
+        free(self._indices)
+        free(self._on_bound)
+        free(self._key)
+        free(self._seek)
+
+    cdef int _grow(self, int capacity) except -1:
+        """
+        Makes room for ``capacity`` levels of the walk stack.
+        """
+        cdef int i
+        cdef void* ptr
+
+        ptr = realloc(self._states, capacity * sizeof(cdatrie.TrieState*))
+        if ptr is NULL:
+            raise MemoryError()
+        self._states = <cdatrie.TrieState**> ptr
+        for i in range(self._capacity, capacity):
+            self._states[i] = NULL
+        self._capacity = capacity
+
+        ptr = realloc(self._children, capacity * 256 * sizeof(cdatrie.AlphaChar))
+        if ptr is NULL:
+            raise MemoryError()
+        self._children = <cdatrie.AlphaChar*> ptr
+        ptr = realloc(self._counts, capacity * sizeof(int))
+        if ptr is NULL:
+            raise MemoryError()
+        self._counts = <int*> ptr
+        ptr = realloc(self._indices, capacity * sizeof(int))
+        if ptr is NULL:
+            raise MemoryError()
+        self._indices = <int*> ptr
+        ptr = realloc(self._on_bound, capacity)
+        if ptr is NULL:
+            raise MemoryError()
+        self._on_bound = <char*> ptr
+        ptr = realloc(self._key, capacity * sizeof(cdatrie.AlphaChar))
+        if ptr is NULL:
+            raise MemoryError()
+        self._key = <cdatrie.AlphaChar*> ptr
+        return 0
+
+    cdef void _enter(self, int depth):
+        """
+        Lists children of the state at ``depth`` (terminal first) and
+        skips the ones which are out of the bound.
+        """
+        cdef cdatrie.AlphaChar* children = self._children + depth * 256
+        cdef int count = cdatrie.trie_state_walkable_chars(
+            self._states[depth], children, 256)
+        cdef int index
+        cdef cdatrie.AlphaChar char
+
+        self._counts[depth] = count
+        index = count - 1 if self._reverse else 0
+        if self._on_bound[depth]:
+            if depth == self._seek_length:
+                # the terminal is the bound itself; other children are
+                # greater than the bound
+                if self._reverse:
+                    index = 0 if (self._seek_inclusive and count
+                                  and children[0] == 0) else -1
+                elif not self._seek_inclusive and count and children[0] == 0:
+                    index = 1
+            else:
+                char = self._seek[depth]
+                if self._reverse:
+                    while index >= 0 and children[index] > char:
+                        index -= 1
+                else:
+                    while index < count and children[index] < char:
+                        index += 1
+        self._indices[depth] = index
+
+    cpdef bint next(self) except -1:
+        if self._done or self._limit == 0 or not self._walk():
+            self._done = True
+            return False
+
+        if self._stop is not None:
+            if self._reverse:
+                self._done = self.key < self._stop
+            else:
+                self._done = self.key > self._stop
+            if self.key == self._stop:
+                self._done = not self._stop_inclusive
+            if self._done:
+                return False
+        if self._limit > 0:
+            self._limit -= 1
+        return True
+
+    cdef bint _walk(self) except -1:
+        cdef int depth
+        cdef cdatrie.AlphaChar char
+        cdef BaseState subtree_state
+
+        if self._version != self._trie._version:
+            raise RuntimeError("trie changed size during iteration")
+
+        while True:
+            if self._subtree is not None:
+                if self._subtree.next():
+                    self.key = self._subtree_prefix + self._subtree.key()
+                    self.data = self._subtree.data()
+                    return True
+                self._subtree = None
+                continue
+
+            depth = self._depth
+            if depth < 0:
+                return False
+            if self._indices[depth] < 0 or self._indices[depth] == self._counts[depth]:
+                self._depth -= 1
+                continue
+
+            char = self._children[depth * 256 + self._indices[depth]]
+            self._indices[depth] += -1 if self._reverse else 1
+            if char == 0:
+                self.key = self._prefix + PyUnicode_FromKindAndData(
+                    PyUnicode_4BYTE_KIND, self._key, depth)
+                self.data = cdatrie.trie_state_get_data(self._states[depth])
+                return True
+
+            if depth + 1 == self._capacity:
+                self._grow(2 * self._capacity)
+            if self._states[depth + 1] is NULL:
+                self._states[depth + 1] = cdatrie.trie_state_clone(
+                    self._states[depth])
+                if self._states[depth + 1] is NULL:
+                    raise MemoryError()
+            else:
+                cdatrie.trie_state_copy(self._states[depth + 1],
+                                        self._states[depth])
+            cdatrie.trie_state_walk(self._states[depth + 1], char)
+            self._key[depth] = char
+            self._on_bound[depth + 1] = (
+                self._on_bound[depth] and depth < self._seek_length
+                and char == self._seek[depth]
+            )
+
+            if not self._reverse and not self._on_bound[depth + 1]:
+                # the whole subtree is in the range
+                subtree_state = BaseState(self._trie)
+                cdatrie.trie_state_copy(subtree_state._state,
+                                        self._states[depth + 1])
+                self._subtree = BaseIterator(subtree_state)
+                self._subtree_prefix = self._prefix + PyUnicode_FromKindAndData(
+                    PyUnicode_4BYTE_KIND, self._key, depth + 1)
+                continue
+
+            self._depth = depth + 1
+            self._enter(depth + 1)
+
+def _parse_pattern(unicode pattern):
+    """
+    Parses a glob pattern to a list of ``(kind, argument)`` tokens.
+    The argument is a character code for literals and a list of
+    ``(begin, end)`` code ranges for character classes.
+    """
+    cdef list tokens = []
+    cdef Py_ssize_t i = 0, end, k
+    cdef Py_ssize_t length = len(pattern)
+
+    while i < length:
+        char = pattern[i]
+        i += 1
+        if char == '*':
+            if not tokens or tokens[-1][0] != PATTERN_STAR:
+                tokens.append((PATTERN_STAR, None))
+        elif char == '?':
+            tokens.append((PATTERN_ANY, None))
+        elif char == '[':
+            # like fnmatch: ']' right after '[' or '[!' is a literal
+            end = i
+            if end < length and pattern[end] in '!^':
+                end += 1
+            if end < length and pattern[end] == ']':
+                end += 1
+            end = pattern.find(']', end)
+            if end == -1:
+                tokens.append((PATTERN_LITERAL, ord(char)))
+                continue
+
+            body = pattern[i:end]
+            i = end + 1
+            kind = PATTERN_CLASS
+            if body[0] in '!^':
+                kind = PATTERN_NEGATED_CLASS
+                body = body[1:]
+
+            ranges = []
+            k = 0
+            while k < len(body):
+                if k + 2 < len(body) and body[k + 1] == '-':
+                    ranges.append((ord(body[k]), ord(body[k + 2])))
+                    k += 3
+                else:
+                    ranges.append((ord(body[k]), ord(body[k])))
+                    k += 1
+            tokens.append((kind, ranges))
+        else:
+            tokens.append((PATTERN_LITERAL, ord(char)))
+
+    return tokens
+
+
+cdef class _MatchIterator:
+    """
+    Depth-first walk over trie keys matching a glob pattern.
+
+    Pattern is matched by a nondeterministic automaton: for each depth
+    the walk keeps a set of active pattern positions and descends only
+    into children which leave some positions active. Subtrees where
+    the rest of the pattern is ``*`` are enumerated by ``BaseIterator``.
+    """
+    cdef BaseTrie _trie
+    cdef unsigned long _version
+    cdef int _size  # number of pattern tokens
+    cdef int* _kinds
+    cdef cdatrie.AlphaChar* _chars  # literal characters
+    cdef int* _class_offsets  # token's ranges are in [offsets[i], offsets[i+1])
+    cdef cdatrie.AlphaChar* _ranges  # (begin, end) pairs
+
+    # per-depth walk stack
+    cdef int _depth
+    cdef int _capacity
+    cdef cdatrie.TrieState** _states
+    cdef char* _active  # active pattern positions; _size + 1 per depth
+    cdef cdatrie.AlphaChar* _children  # children to visit; 256 per depth
+    cdef int* _counts
+    cdef int* _indices
+    cdef cdatrie.AlphaChar* _key
+
+    cdef BaseIterator _subtree
+    cdef unicode _prefix
+
+    cdef readonly unicode key
+    cdef readonly cdatrie.TrieData data
+
+    def __cinit__(self, BaseTrie trie, unicode pattern):
+        cdef list tokens = _parse_pattern(pattern)
+        cdef int i, k, range_count = 0
+        self._trie = trie
+        self._version = trie._version
+        self._size = len(tokens)
+
+        for kind, arg in tokens:
+            if kind == PATTERN_CLASS or kind == PATTERN_NEGATED_CLASS:
+                range_count += len(arg)
+
+        self._kinds = <int*> malloc((self._size + 1) * sizeof(int))
+        self._chars = <cdatrie.AlphaChar*> malloc(
+            (self._size + 1) * sizeof(cdatrie.AlphaChar))
+        self._class_offsets = <int*> malloc((self._size + 1) * sizeof(int))
+        self._ranges = <cdatrie.AlphaChar*> malloc(
+            (2 * range_count + 1) * sizeof(cdatrie.AlphaChar))
+        if (self._kinds is NULL or self._chars is NULL
+                or self._class_offsets is NULL or self._ranges is NULL):
+            raise MemoryError()
+
+        range_count = 0
+        for i, (kind, arg) in enumerate(tokens):
+            self._kinds[i] = kind
+            self._chars[i] = arg if kind == PATTERN_LITERAL else 0
+            self._class_offsets[i] = range_count
+            if kind == PATTERN_CLASS or kind == PATTERN_NEGATED_CLASS:
+                for begin, end in arg:
+                    self._ranges[2 * range_count] = begin
+                    self._ranges[2 * range_count + 1] = end
+                    range_count += 1
+        self._class_offsets[self._size] = range_count
+
+        self._grow(16)
+        self._states[0] = cdatrie.trie_root(trie._c_trie)
+        if self._states[0] is NULL:
+            raise MemoryError()
+        self._active[0] = 1
+        self._close(self._active)
+        self._depth = 0
+        self._enter(0)
+
+    def __dealloc__(self):
+        cdef int i
+        if self._states is not NULL:
+            for i in range(self._capacity):
+                if self._states[i] is not NULL:
+                    cdatrie.trie_state_free(self._states[i])
+        free(self._states)
+        free(self._active)
+        free(self._children)
+        free(self._counts)
+        free(self._indices)
+        free(self._key)
+        free(self._kinds)
+        free(self._chars)
+        free(self._class_offsets)
+        free(self._ranges)
+
+    cdef int _grow(self, int capacity) except -1:
+        """
+        Makes room for ``capacity`` levels of the walk stack.
+        """
+        cdef int width = self._size + 1
+        cdef int old_capacity = self._capacity
+        cdef int i
+        cdef void* ptr
+
+        ptr = realloc(self._states, capacity * sizeof(cdatrie.TrieState*))
+        if ptr is NULL:
+            raise MemoryError()
+        self._states = <cdatrie.TrieState**> ptr
+        for i in range(old_capacity, capacity):
+            self._states[i] = NULL
+        self._capacity = capacity
 
+        ptr = realloc(self._active, capacity * width)
+        if ptr is NULL:
+            raise MemoryError()
+        self._active = <char*> ptr
+        ptr = realloc(self._children, capacity * 256 * sizeof(cdatrie.AlphaChar))
+        if ptr is NULL:
+            raise MemoryError()
+        self._children = <cdatrie.AlphaChar*> ptr
+        ptr = realloc(self._counts, capacity * sizeof(int))
+        if ptr is NULL:
+            raise MemoryError()
+        self._counts = <int*> ptr
+        ptr = realloc(self._indices, capacity * sizeof(int))
+        if ptr is NULL:
+            raise MemoryError()
+        self._indices = <int*> ptr
+        ptr = realloc(self._key, capacity * sizeof(cdatrie.AlphaChar))
+        if ptr is NULL:
+            raise MemoryError()
+        self._key = <cdatrie.AlphaChar*> ptr
+
+        string.memset(self._active + old_capacity * width, 0,
+                      (capacity - old_capacity) * width)
+        return 0
+
+    cdef void _close(self, char* active):
+        # '*' matches an empty string
+        cdef int i
+        for i in range(self._size):
+            if active[i] and self._kinds[i] == PATTERN_STAR:
+                active[i + 1] = 1
+
+    cdef bint _matches(self, int i, cdatrie.AlphaChar char):
+        cdef int kind = self._kinds[i]
+        cdef int k
+        cdef bint found = False
+        if kind == PATTERN_LITERAL:
+            return char == self._chars[i]
+        if kind == PATTERN_ANY:
+            return True
+        for k in range(self._class_offsets[i], self._class_offsets[i + 1]):
+            if self._ranges[2 * k] <= char <= self._ranges[2 * k + 1]:
+                found = True
+                break
+        return found != (kind == PATTERN_NEGATED_CLASS)
 
-cdef (cdatrie.Trie* ) _load_from_file(f) except NULL:
-    cdef int fd = f.fileno()
-    cdef stdio.FILE* f_ptr = stdio_ext.fdopen(fd, "r")
-    if f_ptr == NULL:
-        raise IOError()
-    cdef cdatrie.Trie* trie = cdatrie.trie_fread(f_ptr)
-    if trie == NULL:
-        raise DatrieError("Can't load trie from stream")
+    cdef bint _step(self, int depth, cdatrie.AlphaChar char):
+        """
+        Computes active positions for ``depth + 1`` after ``char``;
+        returns False if there are none.
+        """
+        cdef int width = self._size + 1
+        cdef char* active = self._active + depth * width
+        cdef char* next_active = active + width
+        cdef bint found = False
+        cdef int i
+
+        string.memset(next_active, 0, width)
+        for i in range(self._size):
+            if not active[i]:
+                continue
+            if self._kinds[i] == PATTERN_STAR:
+                next_active[i] = 1
+                found = True
+            elif self._matches(i, char):
+                next_active[i + 1] = 1
+                found = True
+        self._close(next_active)
+        return found
+
+    cdef int _enter(self, int depth) except -1:
+        """
+        Prepares the list of children to visit for the state at ``depth``.
+        """
+        cdef cdatrie.TrieState* state = self._states[depth]
+        cdef char* active = self._active + depth * (self._size + 1)
+        cdef cdatrie.AlphaChar* children = self._children + depth * 256
+        cdef bint literals_only = True
+        cdef int i, k, count = 0
+        cdef cdatrie.AlphaChar char
+        cdef BaseState subtree_state
+
+        self._indices[depth] = 0
+        if (self._size and self._kinds[self._size - 1] == PATTERN_STAR
+                and active[self._size - 1]):
+            # all keys in the subtree match
+            subtree_state = BaseState(self._trie)
+            cdatrie.trie_state_copy(subtree_state._state, state)
+            self._subtree = BaseIterator(subtree_state)
+            self._prefix = PyUnicode_FromKindAndData(
+                PyUnicode_4BYTE_KIND, self._key, depth)
+            self._counts[depth] = 0
+            return 0
+
+        for i in range(self._size):
+            if active[i] and self._kinds[i] != PATTERN_LITERAL:
+                literals_only = False
+                break
+
+        if not literals_only:
+            self._counts[depth] = cdatrie.trie_state_walkable_chars(
+                state, children, 256)
+            return 0
+
+        # walk pattern characters instead of listing all children
+        if active[self._size] and cdatrie.trie_state_is_terminal(state):
+            children[count] = 0
+            count += 1
+        for i in range(self._size):
+            if not active[i]:
+                continue
+            char = self._chars[i]
+            if not cdatrie.trie_state_is_walkable(state, char):
+                continue
+            # insert keeping children sorted and unique
+            k = count
+            while k > 0 and children[k - 1] > char:
+                k -= 1
+            if k > 0 and children[k - 1] == char:
+                continue
+            string.memmove(children + k + 1, children + k,
+                           (count - k) * sizeof(cdatrie.AlphaChar))
+            children[k] = char
+            count += 1
+        self._counts[depth] = count
+        return 0
+
+    cpdef bint next(self) except -1:
+        cdef int depth
+        cdef cdatrie.AlphaChar char
+
+        if self._version != self._trie._version:
+            raise RuntimeError("trie changed size during iteration")
+
+        while True:
+            if self._subtree is not None:
+                if self._subtree.next():
+                    self.key = self._prefix + self._subtree.key()
+                    self.data = self._subtree.data()
+                    return True
+                self._subtree = None
+                self._depth -= 1
+                continue
+
+            depth = self._depth
+            if depth < 0:
+                return False
+            if self._indices[depth] == self._counts[depth]:
+                self._depth -= 1
+                continue
+
+            char = self._children[depth * 256 + self._indices[depth]]
+            self._indices[depth] += 1
+            if char == 0:
+                if self._active[depth * (self._size + 1) + self._size]:
+                    self.key = PyUnicode_FromKindAndData(
+                        PyUnicode_4BYTE_KIND, self._key, depth)
+                    self.data = cdatrie.trie_state_get_data(self._states[depth])
+                    return True
+                continue
+
+            if depth + 1 == self._capacity:
+                self._grow(2 * self._capacity)
+            if not self._step(depth, char):
+                continue
+            if self._states[depth + 1] is NULL:
+                self._states[depth + 1] = cdatrie.trie_state_clone(
+                    self._states[depth])
+                if self._states[depth + 1] is NULL:
+                    raise MemoryError()
+            else:
+                cdatrie.trie_state_copy(self._states[depth + 1],
+                                        self._states[depth])
+            cdatrie.trie_state_walk(self._states[depth + 1], char)
+            self._key[depth] = char
+            self._depth = depth + 1
+            self._enter(depth + 1)
 
-    cdef int f_pos = stdio.ftell(f_ptr)
-    f.seek(f_pos)
 
-    return trie
+cdef int _compare_iterator_keys(_TrieIterator iter,
+                                _TrieIterator other) except -2:
+    """
+    Compares current keys of two iterators by code points;
+    returns -1, 0 or 1. Iterators of all tries yield keys in this order.
+    """
+    cdef cdatrie.AlphaChar* key = cdatrie.trie_iterator_get_key(iter._iter)
+    cdef cdatrie.AlphaChar* other_key = cdatrie.trie_iterator_get_key(other._iter)
+    cdef int res
+    try:
+        if key is NULL or other_key is NULL:
+            raise MemoryError()
+        res = cdatrie.alpha_char_strcmp(key, other_key)
+    finally:
+        free(key)
+        free(other_key)
+    return (res > 0) - (res < 0)
+
+cdef Py_ssize_t _cfile_read(void* owner, char* buf, size_t size) noexcept with gil:
+    return (<_CFile> owner)._read(buf, size)
+
+cdef Py_ssize_t _cfile_write(void* owner, char* buf, size_t size) noexcept with gil:
+    return (<_CFile> owner)._write(buf, size)
+
+
+cdef class _CFile:
+    """
+    A C stream for libdatrie's trie_fread and trie_fwrite which reads
+    from a file-like object or passes written data to a ``write``
+    callable, in chunks of at most IO_CHUNK_SIZE bytes. If ``write``
+    is None, written data is only counted.
+
+    Streams which can seek are read ahead; bytes read past the end of
+    the data are given back by seeking when the stream is closed.
+    Other streams are read without read-ahead, so nothing after the
+    data is consumed. Values of ``Trie`` and ``TypedTrie`` are read
+    through the ``read`` and ``readline`` methods.
+
+    Where C streams can't call back (Windows), the data is copied
+    through a temporary file.
+    """
+    cdef stdio.FILE* fp
+    cdef stdio_ext.datrie_CookieIO _io
+    cdef object _f  # a file-like object to read, a write callable or None
+    cdef object _error  # an exception raised by _f
+    cdef object _tmp  # the temporary file if callbacks aren't available
+    cdef bytearray _head  # the beginning of the data (the alpha map)
+
+    def __cinit__(self, f, bint writing):
+        self._f = f
+        self._io.owner = <void*> self
+        if not writing:
+            self._head = bytearray()
+        if not stdio_ext.DATRIE_HAVE_COOKIE_IO:
+            self._open_temporary(writing)
+            return
+
+        if writing:
+            self._io.write = _cfile_write
+            self.fp = stdio_ext.datrie_fopen_io(&self._io, "wb")
+        else:
+            self._io.read = _cfile_read
+            self.fp = stdio_ext.datrie_fopen_io(&self._io, "rb")
+        if self.fp is NULL:
+            raise MemoryError()
+        seekable = getattr(f, 'seekable', None)
+        if writing or (seekable is not None and seekable()):
+            stdio.setvbuf(self.fp, NULL, stdio._IOFBF, IO_CHUNK_SIZE)
+        else:
+            stdio.setvbuf(self.fp, NULL, stdio._IONBF, 0)
+
+    def __dealloc__(self):
+        if self.fp is not NULL:
+            stdio.fclose(self.fp)
+
+    cdef int _open_temporary(self, bint writing) except -1:
+        self._tmp = tempfile.TemporaryFile()
+        if not writing:
+            for chunk in iter(lambda: self._f.read(IO_CHUNK_SIZE), b''):
+                self._tmp.write(chunk)
+                self._io.pos += len(chunk)
+                if len(self._head) < IO_CHUNK_SIZE:
+                    self._head += chunk
+            self._tmp.seek(0)
+        self.fp = stdio_ext.fdopen(os.dup(self._tmp.fileno()),
+                                   "wb" if writing else "rb")
+        if self.fp is NULL:
+            raise IOError("Can't open a temporary file")
+        return 0
+
+    cdef Py_ssize_t _read(self, char* buf, size_t size) noexcept:
+        try:
+            data = self._f.read(size)
+            if <size_t> len(data) > size:
+                raise ValueError("read() returned too much data")
+            string.memcpy(buf, <const char*> data, len(data))
+            if len(self._head) < IO_CHUNK_SIZE:
+                self._head += data
+            return len(data)
+        except BaseException as e:
+            self._error = e
+            return -1
+
+    cdef Py_ssize_t _write(self, char* buf, size_t size) noexcept:
+        try:
+            if self._f is not None:
+                self._f(buf[:size])
+            return size
+        except BaseException as e:
+            self._error = e
+            return -1
+
+    cdef int check(self, bint failed) except -1:
+        """
+        Raises an exception raised by the underlying stream, or
+        DatrieError if ``failed`` is true.
+        """
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        if failed:
+            raise DatrieError("Can't read trie from stream" if self._head
+                              is not None else "Can't write trie to stream")
+        return 0
+
+    cdef AlphaMap alpha_map(self):
+        """
+        Returns the alphabet map of the trie read from this stream.
+        """
+        return _alpha_map_from_data(bytes(self._head))
+
+    def read(self, Py_ssize_t size=-1):
+        if size < 0:
+            return b''.join(iter(lambda: self.read(IO_CHUNK_SIZE), b''))
+        cdef bytearray buf = bytearray(size)
+        size = stdio.fread(<char*> buf, 1, size, self.fp)
+        self.check(stdio.ferror(self.fp))
+        return bytes(buf[:size])
+
+    def readline(self, Py_ssize_t size=-1):
+        cdef bytearray line = bytearray()
+        cdef int char
+        while size < 0 or len(line) < size:
+            char = stdio.fgetc(self.fp)
+            if char == stdio.EOF:
+                self.check(stdio.ferror(self.fp))
+                break
+            line.append(char)
+            if char == ord('\n'):
+                break
+        return bytes(line)
+
+    cdef int close(self) except -1:
+        """
+        Closes the stream, so that written data is passed on; gives
+        back the bytes which were read ahead and not used.
+        """
+        if self.fp is NULL:
+            return 0
+        cdef long long unread = 0
+        cdef stdio.FILE* fp = self.fp
+        self.fp = NULL
+        if self._head is not None:
+            unread = self._io.pos - stdio.ftell(fp)
+        cdef int res = stdio.fclose(fp)
+        if self._tmp is not None:
+            if self._head is None:
+                self._tmp.seek(0)
+                for chunk in iter(lambda: self._tmp.read(IO_CHUNK_SIZE), b''):
+                    self._io.pos += len(chunk)
+                    if self._f is not None:
+                        self._f(chunk)
+            self._tmp.close()
+        self.check(res != 0)
+        if unread > 0:
+            self._f.seek(-unread, io.SEEK_CUR)
+        return 0
+
+
+# 1 if the layouts of libdatrie structures in cdatrie.pxd match libdatrie,
+# 0 if they don't and -1 if they are not checked yet
+cdef int _layouts_match = -1
+
+cdef int _check_layouts() except -1:
+    """
+    Returns 1 if the layouts of libdatrie structures in cdatrie.pxd are
+    the same as in libdatrie. They are checked once, on a small trie with
+    deleted keys, against the data written by trie_fwrite.
+    """
+    global _layouts_match
+    cdef BaseTrie trie
+    cdef bytes data
+    if _layouts_match < 0:
+        trie = BaseTrie(ranges=[('a', 'c'), ('x', 'z')])
+        for index, key in enumerate(['abc', 'ab', 'ax', 'b', 'bzz', 'cy']):
+            trie[key] = index
+        del trie['ax']
+        del trie['bzz']
+        data = trie.tobytes()
+        _layouts_match = cdatrie.datrie_layouts_match(
+            trie._c_trie, <const unsigned char*> <char*> data, len(data))
+        if not _layouts_match:
+            warnings.warn("The layouts of libdatrie structures don't match "
+                          "datrie; sys.getsizeof(trie) takes linear time",
+                          RuntimeWarning)
+    return _layouts_match
+
+
+cdef Py_ssize_t _write_trie(cdatrie.Trie* c_trie, write) except -1:
+    """
+    Writes a trie with trie_fwrite, passing the data to a ``write``
+    callable (or discarding it if ``write`` is None) in chunks of at most
+    IO_CHUNK_SIZE bytes; returns the number of bytes written.
+    """
+    cdef _CFile stream = _CFile(write, True)
+    cdef int res = cdatrie.trie_fwrite(c_trie, stream.fp)
+    stream.check(res != 0)
+    stream.close()
+    return stream._io.pos
+
+
+cdef int _read_trie(BaseTrie trie, _CFile stream) except -1:
+    """
+    Reads a trie into ``trie`` from ``stream`` with trie_fread.
+    """
+    trie._c_trie = cdatrie.trie_fread(stream.fp)
+    stream.check(trie._c_trie is NULL)
+    trie.alpha_map = stream.alpha_map()
+    return 0
+
+
+cdef AlphaMap _alpha_map_from_data(data):
+    """
+    Creates an alphabet map from the header of serialized trie ``data``.
+    """
+    cdef AlphaMap alpha_map = AlphaMap()
+    signature, count = struct.unpack_from('>Ii', data)
+    for i in range(count):
+        alpha_map._add_range(*struct.unpack_from('>II', data, 8 + 8 * i))
+    return alpha_map
+
+
+cdef inline int32_t _unpack_int32(const unsigned char* p):
+    return <int32_t> ((<uint32_t> p[0] << 24) | (<uint32_t> p[1] << 16)
+                      | (<uint32_t> p[2] << 8) | p[3])
+
+
+cdef dict _trie_data_stats(bytes data):
+    """
+    Returns statistics of the parts of serialized trie ``data``.
+    """
+    cdef const unsigned char* p = data
+    cdef Py_ssize_t pos, count, i, alphabet_size = 0
+    cdef Py_ssize_t free_cells = 0, free_blocks = 0, suffix_bytes = 0
+    cdef Py_ssize_t num_cells, num_tails
+    cdef uint32_t begin, end
+    cdef int16_t length
+
+    # alpha map: (begin, end) ranges
+    count = _unpack_int32(p + 4)
+    for i in range(count):
+        begin = <uint32_t> _unpack_int32(p + 8 + 8 * i)
+        end = <uint32_t> _unpack_int32(p + 12 + 8 * i)
+        alphabet_size += end - begin + 1
+    pos = 8 + 8 * count
+
+    # double array: free cells are in a list linked by negative checks
+    num_cells = _unpack_int32(p + pos + 4)
+    for i in range(2, num_cells):
+        if _unpack_int32(p + pos + 8 * i + 4) < 0:
+            free_cells += 1
+    pos += 8 * num_cells
+
+    # tail: free blocks are in a list, used ones have next free -1
+    num_tails = _unpack_int32(p + pos + 8)
+    pos += 12
+    for i in range(num_tails):
+        if _unpack_int32(p + pos) != -1:
+            free_blocks += 1
+        length = <int16_t> ((p[pos + 8] << 8) | p[pos + 9])
+        if length > 0:
+            suffix_bytes += length
+        pos += TAIL_BLOCK_HEADER_SIZE + length
+
+    return {
+        'alphabet_size': alphabet_size,
+        'alpha_map_ranges': count,
+        'da_cells': num_cells,
+        'da_free_cells': free_cells,
+        'tail_blocks': num_tails,
+        'tail_free_blocks': free_blocks,
+        'tail_bytes': suffix_bytes,
+    }
+
+
+cdef _open_file(path, mode, compression):
+    if compression is None:
+        return open(path, mode)
+    if compression not in COMPRESSION_MODULES:
+        raise ValueError("Unsupported compression: %r" % (compression,))
+    module = importlib.import_module(compression)
+    return module.open(path, mode)
+
+def _chunked(iterator, int size):
+    if size <= 0:
+        raise ValueError("Chunk size must be positive")
+    return iter(lambda: list(itertools.islice(iterator, size)), [])
+
+cdef list _unused_indices(BaseTrie trie, Py_ssize_t size):
+    """
+    Returns a list of indices in ``range(size)`` which are not used
+    as data by ``trie``, in descending order.
+    """
+    cdef bytearray used = bytearray(size)
+    cdef cdatrie.TrieData index
+    for index in BaseTrie.values(trie):
+        used[index] = 1
+    return [index for index in range(size - 1, -1, -1) if not used[index]]
+
+cdef _write_array(f, values):
+    """
+    Serializes ``array.array``: a header (type code and length)
+    followed by raw little-endian data, written in chunks.
+    """
+    f.write(struct.pack(ARRAY_HEADER_FORMAT,
+                        values.typecode.encode('ascii'), len(values)))
+    cdef Py_ssize_t start, step = max(IO_CHUNK_SIZE // values.itemsize, 1)
+    for start in range(0, len(values), step):
+        chunk = values[start:start + step]
+        if sys.byteorder != 'little':
+            chunk.byteswap()
+        f.write(chunk.tobytes())
+
+cdef _read_array(f):
+    """
+    Reads ``array.array`` written by ``_write_array``.
+    """
+    header = _read_exactly(f, struct.calcsize(ARRAY_HEADER_FORMAT))
+    typecode, length = struct.unpack(ARRAY_HEADER_FORMAT, header)
+    values = array.array(typecode.decode('ascii'))
+    cdef Py_ssize_t size, step = max(IO_CHUNK_SIZE // values.itemsize, 1)
+    while length > 0:
+        size = min(length, step)
+        chunk = array.array(values.typecode)
+        chunk.frombytes(_read_exactly(f, size * values.itemsize))
+        if sys.byteorder != 'little':
+            chunk.byteswap()
+        values.extend(chunk)
+        length -= size
+    return values
+
+cdef bytes _read_exactly(f, Py_ssize_t size):
+    cdef list chunks = []
+    while size > 0:
+        chunk = f.read(size)
+        if not chunk:
+            raise DatrieError("Unexpected end of file")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+cdef tuple _unpack_state(state):
+    """
+    Returns ``(data, key_count)`` tuple for pickled trie state;
+    pickles made by older datrie versions have no key count.
+    """
+    if isinstance(state, bytes):
+        return state, -1
+    data, key_count = state
+    return data, key_count
 
 #cdef (cdatrie.Trie*) _load_from_file(path) except NULL:
 #    str_path = path.encode(sys.getfilesystemencoding())
@@ -1052,6 +4671,22 @@ cdef class AlphaMap:
 
         return clone
 
+    @classmethod
+    def from_corpus(cls, keys, int min_count=1):
+        """
+        Creates an alphabet map of characters which occur in ``keys``
+        (an iterable of strings) at least ``min_count`` times.
+
+        Internal codes are assigned in character order (which is also
+        the order of keys in a trie), so the map only keeps the alphabet
+        as small as the data allows.
+        """
+        cdef object counts = collections.Counter()
+        for key in keys:
+            counts.update(key)
+        return cls(alphabet=[char for char, count in counts.items()
+                             if count >= min_count])
+
     def add_alphabet(self, alphabet):
         """
         Adds all chars from iterable to the alphabet set.
@@ -1077,39 +4712,78 @@ cdef class AlphaMap:
             raise MemoryError()
 
 
-cdef cdatrie.AlphaChar* new_alpha_char_from_unicode(unicode txt):
+cdef cdatrie.AlphaChar* new_alpha_char_from_unicode(unicode txt) except NULL:
     """
     Converts Python unicode string to libdatrie's AlphaChar* format.
     libdatrie wants null-terminated array of 4-byte LE symbols.
 
     The caller should free the result of this function.
     """
-    cdef int txt_len = len(txt)
-    cdef int size = (txt_len + 1) * sizeof(cdatrie.AlphaChar)
+    cdef Py_ssize_t size = (len(txt) + 1) * sizeof(cdatrie.AlphaChar)
 
     # allocate buffer
     cdef cdatrie.AlphaChar* data = <cdatrie.AlphaChar*> malloc(size)
     if data is NULL:
         raise MemoryError()
 
-    # Copy text contents to buffer.
-    # XXX: is it safe? The safe alternative is to decode txt
-    # to utf32_le and then use memcpy to copy the content:
-    #
-    #    py_str = txt.encode('utf_32_le')
-    #    cdef char* c_str = py_str
-    #    string.memcpy(data, c_str, size-1)
-    #
-    # but the following is much (say 10x) faster and this
-    # function is really in a hot spot.
-    cdef int i = 0
-    for char in txt:
-        data[i] = <cdatrie.AlphaChar> char
-        i+=1
+    fill_alpha_char_from_unicode(txt, data)
+    return data
+
+
+cdef inline cdatrie.AlphaChar* encode_key(unicode txt,
+                                          cdatrie.AlphaChar* buf) except NULL:
+    """
+    Converts Python unicode string to libdatrie's AlphaChar* format
+    without allocating memory for short strings: ``buf`` must have
+    room for KEY_BUFFER_SIZE symbols and is used if the string fits.
+
+    The result should be released with ``free_key(result, buf)``.
+    """
+    if len(txt) < KEY_BUFFER_SIZE:
+        fill_alpha_char_from_unicode(txt, buf)
+        return buf
+    return new_alpha_char_from_unicode(txt)
+
+
+cdef inline void free_key(cdatrie.AlphaChar* c_key, cdatrie.AlphaChar* buf):
+    if c_key != buf:
+        free(c_key)
+
+
+cdef Py_ssize_t _count_found(char* found, Py_ssize_t count):
+    cdef Py_ssize_t i, res = 0
+    for i in range(count):
+        if found[i]:
+            res += 1
+    return res
+
+
+cdef Py_ssize_t fill_alpha_char_from_unicode(unicode txt,
+                                             cdatrie.AlphaChar* data):
+    """
+    Copies Python unicode string to a preallocated AlphaChar* buffer
+    which must have room for ``len(txt) + 1`` symbols.
+    Returns the length of the string.
+
+    Characters are read directly from the PEP 393 representation
+    of the string.
+    """
+    cdef Py_ssize_t i, length = PyUnicode_GET_LENGTH(txt)
+    cdef int kind = PyUnicode_KIND(txt)
+    cdef void* txt_data = PyUnicode_DATA(txt)
+
+    if kind == PyUnicode_1BYTE_KIND:
+        for i in range(length):
+            data[i] = (<uint8_t*> txt_data)[i]
+    elif kind == PyUnicode_2BYTE_KIND:
+        for i in range(length):
+            data[i] = (<uint16_t*> txt_data)[i]
+    else:
+        string.memcpy(data, txt_data, length * sizeof(cdatrie.AlphaChar))
 
     # Buffer must be null-terminated (last 4 bytes must be zero).
-    data[txt_len] = 0
-    return data
+    data[length] = 0
+    return length
 
 
 cdef unicode unicode_from_alpha_char(cdatrie.AlphaChar* key, int len=0):
@@ -1118,12 +4792,8 @@ cdef unicode unicode_from_alpha_char(cdatrie.AlphaChar* key, int len=0):
     """
     cdef int length = len
     if length == 0:
-        length = cdatrie.alpha_char_strlen(key)*sizeof(cdatrie.AlphaChar)
-    cdef char* c_str = <char*> key
-    if sys.byteorder == "little":
-        return c_str[:length].decode('utf_32_le')
-    else:
-        return c_str[:length].decode('utf_32_be')
+        length = cdatrie.alpha_char_strlen(key)
+    return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, key, length)
 
 
 def to_ranges(lst):
@@ -1151,4 +4821,5 @@ def new(alphabet=None, ranges=None, AlphaMap alpha_map=None):
 
 
 MutableMapping.register(Trie)
+MutableMapping.register(TypedTrie)
 MutableMapping.register(BaseTrie)
@@ -0,0 +1,49 @@
+cdef extern from *:
+    """
+    #ifdef _WIN32
+    #include <windows.h>
+
+    typedef SRWLOCK datrie_rwlock_t;
+
+    #define datrie_rwlock_init(l) InitializeSRWLock(l)
+    #define datrie_rwlock_destroy(l)
+    #define datrie_rwlock_rdlock(l) AcquireSRWLockShared(l)
+    #define datrie_rwlock_tryrdlock(l) (TryAcquireSRWLockShared(l) != 0)
+    #define datrie_rwlock_rdunlock(l) ReleaseSRWLockShared(l)
+    #define datrie_rwlock_wrlock(l) AcquireSRWLockExclusive(l)
+    #define datrie_rwlock_trywrlock(l) (TryAcquireSRWLockExclusive(l) != 0)
+    #define datrie_rwlock_wrunlock(l) ReleaseSRWLockExclusive(l)
+    #else
+    #include <pthread.h>
+
+    typedef pthread_rwlock_t datrie_rwlock_t;
+
+    #define datrie_rwlock_init(l) pthread_rwlock_init((l), NULL)
+    #define datrie_rwlock_destroy(l) pthread_rwlock_destroy(l)
+    #define datrie_rwlock_rdlock(l) pthread_rwlock_rdlock(l)
+    #define datrie_rwlock_tryrdlock(l) (pthread_rwlock_tryrdlock(l) == 0)
+    #define datrie_rwlock_rdunlock(l) pthread_rwlock_unlock(l)
+    #define datrie_rwlock_wrlock(l) pthread_rwlock_wrlock(l)
+    #define datrie_rwlock_trywrlock(l) (pthread_rwlock_trywrlock(l) == 0)
+    #define datrie_rwlock_wrunlock(l) pthread_rwlock_unlock(l)
+    #endif
+
+    #ifdef Py_GIL_DISABLED
+    #define DATRIE_GIL_DISABLED 1
+    #else
+    #define DATRIE_GIL_DISABLED 0
+    #endif
+    """
+    ctypedef struct datrie_rwlock_t:
+        pass
+
+    bint DATRIE_GIL_DISABLED
+
+    void datrie_rwlock_init(datrie_rwlock_t *lock)
+    void datrie_rwlock_destroy(datrie_rwlock_t *lock)
+    void datrie_rwlock_rdlock(datrie_rwlock_t *lock) nogil
+    bint datrie_rwlock_tryrdlock(datrie_rwlock_t *lock) nogil
+    void datrie_rwlock_rdunlock(datrie_rwlock_t *lock) nogil
+    void datrie_rwlock_wrlock(datrie_rwlock_t *lock) nogil
+    bint datrie_rwlock_trywrlock(datrie_rwlock_t *lock) nogil
+    void datrie_rwlock_wrunlock(datrie_rwlock_t *lock) nogil
@@ -2,3 +2,117 @@ from libc cimport stdio
 
 cdef extern from "stdio.h" nogil:
     stdio.FILE *fdopen(int fd, char *mode)
+
+cdef extern from *:
+    """
+    /*
+     * C streams which call back into datrie to read or write their data:
+     * fopencookie on Linux, funopen on BSD and macOS. Callbacks return
+     * the number of bytes read or written, 0 at the end of file or -1
+     * on error. Seeking is not supported, but ftell works, so that the
+     * number of bytes read ahead into the stream buffer can be found.
+     */
+    typedef Py_ssize_t (*datrie_io_func)(void *owner, char *buf, size_t size);
+
+    typedef struct {
+        void *owner;
+        datrie_io_func read;
+        datrie_io_func write;
+        long long pos;  /* number of bytes passed through the callbacks */
+    } datrie_CookieIO;
+
+    static Py_ssize_t datrie_cookie_io(datrie_CookieIO *io, datrie_io_func func,
+                                       char *buf, size_t size)
+    {
+        Py_ssize_t res = func (io->owner, buf, size);
+        if (res > 0)
+            io->pos += res;
+        return res;
+    }
+
+    #if defined(__linux__) || defined(__CYGWIN__)
+    #include <stdio_ext.h>
+    #define DATRIE_HAVE_COOKIE_IO 1
+
+    static ssize_t datrie_cookie_read(void *cookie, char *buf, size_t size)
+    {
+        datrie_CookieIO *io = (datrie_CookieIO *) cookie;
+        return datrie_cookie_io (io, io->read, buf, size);
+    }
+
+    static ssize_t datrie_cookie_write(void *cookie, const char *buf, size_t size)
+    {
+        datrie_CookieIO *io = (datrie_CookieIO *) cookie;
+        Py_ssize_t res = datrie_cookie_io (io, io->write, (char *) buf, size);
+        return res < 0 ? 0 : res;  /* 0 is an error for write functions */
+    }
+
+    static int datrie_cookie_seek(void *cookie, off64_t *offset, int whence)
+    {
+        if (whence != SEEK_CUR || *offset != 0)
+            return -1;
+        *offset = ((datrie_CookieIO *) cookie)->pos;
+        return 0;
+    }
+
+    static FILE *datrie_fopen_io(datrie_CookieIO *io, const char *mode)
+    {
+        cookie_io_functions_t funcs = {
+            io->read ? datrie_cookie_read : NULL,
+            io->write ? datrie_cookie_write : NULL,
+            datrie_cookie_seek,
+            NULL
+        };
+        FILE *file = fopencookie (io, mode, funcs);
+        /* libdatrie reads and writes integers one by one; the stream
+           is only used by one thread, so stdio needn't lock it */
+        if (file)
+            __fsetlocking (file, FSETLOCKING_BYCALLER);
+        return file;
+    }
+
+    #elif defined(__APPLE__) || defined(__FreeBSD__) || defined(__NetBSD__) \\
+          || defined(__OpenBSD__) || defined(__DragonFly__)
+    #define DATRIE_HAVE_COOKIE_IO 1
+
+    static int datrie_funopen_read(void *cookie, char *buf, int size)
+    {
+        datrie_CookieIO *io = (datrie_CookieIO *) cookie;
+        return (int) datrie_cookie_io (io, io->read, buf, (size_t) size);
+    }
+
+    static int datrie_funopen_write(void *cookie, const char *buf, int size)
+    {
+        datrie_CookieIO *io = (datrie_CookieIO *) cookie;
+        return (int) datrie_cookie_io (io, io->write, (char *) buf, (size_t) size);
+    }
+
+    static fpos_t datrie_funopen_seek(void *cookie, fpos_t offset, int whence)
+    {
+        if (whence != SEEK_CUR || offset != 0)
+            return -1;
+        return (fpos_t) ((datrie_CookieIO *) cookie)->pos;
+    }
+
+    static FILE *datrie_fopen_io(datrie_CookieIO *io, const char *mode)
+    {
+        return funopen (io, io->read ? datrie_funopen_read : NULL,
+                        io->write ? datrie_funopen_write : NULL,
+                        datrie_funopen_seek, NULL);
+    }
+
+    #else
+    #define DATRIE_HAVE_COOKIE_IO 0
+    #define datrie_fopen_io(io, mode) ((FILE *) NULL)
+    #endif
+    """
+    # streams with I/O callbacks are not available on Windows
+    ctypedef Py_ssize_t (*datrie_io_func)(void *owner, char *buf,
+                                          size_t size) noexcept
+    ctypedef struct datrie_CookieIO:
+        void *owner
+        datrie_io_func read
+        datrie_io_func write
+        long long pos
+    bint DATRIE_HAVE_COOKIE_IO
+    stdio.FILE *datrie_fopen_io(datrie_CookieIO *io, const char *mode)
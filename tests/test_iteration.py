@@ -3,7 +3,9 @@
 from __future__ import absolute_import, unicode_literals
 
 import string
+
 import datrie
+import pytest
 
 WORDS = ['producers', 'pool', 'prepare', 'preview', 'prize', 'produce',
          'producer', 'progress']
@@ -111,3 +113,92 @@ def test_keys_tail():
         keys.append(it.key())
 
     assert keys == ['duce', 'ducer', 'ducers', 'gress']
+
+
+def test_modification_during_iteration():
+    trie = _trie()
+    it = iter(trie)
+    assert next(it) == 'pool'
+
+    trie['pool'] = 10  # updates are fine
+    assert next(it) == 'prepare'
+
+    trie['zoo'] = 1
+    with pytest.raises(RuntimeError):
+        next(it)
+
+    state = datrie.State(trie)
+    it = datrie.Iterator(state)
+    assert it.next()
+    del trie['zoo']
+    with pytest.raises(RuntimeError):
+        it.next()
+
+
+@pytest.mark.parametrize("prefix", [None, '', 'pr', 'produce', 'x'])
+def test_lazy_iteration(prefix):
+    trie = _trie()
+    assert list(trie.iterkeys(prefix)) == trie.keys(prefix)
+    assert list(trie.itervalues(prefix)) == trie.values(prefix)
+    assert list(trie.iteritems(prefix)) == trie.items(prefix)
+
+    chunks = list(trie.iteritems_chunked(prefix, size=3))
+    assert all(0 < len(chunk) <= 3 for chunk in chunks)
+    assert sum(chunks, []) == trie.items(prefix)
+
+
+def test_lazy_iteration_chunks():
+    trie = _trie()
+    assert list(trie.iterkeys_chunked(size=4)) == [sorted(WORDS)[:4],
+                                                   sorted(WORDS)[4:]]
+    assert list(trie.itervalues_chunked('prod', 10)) == [[6, 7, 1]]
+
+    base_trie = datrie.BaseTrie(string.ascii_lowercase)
+    base_trie['foo'] = 5
+    assert list(base_trie.itervalues()) == [5]
+
+    with pytest.raises(ValueError):
+        trie.iterkeys_chunked(size=0)
+
+
+@pytest.mark.parametrize("prefix", [None, 'pr', 'produce', 'x'])
+@pytest.mark.parametrize("reverse", [False, True])
+@pytest.mark.parametrize("start, stop, after", [
+    (None, None, None),
+    ('pre', 'prod', None),
+    ('prepare', 'produce', None),
+    ('a', 'pz', 'preview'),
+    (None, None, 'produce'),
+    ('produce', 'producers', 'prize'),
+    ('q', 'p', None),
+])
+def test_range_iteration(prefix, reverse, start, stop, after):
+    trie = _trie()
+    keys = [key for key in trie.keys(prefix)
+            if (start is None or key >= start) and (stop is None or key < stop)]
+    if reverse:
+        keys.reverse()
+    if after is not None:
+        keys = [key for key in keys if (key < after if reverse else key > after)]
+
+    assert list(trie.iterkeys(prefix, start, stop, after,
+                              reverse=reverse)) == keys
+    assert list(trie.iteritems(prefix, start, stop, after, limit=2,
+                               reverse=reverse)) == [(key, trie[key])
+                                                     for key in keys[:2]]
+
+
+def test_range_pagination():
+    trie = _trie()
+    pages, after = [], None
+    while True:
+        page = list(trie.iterkeys(after=after, limit=3))
+        if not page:
+            break
+        pages.append(page)
+        after = page[-1]
+    assert pages == [sorted(WORDS)[:3], sorted(WORDS)[3:6], sorted(WORDS)[6:]]
+
+    assert list(trie.itervalues(stop='pri', limit=0)) == []
+    with pytest.raises(ValueError):
+        list(trie.iterkeys(limit=-1))
@@ -2,11 +2,15 @@
 
 from __future__ import absolute_import, unicode_literals
 
+import gzip
+import io
+import operator
 import pickle
 import random
 import string
 import sys
 import tempfile
+import threading
 
 import datrie
 import pytest
@@ -36,6 +40,74 @@ def test_trie():
         trie['bar']
 
 
+def test_get_many():
+    trie = datrie.Trie(string.ascii_lowercase)
+    trie['foo'] = 'x'
+    trie['bar'] = 10
+
+    assert trie.get_many([]) == []
+    assert trie.get_many(['foo', 'baz', 'bar', 'fo']) == ['x', None, 10, None]
+    assert trie.get_many(iter(['bar', 'BAR']), default=0) == [10, 0]
+
+    base_trie = datrie.BaseTrie(string.ascii_lowercase)
+    base_trie['foo'] = 5
+    assert base_trie.get_many(['foo', 'bar'], -1) == [5, -1]
+
+    with pytest.raises(TypeError):
+        trie.get_many([b'foo'])
+
+
+def test_contains_many():
+    trie = datrie.BaseTrie(string.ascii_lowercase)
+    trie['foo'] = 1
+    trie['foobar'] = 2
+
+    assert trie.contains_many([]) == []
+    assert trie.contains_many(['foo', 'fo', 'foobar', '']) == [
+        True, False, True, False
+    ]
+
+
+@pytest.mark.parametrize("concurrent", [False, True])
+def test_concurrent_access(concurrent):
+    trie = datrie.Trie(string.ascii_lowercase)
+    trie.concurrent = concurrent
+    assert trie.concurrent == concurrent
+
+    words = ['foo', 'bar', 'foobar', 'baz']
+    for index, word in enumerate(words):
+        trie[word] = index
+
+    new_words = [''.join(random.choice('xyz') for _ in range(8))
+                 for _ in range(2000)]
+    errors = []
+
+    def reader():
+        try:
+            for _ in range(200):
+                assert trie.get_many(words) == list(range(len(words)))
+                for index, word in enumerate(words):
+                    assert trie[word] == index
+                    assert word in trie
+        except Exception as e:
+            errors.append(e)
+
+    def writer():
+        for index, word in enumerate(new_words):
+            trie[word] = index
+            trie.setdefault(word[::-1], index)
+
+    threads = [threading.Thread(target=reader) for _ in range(4)]
+    threads.append(threading.Thread(target=writer))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert set(new_words) <= set(trie.keys())
+
+
 def test_trie_invalid_alphabet():
     t = datrie.Trie('abc')
     t['a'] = 'a'
@@ -52,6 +124,22 @@ def test_trie_invalid_alphabet():
         t['e']
 
 
+@pytest.mark.parametrize("cls", [datrie.BaseTrie, datrie.Trie])
+def test_build(cls):
+    items = [('foo', 1), ('bar', 2), ('foobar', 3), ('ba', 4), ('foo', 5)]
+
+    trie = cls.build(items, string.ascii_lowercase)
+    assert trie.items() == [('ba', 4), ('bar', 2), ('foo', 5), ('foobar', 3)]
+    assert len(trie) == 4
+
+    trie = cls.build(iter(sorted(items)), presorted=True)
+    assert trie.items() == [('ba', 4), ('bar', 2), ('foo', 5), ('foobar', 3)]
+    assert 'zoo' not in trie
+
+    trie = cls.build([], alphabet=string.ascii_lowercase)
+    assert len(trie) == 0
+
+
 def test_trie_save_load():
     fd, fname = tempfile.mkstemp()
     trie = datrie.Trie(string.printable)
@@ -71,6 +159,171 @@ def test_trie_save_load():
     assert trie2['Foo'] == 'vasia'
 
 
+def test_alpha_map_from_corpus():
+    alpha_map = datrie.AlphaMap.from_corpus(['hello', 'world', 'held'],
+                                            min_count=2)
+    trie = datrie.Trie(alpha_map=alpha_map)
+    trie['hello'] = 1
+    trie['world'] = 2  # 'w' and 'r' are too rare
+    assert trie.items() == [('hello', 1)]
+
+
+@pytest.mark.parametrize("cls", [datrie.BaseTrie, datrie.Trie,
+                                 datrie.TypedTrie])
+def test_strict_mode(cls):
+    trie = cls('ab')
+    trie['ab'] = 1
+    trie['abc'] = 2
+    assert not trie.strict
+    assert trie.keys() == ['ab']
+
+    trie.strict = True
+    with pytest.raises(datrie.DatrieError):
+        trie['abc'] = 2
+    with pytest.raises(datrie.DatrieError):
+        trie.setdefault('c', 2)
+    assert trie.keys() == ['ab']
+    if cls is not datrie.BaseTrie:
+        assert trie.tombstones == 0
+
+
+def test_extend_alphabet():
+    trie = datrie.Trie('ab')
+    trie['ab'] = 'x'
+    trie['b'] = 'y'
+    trie.extend_alphabet('c', ranges=[('x', 'z')])
+    trie['abc'] = 'z'
+    trie['z'] = 'w'
+    assert trie.items() == [('ab', 'x'), ('abc', 'z'), ('b', 'y'), ('z', 'w')]
+
+    # the alphabet of loaded tries is read from the file
+    trie = datrie.Trie.frombytes(trie.tobytes())
+    trie.extend_alphabet('d')
+    trie['abd'] = 'v'
+    assert trie['abd'] == 'v'
+    assert trie['abc'] == 'z'
+
+
+def test_repack():
+    words = ['%s%04d' % (prefix, i) for prefix in ['foo', 'bar', 'baz']
+             for i in range(300)]
+    trie = datrie.Trie(string.ascii_lowercase + string.digits)
+    for word in words:
+        trie[word] = word.upper()
+    for word in words[::2]:
+        del trie[word]
+    items = trie.items()
+    size = len(datrie.BaseTrie.tobytes(trie))
+
+    before, after = trie.repack()
+    assert before == size
+    assert after < before
+    assert after == len(datrie.BaseTrie.tobytes(trie))
+    assert trie.items() == items
+
+    trie['foo'] = 'FOO'
+    del trie['foo0001']
+    f = io.BytesIO()
+    trie.write(f, repack=True)
+    f.seek(0)
+    assert datrie.Trie.read(f).items() == trie.items()
+    assert len(trie.tobytes()) == len(f.getvalue())
+
+
+def test_stats():
+    trie = datrie.Trie(string.ascii_lowercase)
+    for word in ['foo', 'foobar', 'bar', 'baz', 'x']:
+        trie[word] = word
+    stats = trie.stats()
+    assert stats['keys'] == 5
+    assert stats['alphabet_size'] == 26
+    assert stats['alpha_map_ranges'] == 1
+    assert stats['max_depth'] == 6
+    assert stats['avg_depth'] == 16 / 5
+    assert stats['values'] == 5
+    assert stats['data_bytes'] == len(datrie.BaseTrie.tobytes(trie))
+    assert stats['tail_free_blocks'] == 0
+    assert 0 <= stats['da_free_cells'] < stats['da_cells']
+    size = sys.getsizeof(trie)
+    assert size >= stats['memory_bytes'] > stats['values_bytes']
+    trie.build_rank_index()
+    assert sys.getsizeof(trie) > size
+
+    del trie['baz']
+    del trie['x']
+    stats = trie.stats()
+    assert stats['keys'] == 3
+    assert stats['tail_free_blocks'] > 0
+
+    stats = datrie.BaseTrie(string.ascii_lowercase).stats()
+    assert stats['keys'] == stats['max_depth'] == stats['values'] == 0
+
+
+def test_instrumentation():
+    trie = datrie.Trie(string.ascii_lowercase)
+    trie['foo'] = 1
+    assert not trie.instrumented
+    assert trie.counters()['set_calls'] == 0
+
+    trie.instrumented = True
+    trie.timing_interval = 2
+    trie['foo'] = 2
+    trie['bar'] = 3
+    assert 'foo' in trie
+    assert trie.get('baz') is None
+    assert trie.get_many(['foo', 'x']) == [2, None]
+    assert trie.prefixes('foobar') == ['foo']
+    assert not trie.has_keys_with_prefix('fox')
+    assert trie.keys('b') == ['bar']
+    assert trie.items('x') == []
+    del trie['bar']
+    with pytest.raises(KeyError):
+        del trie['bar']
+
+    counters = trie.counters(reset=True)
+    assert counters['set_calls'] == 2
+    assert counters['set_hits'] == counters['set_misses'] == 1
+    assert counters['get_calls'] == 4
+    assert counters['get_hits'] == counters['get_misses'] == 2
+    assert counters['delete_hits'] == counters['delete_misses'] == 1
+    assert counters['prefix_calls'] == 2
+    assert counters['prefix_hits'] == 1
+    assert counters['prefix_misses'] == 1
+    assert counters['iter_hits'] == counters['iter_misses'] == 1
+    assert counters['walk_steps'] == 3 + 3 + 3 + 3 + 4 + 3 + 2 + 1 + 1 + 3 + 3
+    assert counters['encoded_bytes'] == 4 * (4 + 4 + 4 + 4 + 4 + 2 + 4 + 4)
+    assert 0 < counters['get_timed_calls'] < counters['get_calls']
+    assert counters['get_time'] > 0
+
+    assert all(value == 0 for value in trie.counters().values())
+    trie.instrumented = False
+    trie['foo'] = 1
+    assert trie.counters()['set_calls'] == 0
+
+
+@pytest.mark.parametrize('cls', [datrie.Trie, datrie.TypedTrie])
+def test_instrumentation_timing_interval(cls):
+    trie = cls(string.ascii_lowercase)
+    trie.instrumented = True
+    trie.timing_interval = 2
+    for key in ['a', 'b', 'c', 'd', 'e', 'f', 'a', 'b']:
+        trie[key] = 1
+    counters = trie.counters()
+    assert counters['set_calls'] == 8
+    assert counters['set_misses'] == 6
+    assert counters['set_timed_calls'] == 4
+
+
+def test_base_trie_negative_values():
+    trie = datrie.BaseTrie(string.ascii_lowercase)
+    trie['foo'] = -1
+    trie['bar'] = -2147483648
+    assert trie['foo'] == -1
+    assert trie.get('foo') == -1
+    assert trie.setdefault('foo', 5) == -1
+    assert trie['bar'] == -2147483648
+
+
 def test_save_load_base():
     fd, fname = tempfile.mkstemp()
     trie = datrie.BaseTrie(alphabet=string.printable)
@@ -87,6 +340,40 @@ def test_save_load_base():
     assert trie2['foovar'] == 2
 
 
+@pytest.mark.parametrize("cls", [datrie.BaseTrie, datrie.Trie])
+def test_load_frozen(cls):
+    fd, fname = tempfile.mkstemp()
+    trie = cls(string.ascii_lowercase)
+    trie['foo'] = 1
+    trie['bar'] = 2
+    trie.save(fname)
+    assert not trie.frozen
+
+    trie2 = cls.load(fname, frozen=True)
+    assert trie2.frozen
+    assert trie2['foo'] == 1
+    assert trie2.keys('f') == ['foo']
+    assert trie2.setdefault('bar', 5) == 2
+
+    with pytest.raises(datrie.DatrieError):
+        trie2['foo'] = 3
+    with pytest.raises(datrie.DatrieError):
+        trie2['baz'] = 3
+    with pytest.raises(datrie.DatrieError):
+        trie2.setdefault('baz', 3)
+    with pytest.raises(datrie.DatrieError):
+        del trie2['foo']
+    with pytest.raises(datrie.DatrieError):
+        trie2.pop('foo')
+    with pytest.raises(datrie.DatrieError):
+        trie2.update({'baz': 3})
+    with pytest.raises(datrie.DatrieError):
+        trie2.clear()
+
+    assert trie2.items() == [('bar', 2), ('foo', 1)]
+    assert not cls.load(fname).frozen
+
+
 def test_trie_file_io():
     fd, fname = tempfile.mkstemp()
 
@@ -113,6 +400,125 @@ def test_trie_file_io():
     assert len(trie2) == len(trie)
 
 
+class _FailingWriter(object):
+    def write(self, data):
+        raise ZeroDivisionError()
+
+
+class _ChunkedReader(object):
+    """ A stream returning at most 7 bytes per read """
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._stream.read(min(size, 7) if size >= 0 else 7)
+
+
+@pytest.mark.parametrize("cls", [datrie.BaseTrie, datrie.Trie, datrie.TypedTrie])
+def test_trie_stream_io(cls):
+    trie = cls(string.ascii_lowercase)
+    for index, key in enumerate(['foo', 'f' * 300, 'bar' * 40, 'baz', 'b']):
+        trie[key] = index
+
+    f = io.BytesIO()
+    trie.write(f)
+    f.write(b'extra')
+    assert f.getvalue() == trie.tobytes() + b'extra'
+
+    f.seek(0)
+    trie2 = cls.read(f)
+    assert f.read() == b'extra'
+    assert trie2.items() == trie.items()
+
+    # short reads from a stream which can't seek
+    f = _ChunkedReader(trie.tobytes() + b'extra')
+    trie3 = cls.read(f)
+    assert f.read() == b'extra'
+    assert trie3.items() == trie.items()
+
+    with pytest.raises(ZeroDivisionError):
+        trie.write(_FailingWriter())
+
+    with pytest.raises(datrie.DatrieError):
+        cls.read(io.BytesIO(datrie.BaseTrie.tobytes(trie)[:-1]))
+    with pytest.raises(datrie.DatrieError):
+        cls.read(io.BytesIO(b'\0' * 100))
+
+
+class _RecordingStream(io.BytesIO):
+    """
+    Records the largest read and write sizes.
+    """
+    max_size = 0
+
+    def read(self, size=-1):
+        data = super(_RecordingStream, self).read(size)
+        self.max_size = max(self.max_size, len(data))
+        return data
+
+    def write(self, data):
+        self.max_size = max(self.max_size, len(data))
+        return super(_RecordingStream, self).write(data)
+
+
+@pytest.mark.parametrize("cls", [datrie.BaseTrie, datrie.TypedTrie])
+def test_trie_stream_io_chunks(cls):
+    trie = cls(string.ascii_lowercase + string.digits)
+    for index in range(20000):
+        trie['%05d%s' % (index, 'x' * (index % 50))] = index
+    trie['z' * 30000] = 1
+    data = trie.tobytes()
+    assert len(data) > 4 * 65536
+
+    f = _RecordingStream()
+    trie.write(f)
+    assert f.getvalue() == data
+    assert f.max_size <= 65536
+
+    f = _RecordingStream(data)
+    trie2 = cls.read(f)
+    assert f.max_size <= 65536
+    assert trie2.items() == trie.items()
+    assert trie2.tobytes() == data
+
+
+@pytest.mark.parametrize("compression", ['gzip', 'bz2', 'lzma'])
+def test_trie_save_load_compressed(compression):
+    fd, fname = tempfile.mkstemp()
+    trie = datrie.Trie(string.ascii_lowercase)
+    trie['foo'] = 'bar'
+    trie.save(fname, compression=compression)
+
+    trie2 = datrie.Trie.load(fname, compression=compression)
+    assert trie2.items() == [('foo', 'bar')]
+    if compression == 'gzip':
+        with gzip.open(fname) as f:
+            assert datrie.Trie.read(f).items() == [('foo', 'bar')]
+
+    with pytest.raises(ValueError):
+        trie.save(fname, compression='zip')
+
+
+def test_trie_long_keys():
+    trie = datrie.Trie(ranges=[('a', 'z'), ('а', 'я'), ('\U0001f600', '\U0001f64f')])
+    keys = ['a' * 63, 'a' * 64, 'b' * 1000, 'я' * 100, '\U0001f600' * 100]
+    for index, key in enumerate(keys):
+        trie[key] = index
+
+    for index, key in enumerate(keys):
+        assert key in trie
+        assert trie[key] == index
+        assert trie.setdefault(key, None) == index
+        assert trie.longest_prefix(key + 'z') == key
+
+    assert 'a' * 65 not in trie
+    assert trie.prefixes('a' * 65) == ['a' * 63, 'a' * 64]
+
+    del trie['b' * 1000]
+    assert 'b' * 1000 not in trie
+    assert len(trie) == len(keys) - 1
+
+
 def test_trie_unicode():
     # trie for lowercase Russian characters
     trie = datrie.Trie(ranges=[('а', 'я')])
@@ -173,6 +579,214 @@ def test_trie_comparison():
     with pytest.raises(TypeError):
         trie < other  # same for other comparisons
 
+    # same size, different keys
+    other = datrie.Trie(ranges=[('a', 'z'), ('а', 'я')])
+    other['bar'] = 42
+    assert trie != other
+    other['foo'] = 42
+    del other['bar']
+    assert trie == other
+
+
+def test_trie_diff():
+    old = datrie.Trie(string.ascii_lowercase)
+    new = datrie.Trie(string.ascii_lowercase + 'z')
+    for key, value in [('a', 1), ('b', 2), ('bar', 3), ('foo', 4), ('z', 5)]:
+        old[key] = value
+    for key, value in [('b', 2), ('ba', 6), ('bar', 7), ('foo', 4), ('zz', 8)]:
+        new[key] = value
+
+    assert list(old.diff(new)) == [
+        ('removed', 'a', 1, None),
+        ('added', 'ba', None, 6),
+        ('changed', 'bar', 3, 7),
+        ('removed', 'z', 5, None),
+        ('added', 'zz', None, 8),
+    ]
+    assert list(new.diff(old))[0] == ('added', 'a', None, 1)
+    assert list(old.diff(old)) == []
+    assert list(old.diff(datrie.Trie('a'))) == [
+        ('removed', key, value, None) for key, value in old.items()
+    ]
+
+
+def test_fuzzy_search():
+    trie = datrie.Trie(string.ascii_lowercase)
+    for index, key in enumerate(['cat', 'cart', 'act', 'dog', 'cats', 'at']):
+        trie[key] = index
+
+    assert trie.fuzzy_keys('cat', 0) == ['cat']
+    assert trie.fuzzy_keys('cat', 1) == ['cat', 'at', 'cart', 'cats']
+    assert trie.fuzzy_keys('cat', 1, transpositions=True) == [
+        'cat', 'act', 'at', 'cart', 'cats'
+    ]
+    assert trie.fuzzy_items('cta', 1, transpositions=True) == [('cat', 0)]
+    assert trie.fuzzy_items('cat', 2, limit=2) == [('cat', 0), ('at', 5)]
+    assert trie.fuzzy_keys('', 2) == ['at']
+    assert trie.fuzzy_keys('xyz', 1) == []
+    assert trie.fuzzy_keys('cat', 1, limit=0) == []
+
+    base_trie = datrie.BaseTrie(string.ascii_lowercase)
+    base_trie['dog'] = 5
+    assert base_trie.fuzzy_items('dig', 1) == [('dog', 5)]
+
+    with pytest.raises(ValueError):
+        trie.fuzzy_keys('cat', -1)
+
+
+def test_match():
+    trie = datrie.Trie(string.ascii_lowercase + '[]')
+    for index, key in enumerate(['cat', 'cut', 'cats', 'coat', 'ct', 'dog',
+                                 'a[b]']):
+        trie[key] = index
+
+    assert trie.match('c?t') == ['cat', 'cut']
+    assert trie.match('c?t*') == ['cat', 'cats', 'cut']
+    assert trie.match('c*t') == ['cat', 'coat', 'ct', 'cut']
+    assert trie.match('*') == sorted(trie.keys())
+    assert trie.match('[cd]o*') == ['coat', 'dog']
+    assert trie.match('c[!a]t') == ['cut']
+    assert trie.match('[a-c]*s') == ['cats']
+    assert trie.match('a[[]b[]]') == ['a[b]']
+    assert trie.match('dog') == ['dog']
+    assert trie.match('x*') == []
+    assert trie.match('') == []
+
+    assert trie.match_items('c?t') == [('cat', 0), ('cut', 1)]
+    assert trie.match_values('*s') == [2]
+    assert list(trie.iter_match('c?t')) == ['cat', 'cut']
+    assert list(trie.iter_match_items('d*')) == [('dog', 5)]
+    assert list(trie.iter_match_values('*t')) == [0, 3, 4, 1]
+
+
+def test_scanner():
+    trie = datrie.Trie(string.ascii_lowercase)
+    for key in ['he', 'she', 'his', 'hers', 'her']:
+        trie[key] = key.upper()
+    scanner = trie.scanner()
+
+    assert scanner.findall('ushers') == [
+        (1, 4, 'SHE'), (2, 4, 'HE'), (2, 5, 'HER'), (2, 6, 'HERS')
+    ]
+    assert list(scanner.finditer('ushers her', overlapping=False)) == [
+        (1, 4, 'SHE'), (7, 10, 'HER')
+    ]
+    assert scanner.findall('xyz') == []
+    assert scanner.findall('') == []
+    assert datrie.BaseTrie(string.ascii_lowercase).scanner().findall('he') == []
+
+    # finditer scans the text lazily, with the same results as findall
+    text = 'ushers hershe his ' * 3
+    for overlapping in [True, False]:
+        assert (list(scanner.finditer(text, overlapping))
+                == scanner.findall(text, overlapping))
+    matches = scanner.finditer('she' + 'x' * 10 ** 6, overlapping=False)
+    assert next(matches) == (0, 3, 'SHE')
+
+    trie['hi'] = 'HI'
+    with pytest.raises(RuntimeError):
+        scanner.findall('hi')
+    with pytest.raises(RuntimeError):
+        next(matches)
+
+
+def test_segment():
+    trie = datrie.BaseTrie(string.ascii_lowercase)
+    for key, value in [('the', 5), ('them', 1), ('theme', 1), ('me', 3),
+                       ('men', 2)]:
+        trie[key] = value
+
+    assert trie.segment('themen') == ['theme', 'n']
+    assert trie.segment('themen', mode='best') == ['the', 'men']
+    assert trie.segment('thexyme') == ['the', 'x', 'y', 'me']
+    assert trie.segment('thexyme', fallback='merge') == ['the', 'xy', 'me']
+    assert trie.segment('thexyme', mode='best', fallback='merge') == [
+        'the', 'xy', 'me'
+    ]
+    assert trie.segment('') == []
+    with pytest.raises(KeyError):
+        trie.segment('thex', fallback='error')
+    with pytest.raises(ValueError):
+        trie.segment('the', mode='shortest')
+
+    trie = datrie.Trie(string.ascii_lowercase)
+    trie['ab'] = 1.5
+    trie['a'] = trie['b'] = 1
+    assert trie.segment('ab', mode='best') == ['a', 'b']
+    trie['b'] = 0.25
+    assert trie.segment('ab', mode='best') == ['ab']
+    trie['c'] = 'not a number'
+    with pytest.raises(TypeError):
+        trie.segment('c', mode='best')
+
+
+def test_count_rank_select():
+    trie = datrie.Trie(string.ascii_lowercase)
+    words = ['', 'a', 'ab', 'abc', 'abd', 'b', 'ba', 'c']
+    for word in words:
+        trie[word] = None
+
+    with pytest.raises(datrie.DatrieError):
+        trie.count()
+    trie.build_rank_index()
+    assert trie.count() == len(words)
+    assert trie.count('a') == 4
+    assert trie.count('ab') == 3
+    assert trie.count('abz') == 0
+    assert [trie.rank(word) for word in words] == list(range(len(words)))
+    assert trie.rank('aa') == 2
+    assert trie.rank('abzz') == 5
+    assert trie.rank('z') == len(words)
+    assert [trie.select(n) for n in range(len(words))] == words
+    assert trie.select(-1) == 'c'
+    with pytest.raises(IndexError):
+        trie.select(len(words))
+
+    # the index must be rebuilt after changes
+    del trie['ab']
+    trie['bb'] = None
+    with pytest.raises(datrie.DatrieError):
+        trie.rank('c')
+    trie.build_rank_index()
+    assert trie.count('a') == 3
+    assert trie.rank('c') == 7
+    assert trie.select(3) == 'abd'
+
+
+def test_top_k():
+    trie = datrie.BaseTrie(string.ascii_lowercase)
+    trie.update({'a': 1, 'ab': 5, 'abc': 3, 'abd': 5, 'b': 7, 'ba': 2})
+
+    assert trie.top_k('', 3) == [('b', 7), ('ab', 5), ('abd', 5)]
+    assert trie.top_k('a', 10) == [
+        ('ab', 5), ('abd', 5), ('abc', 3), ('a', 1)
+    ]
+    assert trie.top_k('abc', 2) == [('abc', 3)]
+    assert trie.top_k('c', 2) == []
+    assert trie.top_k('a', 0) == []
+
+    # the index is updated after value changes and rebuilt after
+    # keys are added or removed
+    trie['abc'] = 10
+    assert trie.top_k('a', 1) == [('abc', 10)]
+    trie['abc'] = 0
+    trie['b'] = 4
+    assert trie.top_k('', 2) == [('ab', 5), ('abd', 5)]
+    assert trie.top_k('b', 3) == [('b', 4), ('ba', 2)]
+    del trie['abc']
+    trie['aa'] = 6
+    assert trie.top_k('a', 2) == [('aa', 6), ('ab', 5)]
+
+    trie = datrie.Trie(string.ascii_lowercase)
+    trie.update({'foo': (3, 'x'), 'foobar': (5, 'y'), 'fa': (4, 'z')})
+    trie.top_k_key = operator.itemgetter(0)
+    assert trie.top_k('f', 2) == [('foobar', (5, 'y')), ('fa', (4, 'z'))]
+    trie['foobar'] = (1, 'y')
+    assert trie.top_k('f', 2) == [('fa', (4, 'z')), ('foo', (3, 'x'))]
+    trie.top_k_key = len
+    trie.build_top_k_index()
+    assert trie.top_k('foo', 1) == [('foo', (3, 'x'))]
+
 
 def test_trie_update():
     trie = datrie.Trie(string.ascii_lowercase)
@@ -219,6 +833,204 @@ def test_trie_len():
     assert len(trie) == 0
 
 
+@pytest.mark.parametrize("cls", [datrie.BaseTrie, datrie.Trie])
+def test_trie_len_maintained(cls):
+    trie = cls(string.ascii_lowercase)
+    trie['foo'] = 1
+    trie['foo'] = 2
+    trie['bar'] = 3
+    trie['BAR'] = 4  # out of alphabet, not stored
+    trie.setdefault('foo', 5)
+    trie.setdefault('baz', 6)
+    assert len(trie) == 3
+
+    del trie['foo']
+    with pytest.raises(KeyError):
+        del trie['foo']
+    trie.pop('bar')
+    trie.pop('bar')
+    assert len(trie) == 1
+
+    trie.update({'foo': 1, 'baz': 2})
+    assert len(trie) == 2
+
+    trie2 = pickle.loads(pickle.dumps(trie))
+    assert len(trie2) == 2
+    trie2['x'] = 1
+    assert len(trie2) == 3
+
+    fd, fname = tempfile.mkstemp()
+    trie.save(fname)
+    trie3 = cls.load(fname)
+    assert len(trie3) == 2
+    trie3['y'] = 1
+    assert len(trie3) == 3
+
+    trie.clear()
+    assert len(trie) == 0
+
+
+def test_unpickle_old_state():
+    trie = datrie.BaseTrie(string.ascii_lowercase)
+    trie['foo'] = 1
+    state = trie.__reduce__()[2][0]
+
+    trie2 = datrie.BaseTrie(_create=False)
+    trie2.__setstate__(state)
+    assert trie2['foo'] == 1
+    assert len(trie2) == 1
+
+
+@pytest.mark.parametrize("cls", [datrie.BaseTrie, datrie.Trie, datrie.TypedTrie])
+def test_tobytes_frombytes(cls):
+    trie = cls(string.ascii_lowercase)
+    trie['foo'] = 1
+    trie['bar'] = 2
+    data = trie.tobytes()
+
+    fd, fname = tempfile.mkstemp()
+    trie.save(fname)
+    with open(fname, 'rb') as f:
+        assert f.read() == data
+
+    for buf in [data, bytearray(data), memoryview(data)]:
+        trie2 = cls.frombytes(buf)
+        assert trie2.items() == trie.items()
+        assert not trie2.frozen
+    assert cls.frombytes(data, frozen=True).frozen
+
+    with pytest.raises(datrie.DatrieError):
+        cls.frombytes(b'')
+    with pytest.raises(datrie.DatrieError):
+        cls.frombytes(b'foo')
+
+
+def test_trie_value_slots_reuse():
+    trie = datrie.Trie(string.ascii_lowercase)
+    for index, key in enumerate(['foo', 'bar', 'baz', 'qux']):
+        trie[key] = index
+    assert trie.tombstones == 0
+
+    del trie['bar']
+    assert trie.pop('foo') == 0
+    assert trie.tombstones == 2
+
+    trie['new'] = 'x'
+    assert trie.setdefault('other', 'y') == 'y'
+    assert trie.setdefault('other', 'z') == 'y'
+    assert trie.tombstones == 0
+    assert trie.items() == [('baz', 2), ('new', 'x'), ('other', 'y'), ('qux', 3)]
+
+    trie['BAD'] = 1  # out of alphabet, no slot is used
+    assert trie.tombstones == 0
+    assert len(trie) == 4
+
+
+def test_trie_compact():
+    trie = datrie.Trie(string.ascii_lowercase)
+    for index, key in enumerate(['foo', 'bar', 'baz', 'qux', 'quux']):
+        trie[key] = index
+    del trie['bar']
+    del trie['qux']
+    assert trie.tombstones == 2
+
+    trie2 = pickle.loads(pickle.dumps(trie))
+    assert trie2.tombstones == 2
+    scanner = trie2.scanner()
+    trie2.build_rank_index()
+    assert trie2.rank('quux') == 2
+    assert trie2.compact() == 2
+    with pytest.raises(RuntimeError):
+        scanner.findall('quux')
+    with pytest.raises(datrie.DatrieError):
+        trie2.select(2)
+    trie2.build_rank_index()
+    assert trie2.select(2) == 'quux'
+    assert trie2.top_k('q', 1) == [('quux', 4)]
+    assert trie2.tombstones == 0
+    assert trie2.items() == [('baz', 2), ('foo', 0), ('quux', 4)]
+    assert trie2.values() == trie2.get_many(trie2.keys())
+
+    fd, fname = tempfile.mkstemp()
+    trie.save(fname, compact=True)
+    assert trie.tombstones == 0
+    trie3 = datrie.Trie.load(fname)
+    assert trie3.tombstones == 0
+    assert trie3.items() == trie2.items()
+    trie3['bar'] = 'bar'
+    assert trie3['bar'] == 'bar'
+    assert trie3.tombstones == 0
+
+
+@pytest.mark.parametrize("top_k_key", [None, lambda value: value['s']])
+def test_trie_compact_with_top_k_index(top_k_key):
+    trie = datrie.Trie(string.ascii_lowercase)
+    if top_k_key is not None:
+        trie.top_k_key = top_k_key
+    for score, key in enumerate(['a', 'b', 'c', 'd']):
+        trie[key] = score + 0.5 if top_k_key is None else {'s': score}
+    del trie['a']
+    del trie['c']
+    assert [key for key, value in trie.top_k('', 2)] == ['d', 'b']
+
+    assert trie.compact() == 2
+    assert trie.keys() == ['b', 'd']
+    assert [key for key, value in trie.top_k('', 2)] == ['d', 'b']
+    assert trie.values() == trie.get_many(trie.keys())
+
+
+def test_typed_trie():
+    trie = datrie.TypedTrie(string.ascii_lowercase, typecode='q')
+    assert trie.typecode == 'q'
+    trie['foo'] = 1
+    trie['foobar'] = 2 ** 40
+    trie['bar'] = -3
+    trie['foo'] = 5
+
+    assert trie['foo'] == 5
+    assert trie.get('baz') is None
+    assert trie.setdefault('baz', 7) == 7
+    assert trie.setdefault('baz', 8) == 7
+    assert trie.items('foo') == [('foo', 5), ('foobar', 2 ** 40)]
+    assert list(trie.values()) == [-3, 7, 5, 2 ** 40]
+    assert trie.values().typecode == 'q'
+    assert trie.prefix_items('foobarz') == [('foo', 5), ('foobar', 2 ** 40)]
+    assert trie.longest_prefix_value('foob') == 5
+    assert trie.get_many(['bar', 'qux']) == [-3, None]
+
+    with pytest.raises(TypeError):
+        trie['qux'] = 'qux'
+    assert 'qux' not in trie
+    assert trie.tombstones == 0
+
+    del trie['bar']
+    assert trie.tombstones == 1
+    trie['qux'] = 1
+    assert trie.tombstones == 0
+    del trie['qux']
+    del trie['foo']
+
+
+@pytest.mark.parametrize("frozen", [False, True])
+def test_typed_trie_save_load(frozen):
+    trie = datrie.TypedTrie.build([('foo', 0.5), ('bar', 1.5), ('baz', 2.5)])
+    assert trie.typecode == 'd'
+    del trie['bar']
+
+    trie2 = pickle.loads(pickle.dumps(trie))
+    assert trie2.items() == trie.items()
+    assert trie2.tombstones == 1
+
+    fd, fname = tempfile.mkstemp()
+    trie.save(fname)
+    trie3 = datrie.TypedTrie.load(fname, frozen=frozen)
+    assert trie3.typecode == 'd'
+    assert trie3.items() == [('baz', 2.5), ('foo', 0.5)]
+    if not frozen:
+        assert trie3.compact() == 1
+        assert trie3.items() == [('baz', 2.5), ('foo', 0.5)]
+
+
 def test_setdefault():
     trie = datrie.Trie(string.ascii_lowercase)
     assert trie.setdefault('foo', 5) == 5